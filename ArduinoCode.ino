@@ -4,16 +4,27 @@
 */
 
 // software version:
-char softVersion[] = "V 0.0.1";
+char softVersion[] = "V 0.0.4";
+
+// the size of the grid and the number of hex characters in a frame message (one bit per plate)
+// (a larger grid needs maxX source pins and maxY ground pins listed below, the main software reads the size with DIM)
+const int maxX = 8;
+const int maxY = 9;
+const int frameChars = ((maxX * maxY + 7) / 8) * 2;
 
 // ground pins 0 to 8 (y axis on grid)
-int G[] = {2,3,4,5,6,7,8,9,10};
+int G[maxY] = {2,3,4,5,6,7,8,9,10};
 
 // source pins 1 to 8 (x axis on grid)
-int S[] = {11,12,13,14,15,16,17,18};
+int S[maxX] = {11,12,13,14,15,16,17,18};
 
 // holds the circular buffer for the serial input
-int serialBuffer[15];
+// (large enough to hold a whole frame message or a sparse frame of several plates)
+const int bufSize = 128;
+int serialBuffer[bufSize];
+
+// the longest message that can be taken (the buffer less the sequence tag, the \r\n and the end of string)
+const int maxMessage = bufSize - 6;
 
 // hold the index pointers for the circular buffer
 int bufTop = 0;
@@ -25,12 +36,12 @@ void clearPlates() {
   // set all plates off
   
   // set all source pins high
-  for (int i = 0; i < 8; i++) {
+  for (int i = 0; i < maxX; i++) {
     digitalWrite(S[i], HIGH);
   }
   
   // set all ground pins low
-  for (int i = 0; i < 9; i++) {
+  for (int i = 0; i < maxY; i++) {
     digitalWrite(G[i], LOW);
   }
 }
@@ -38,6 +49,10 @@ void clearPlates() {
 // ------------------------ set the plate at the given xy coordinates ------------------------
 void setPlate(int x, int y)
 {
+  // ignore plates that are not on the grid
+  if (x < 1 || x > maxX || y < 1 || y > maxY)
+    return;
+
   // set the given plate on
   digitalWrite(S[x-1], LOW);
   digitalWrite(G[y-1], HIGH);
@@ -46,60 +61,190 @@ void setPlate(int x, int y)
 // ------------------------ clear the plate at the given xy coordinates -----------------------
 void clearPlate(int x, int y)
 {
+  // ignore plates that are not on the grid
+  if (x < 1 || x > maxX || y < 1 || y > maxY)
+    return;
+
   // clear the given plate (turn off)
   digitalWrite(S[x-1], HIGH);
   digitalWrite(G[y-1], LOW);
 }
 
+// ------------------------ convert a hex character into its value ------------------------
+int hexValue(char c)
+{
+  if (c >= 'A' && c <= 'F')
+    return c - 'A' + 10;
+  return c - '0';
+}
+
+// ------------------------ set the whole grid from a frame message ------------------------
+void applyFrame(char message[])
+{
+  // the frame is a bitmask with one bit per plate (bit (y-1)*maxX + (x-1)), sent as pairs of hex characters
+  clearPlates();
+
+  for (int bit = 0; bit < maxX * maxY; bit++) {
+    int value = (hexValue(message[1 + (bit / 8) * 2]) << 4) | hexValue(message[2 + (bit / 8) * 2]);
+
+    if (value & (1 << (bit % 8)))
+      setPlate((bit % maxX) + 1, (bit / maxX) + 1);
+  }
+}
+
+// ------------------------ read a decimal number from a message, moving pos past it ------------------------
+int readNumber(char message[], int &pos)
+{
+  int value = 0;
+
+  while (message[pos] >= '0' && message[pos] <= '9') {
+    value = value * 10 + (message[pos] - '0');
+    pos++;
+  }
+  return value;
+}
+
+// ------------------------ read the x and y coordinates of a set or clear message ------------------------
+void readPlate(char message[], int &x, int &y)
+{
+  // either two single digits (S44) or two numbers separated by a comma (S12,3)
+  if (strchr(message, ',') == NULL) {
+    x = message[1] - 48;
+    y = message[2] - 48;
+  } else {
+    int pos = 1;
+    x = readNumber(message, pos);
+    pos++;
+    y = readNumber(message, pos);
+  }
+}
+
+// ------------------------ set the whole grid from a sparse frame message ------------------------
+void applySparseFrame(char message[])
+{
+  // the message lists the plates that are on (P1,2;12,3), every other plate is turned off
+  clearPlates();
+
+  int pos = 1;
+  while (message[pos] != 0) {
+    int x = readNumber(message, pos);
+    if (message[pos] != ',')
+      return;
+    pos++;
+
+    int y = readNumber(message, pos);
+    setPlate(x, y);
+
+    if (message[pos] == ';')
+      pos++;
+    else if (message[pos] != 0)
+      return;
+  }
+}
+
+// ------------------------ finish a reply, sending back the sequence tag of the message if it had one ------------------------
+void endReply(char tag[])
+{
+  if (tag[0] != 0) {
+    Serial.print(':');
+    Serial.print(tag);
+  }
+  Serial.println();
+}
+
 // ------------------------ act on a message that has been received ------------------------
 void messageReceived() {
 
-  // hold the message in a small int buffer
-  // (messages from main software are always 3 characters long (not including the \n closing char)
-  char message[3];
+  // hold the message in a char buffer
+  // (messages from main software are 3 characters long, or longer for frames and plates numbered 10 or more (not including the \r\n closing chars)
+  char message[bufSize];
+  int length = 0;
 
-  // extract the message from the serial buffer
-  for (int i = 0; i < 3; i++) {
-    message[i] = serialBuffer[bufBottom];
+  // extract the message from the serial buffer (up to the \r\n closing chars)
+  while (bufBottom != bufTop) {
+    char c = serialBuffer[bufBottom];
 
     // increment the bottom pointer of the circular buffer
     bufBottom++;
-    if (bufBottom >= 15)
+    if (bufBottom >= bufSize)
       bufBottom = 0;
+
+    if (c == '\r' || c == '\n')
+      break;
+
+    message[length] = c;
+    length++;
+  }
+  message[length] = 0;
+
+  // split off the sequence tag if there is one (e.g. S44:1F), the tag is sent back at the end of the reply
+  char *tag = &message[length];
+  for (int i = 0; i < length; i++) {
+    if (message[i] == ':') {
+      message[i] = 0;
+      tag = &message[i + 1];
+      length = i;
+      break;
+    }
   }
   
   // act on the message
-  if (message[0] == 'S') {
+  if (message[0] == 'F' && length == 1 + frameChars) {
+
+    // the message is a frame command, the rest of the message is the state of every plate
 
-    // the message is a set plate command, the other two bytes of the message should contain the integers for x and y
+    // return acknowledgement
+    Serial.print("ACK ");
+    Serial.print(message);
+    endReply(tag);
+
+    applyFrame(message);
+
+  } else if (message[0] == 'P') {
+
+    // the message is a sparse frame command, the rest of the message lists the plates that are on
 
     // return acknowledgement
     Serial.print("ACK ");
-    Serial.print(message[0]);
-    Serial.print(message[1]);
-    Serial.println(message[2]);
+    Serial.print(message);
+    endReply(tag);
+
+    applySparseFrame(message);
+
+  } else if (message[0] == 'S') {
+
+    // the message is a set plate command, the rest of the message contains the integers for x and y
+
+    // return acknowledgement
+    Serial.print("ACK ");
+    Serial.print(message);
+    endReply(tag);
 
     // extract the two x and y coordinates and set the plate at those coords
-    setPlate(message[1]-48, message[2]-48);
+    int x, y;
+    readPlate(message, x, y);
+    setPlate(x, y);
     
   } else if (message[0] == 'C' && message[1] != 'A' && message[2] != 'P') {
-    // the message is a clear plate command, the other two bytes of the message should contain the integers for x and y
+    // the message is a clear plate command, the rest of the message contains the integers for x and y
 
     // return acknowledgement
     Serial.print("ACK ");
-    Serial.print(message[0]);
-    Serial.print(message[1]);
-    Serial.println(message[2]);
+    Serial.print(message);
+    endReply(tag);
 
     // extract the two x and y coordinates and clear the plate at those coords
-    clearPlate(message[1]-48, message[2]-48);
+    int x, y;
+    readPlate(message, x, y);
+    clearPlate(x, y);
     
   } else if (message[0] == 'C' && message[1] == 'A' && message[2] == 'P') {
 
     // the message is a clear all plates command
 
     // return acknowledgement
-    Serial.println("ACK CAP");
+    Serial.print("ACK CAP");
+    endReply(tag);
     
     clearPlates();
     
@@ -107,7 +252,20 @@ void messageReceived() {
 
     // the message is an arduino software version request
     // return software version
-    Serial.println(softVersion);
+    Serial.print(softVersion);
+    endReply(tag);
+
+  } else if (message[0] == 'D' && message[1] == 'I' && message[2] == 'M') {
+
+    // the message is a descriptor request
+    // return the size of the grid and the longest message that can be taken
+    Serial.print("DIM ");
+    Serial.print(maxX);
+    Serial.print(',');
+    Serial.print(maxY);
+    Serial.print(',');
+    Serial.print(maxMessage);
+    endReply(tag);
   }
 }
 
@@ -127,7 +285,7 @@ void readSerialInput() {
 
     // increment the top position 'pointer'
     bufTop++;
-    if (bufTop >= 15)
+    if (bufTop >= bufSize)
       bufTop = 0;
 
     // check if the new byte was a new line char...
@@ -148,10 +306,10 @@ void setup() {
   
   // initialise the digital pins as an output.
   // initialise the ground pins
-  for (int i = 0; i < 9; i++) {
+  for (int i = 0; i < maxY; i++) {
     pinMode(G[i], OUTPUT);
   }
-  for (int i = 0; i < 8; i++) {
+  for (int i = 0; i < maxX; i++) {
     pinMode(S[i], OUTPUT);
   }
 
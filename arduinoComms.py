@@ -3,29 +3,224 @@ All communication follows the protocol
 This code abstracts the protocol so that higher layers can use this without knowing what the protocol is"""
 
 import serialComms
+import serialTransport
+import telemetry
 import time
 
+#the grid of arduino code that has no descriptor, and the longest message it can take: the original code (0.0.1)
+#only takes 3 character messages, so that is assumed when the version is not known
+DEFAULT_DIMENSIONS = [8, 9]
+DEFAULT_MAX_MESSAGE = 3
+#the first arduino code to take frames and the longest message it can take (its 32 byte buffer less the sequence tag and \r\n)
+FRAME_VERSION = (0, 0, 2)
+FRAME_MAX_MESSAGE = 26
+#the first arduino code to answer DIM
+DESCRIPTOR_VERSION = (0, 0, 4)
+
+def get_version_number(version):
+	"""The version number of a version reply ("V 0.0.3" -> (0, 0, 3)), None if it cannot be read"""
+	
+	try:
+		return tuple(int(number) for number in version[2:].split("."))
+	except ValueError:
+		return None
+
+
+def get_address(x, y):
+	"""The address of a plate in a set or clear message, two digits if both coordinates are below 10
+	(as the original protocol) otherwise the two numbers separated by a comma"""
+	
+	if x < 10 and y < 10:
+		return "%i%i" % (x, y)
+	return "%i,%i" % (x, y)
+
+
 class ArduinoCommunication:
 	
-	def __init__(self, port_name, dimensions=[8,9]):
+	def __init__(self, port_name, dimensions=[8,9], pipelined=False, baudrate=9600, connection=None, ready_timeout=5.0, version=None):
 		"""Initialise the state of the object and its attributes
+		If dimensions is None the size of the grid is asked for from the arduino (see read_descriptor)
+		If pipelined is True, commands are sent through a SerialTransport with sequence numbers,
+		each command then returns a CommandFuture for its reply and check_replies is not needed
+		The baudrate has to match the one set in the arduino code
+		An already open connection can be given in place of the port (see SerialCommunication),
+		otherwise the port is opened and the arduino is waited for (up to ready_timeout seconds) as it resets
+		version is the version reply of the arduino on an open connection (it is asked for otherwise), the messages
+		are kept to what that version takes (see set_version)
 		"""
 		
-		self.serial = serialComms.SerialCommunication(port_name)
-		self.maxX = dimensions[0]
-		self.maxY = dimensions[1]
+		self.serial = serialComms.SerialCommunication(port_name, baudrate, connection)
+		self.maxX = DEFAULT_DIMENSIONS[0]
+		self.maxY = DEFAULT_DIMENSIONS[1]
+		if dimensions is not None:
+			self.maxX = dimensions[0]
+			self.maxY = dimensions[1]
+		
+		#the longest message (not including the sequence tag and \r\n) the arduino can take,
+		#and whether it takes sparse frames, both are known from the version or the descriptor of newer arduino code
+		self.max_message = DEFAULT_MAX_MESSAGE
+		self.sparse_frames = False
 		
 		self.msg_queue = []
 		self.arduino_version = ""
+		#the number of replies still to come to the version requests sent while waiting for the arduino to start
+		self.pending_versions = 0
+		#the times the commands in msg_queue were sent (command -> list of times), only kept when the telemetry is enabled
+		self.sent_times = {}
+		
+		#the plates that are on as far as the arduino has been told (a set of (x, y) coordinates)
+		self.plates = set()
+		#the state being built up for the next commit (None when nothing has been staged)
+		self.staged = None
+		#whether the arduino is known to match self.plates (it is not until a whole frame has been sent)
+		self.synced = False
+		
+		if connection is None:
+			self.wait_until_ready(ready_timeout)
+		elif version is not None:
+			self.set_version(version)
+		
+		if dimensions is None:
+			self.read_descriptor()
+		
+		self.transport = None
+		if pipelined:
+			self.transport = serialTransport.SerialTransport(self.serial, resync=self.get_resync_messages)
+			self.transport.start()
+	
+	
+	def wait_until_ready(self, timeout=5.0, poll_interval=0.1):
+		"""Wait for the arduino to start (it resets when the port is opened) by asking for its version until it answers
+		The version is stored as arduino_version
+		Raises an IOError if the arduino has not answered within timeout seconds"""
+		
+		end = time.time() + timeout
+		sent = 0
+		
+		while True:
+			self.serial.write("VER")
+			sent += 1
+			
+			#give the arduino poll_interval seconds to answer before asking again
+			poll_end = min(time.time() + poll_interval, end)
+			while True:
+				for msg in self.serial.read():
+					if msg[0:1] == 'V':
+						#the other requests may still be answered
+						self.pending_versions = sent - 1
+						self.set_version(msg)
+						return
+				
+				if time.time() >= poll_end:
+					break
+				time.sleep(0.005)
+			
+			if time.time() >= end:
+				raise IOError("The arduino did not answer within %.1f seconds" % (timeout,))
+	
+	
+	def set_version(self, version):
+		"""Store the version reply of the arduino and keep the messages to what that version takes:
+		3 characters for the original code (and unknown versions), frames of up to 26 characters from 0.0.2"""
+		
+		self.arduino_version = version
+		
+		number = get_version_number(version)
+		if number is not None and number >= FRAME_VERSION:
+			self.max_message = FRAME_MAX_MESSAGE
+		else:
+			self.max_message = DEFAULT_MAX_MESSAGE
+	
+	
+	def read_descriptor(self, timeout=1.0):
+		"""Ask the arduino for its descriptor (DIM [x],[y],[n]): the size of its grid and the longest message it can take
+		Arduino code that is too old to answer is taken to be the original 8 x 9 grid, it is not asked if its version
+		is known to be older than 0.0.4
+		Returns True if the arduino answered"""
+		
+		number = get_version_number(self.arduino_version)
+		if number is not None and number < DESCRIPTOR_VERSION:
+			return False
+		
+		self.serial.write("DIM")
+		
+		end = time.time() + timeout
+		while time.time() < end:
+			for msg in self.serial.read():
+				if msg[0:1] == 'V' and self.pending_versions > 0:
+					self.pending_versions -= 1
+				
+				if msg[0:4] == "DIM ":
+					try:
+						maxX, maxY, max_message = [int(value) for value in msg[4:].split(",")]
+					except ValueError:
+						raise IOError("The arduino sent a descriptor that could not be read: %s" % (msg,))
+					
+					self.set_descriptor(maxX, maxY, max_message)
+					return True
+			
+			time.sleep(0.005)
+		
+		return False
+	
+	
+	def set_descriptor(self, maxX, maxY, max_message):
+		"""Set the grid size and the longest message as given in the descriptor of the arduino (which takes sparse frames)"""
+		
+		self.maxX = maxX
+		self.maxY = maxY
+		self.max_message = max_message
+		self.sparse_frames = True
+	
+	
+	def send_command(self, command):
+		"""Send the command to the arduino
+		Returns a CommandFuture for the reply if pipelined, otherwise the command is queued until its reply is checked"""
+		
+		telemetry.count("serial.commands")
+		
+		if self.transport is not None:
+			future = self.transport.send(command)
+			future.add_done_callback(self.command_done)
+			return future
+		
+		if telemetry.enabled:
+			self.sent_times.setdefault(command, []).append(time.time())
+		
+		self.msg_queue.append(command)
+		self.serial.write(command)
+	
+	
+	def command_done(self, future):
+		"""Check the reply to a pipelined command, if it failed the arduino may no longer match the plate state"""
+		
+		if future.error is not None:
+			self.synced = False
+			telemetry.count("serial.failed")
+		elif telemetry.enabled:
+			#the time from the last time the command was sent
+			telemetry.observe("serial.round_trip", time.time() - future.sent_time)
+			telemetry.count("serial.retransmits", future.attempts - 1)
+	
+	
+	def get_resync_messages(self, command):
+		"""Get the messages to send in place of a pipelined plate command that was lost after later commands were sent
+		Sending it again would apply it after them, so the whole plate state is sent instead
+		Returns None for commands that do not change the plates, they are sent again"""
+		
+		if command == "CAP" or command[0:1] in ["S", "C", "F", "P"]:
+			return self.get_frame_messages(list(self.plates))
+		
+		return None
 	
 	
 	def validate_coordinates(self, x, y):
 		"""Validates the given coordinates
-		x and y must be positive integers
-		They cannot be more than the dimensions given at initialisation, or less than 0
+		x and y must be positive integers (plates are numbered from 1, as they are in the arduino code)
+		They cannot be more than the dimensions given at initialisation, or less than 1
 		"""
 		
-		if x < 0 or x >= self.maxX or y < 0 or y >= self.maxY:
+		if x < 1 or x > self.maxX or y < 1 or y > self.maxY:
 			#error
 			raise ValueError("x or y are out of bounds for set plate function")
 	
@@ -37,8 +232,8 @@ class ArduinoCommunication:
 		"""
 		self.validate_coordinates(x, y)
 		
-		self.msg_queue.append("S%i%i" % (x,y))
-		self.serial.write(self.msg_queue[-1])
+		self.plates.add((x, y))
+		return self.send_command("S" + get_address(x, y))
 		
 		
 	def clear_plate(self, x, y):
@@ -47,26 +242,176 @@ class ArduinoCommunication:
 		"""
 		
 		self.validate_coordinates(x, y)
-		self.msg_queue.append("C%i%i" % (x,y))
-		self.serial.write(self.msg_queue[-1])
+		
+		self.plates.discard((x, y))
+		return self.send_command("C" + get_address(x, y))
+		
+	
+	def get_frame_messages(self, plates):
+		"""Return the messages that set the given plates on and every other plate off, using the fewest bytes
+		The frame is sent as a bitmask with one bit per plate (bit (y-1)*maxX + (x-1)), packed into bytes
+		and written as hex characters so that it cannot contain the \\r\\n end of message characters,
+		or (if the arduino takes them) as a sparse frame listing only the plates that are on (P[x],[y];[x],[y]...),
+		whichever is shorter and fits in a message
+		On a grid too large for either the plates are cleared and then set one at a time
+		"""
+		
+		messages = []
+		
+		#the bitmask grows with the grid and the sparse frame with the number of plates that are on
+		if (self.maxX * self.maxY + 7) // 8 * 2 + 1 <= self.max_message:
+			bitmask = [0] * ((self.maxX * self.maxY + 7) // 8)
+			for x, y in plates:
+				bit = (y - 1) * self.maxX + (x - 1)
+				bitmask[bit // 8] |= 1 << (bit % 8)
+			messages.append("F" + "".join("%02X" % (byte,) for byte in bitmask))
+		
+		if self.sparse_frames:
+			sparse = "P" + ";".join("%i,%i" % (x, y) for x, y in sorted(plates))
+			if len(sparse) <= self.max_message:
+				messages.append(sparse)
+		
+		if messages != []:
+			return [min(messages, key=len)]
+		
+		return ["CAP"] + ["S" + get_address(x, y) for x, y in sorted(plates)]
+	
+	
+	def apply_frame(self, plates):
+		"""Sets the whole grid, the given plates are set on and every other plate is cleared
+		plates is a list of (x, y) coordinates
+		The grid is set in a single message unless it is too large (see get_frame_messages)
+		Returns the reply to the last message sent
+		"""
+		
+		return self.send_frame(plates)[-1]
+	
+	
+	def send_frame(self, plates):
+		"""Sets the whole grid as apply_frame does, returns the replies to every message sent"""
+		
+		for x, y in plates:
+			self.validate_coordinates(x, y)
+		
+		self.plates = set(plates)
+		self.synced = True
+		
+		return [self.send_command(message) for message in self.get_frame_messages(plates)]
 		
 	
 	def clear_all_plates(self):
 		"""Sends a message to clear all plates (turn all plates off)"""
 		
-		self.msg_queue.append("CAP")
-		self.serial.write("CAP")
+		self.plates = set()
+		self.synced = True
+		return self.send_command("CAP")
+	
+	
+	def stage_plate(self, x, y, on=True):
+		"""Stage the plate at x, y to be turned on (or off) at the next commit"""
+		
+		self.validate_coordinates(x, y)
+		
+		if self.staged is None:
+			self.staged = set(self.plates)
+		
+		if on:
+			self.staged.add((x, y))
+		else:
+			self.staged.discard((x, y))
+	
+	
+	def stage_plates(self, plates):
+		"""Stage the given plates (a list of (x, y) coordinates) as the only plates on at the next commit"""
+		
+		for x, y in plates:
+			self.validate_coordinates(x, y)
+		
+		self.staged = set(plates)
+	
+	
+	def discard(self):
+		"""Throw away the staged changes"""
+		
+		self.staged = None
+	
+	
+	def commit(self):
+		"""Send the staged changes to the arduino using the fewest bytes
+		Only the plates that have changed are sent, as single clear and set messages or a whole frame (see get_frame_messages),
+		whichever is shorter
+		A frame is also sent if clearing a plate would turn off another plate that is staying on (clearing a plate
+		clears its whole row and column of pins) or the arduino is not known to match the plate state
+		Returns the list of replies (CommandFutures if pipelined, otherwise Nones), empty if nothing has changed"""
+		
+		if self.staged is None:
+			return []
+		
+		staged = self.staged
+		self.staged = None
+		
+		if not self.synced:
+			return self.send_frame(list(staged))
+		
+		to_clear = self.plates - staged
+		to_set = staged - self.plates
+		kept = staged & self.plates
+		
+		kept_columns = set(x for x, y in kept)
+		kept_rows = set(y for x, y in kept)
+		unsafe = any(x in kept_columns or y in kept_rows for x, y in to_clear)
+		
+		if not unsafe:
+			#every message is followed by \r\n
+			single_size = sum(len(get_address(x, y)) + 3 for x, y in to_clear | to_set)
+			frame_size = sum(len(message) + 2 for message in self.get_frame_messages(staged))
+			
+			if single_size < frame_size:
+				replies = []
+				for x, y in sorted(to_clear):
+					replies.append(self.clear_plate(x, y))
+				for x, y in sorted(to_set):
+					replies.append(self.set_plate(x, y))
+				
+				return replies
+		
+		return self.send_frame(list(staged))
+	
+	
+	def reconcile(self):
+		"""Send the whole plate state to the arduino so that it matches (e.g. after reconnecting, as the arduino resets)"""
+		
+		if self.staged is not None:
+			self.commit()
+		
+		return self.apply_frame(list(self.plates))
 		
 	
 	def get_version(self):
 		"""Sends a message to get the version of the software that is running on the arduino"""
 		
-		self.msg_queue.append("VER")
-		self.serial.write("VER")
+		future = self.send_command("VER")
+		
+		if future is not None:
+			#the version is stored once the reply arrives
+			future.add_done_callback(self.version_received)
+		
+		return future
+	
+	
+	def version_received(self, future):
+		"""Store the version from the reply to a pipelined VER request"""
+		
+		if future.error is None:
+			self.arduino_version = future.reply
 		
 	
 	def check_replies(self):
-		"""Check the replies from the arduino"""
+		"""Check the replies from the arduino
+		(when pipelined the replies are checked by the transport instead)"""
+		
+		if self.transport is not None:
+			return
 		
 		msg_list = self.serial.read()
 		
@@ -80,18 +425,35 @@ class ArduinoCommunication:
 			if original_msg in self.msg_queue:
 				self.msg_queue.remove(original_msg)
 				
+				sent_times = self.sent_times.get(original_msg)
+				if sent_times:
+					#the round trip time is only known to when the reply was checked
+					telemetry.observe("serial.round_trip", time.time() - sent_times.pop(0))
+				
+			elif original_msg == "VER" and self.pending_versions > 0:
+				#the reply to one of the requests sent while waiting for the arduino to start
+				self.pending_versions -= 1
+				
 			else:
 				#error unexpected message arrived from arduino
 				print("Unexpected message arrived from arduino: %s" % (msg,))
+				telemetry.count("serial.unexpected")
 
 
 if __name__ == "__main__":
 	# test suite for this module
 	acomms = ArduinoCommunication("/dev/ttyACM0")
 	acomms.set_plate(4,2)
-	#acomms.set_plate(6,9) #correctly errors on this command
+	#acomms.set_plate(6,10) #correctly errors on this command
 	acomms.clear_plate(1,6)
+	acomms.apply_frame([(1,1), (8,9)])
 	acomms.clear_all_plates()
+	#only the changed plates are sent (S23 and S56, then C23 and S57)
+	acomms.stage_plates([(2,3), (5,6)])
+	acomms.commit()
+	acomms.stage_plate(2,3, False)
+	acomms.stage_plate(5,7)
+	acomms.commit()
 	acomms.get_version()
 	
 	# wait for arduino to respond
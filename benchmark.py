@@ -0,0 +1,353 @@
+"""This module benchmarks the main parts of the software so that changes can be checked for speed
+It covers the user input parser, the path planning, the visual feedback stages and the serial framing
+The results are written as JSON and can be compared against a stored baseline to find any regressions
+
+Usage:   python benchmark.py [--output results.json] [--baseline baseline.json] [--save-baseline baseline.json] [--rounds 3]"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+import arduinoComms
+import cameraInput
+import droplet_program
+import pathPlanner
+import serialComms
+import userInput
+
+class FakeSerialConnection:
+	"""Acts as an open pyserial connection to the arduino, answering every command straight away
+	The replies are the same as the arduino code would send"""
+
+	def __init__(self, version="V 0.0.3"):
+		"""Initialise object state"""
+
+		self.version = version
+		self.output = bytearray()
+		self.written = 0
+
+	def write(self, data):
+		"""Receive a message and queue its reply"""
+
+		self.written += len(data)
+
+		for message in data.split("\r\n"):
+			if message == "":
+				continue
+
+			command, sep, tag = message.partition(":")
+			if command == "VER":
+				reply = self.version
+			else:
+				reply = "ACK " + command
+
+			self.output.extend("%s%s%s\r\n" % (reply, sep, tag))
+
+	def feed(self, data):
+		"""Add bytes to be read, as if the arduino had sent them"""
+
+		self.output.extend(data)
+
+	def inWaiting(self):
+		"""The number of bytes waiting to be read"""
+
+		return len(self.output)
+
+	def read(self, size=1):
+		"""Read up to size bytes"""
+
+		data = bytes(self.output[:size])
+		del self.output[:size]
+		return data
+
+	def close(self):
+		"""Nothing to close"""
+
+		pass
+
+
+def measure(function, repeat=5, setup=None, min_time=0.02):
+	"""Time the function, repeat times
+	If a setup function is given, it is called (untimed) before each run and its result is passed to the function,
+	otherwise each time is taken over enough calls to last at least min_time seconds (so that short functions
+	are not lost in the timer and scheduler noise)
+	Returns a dictionary with the minimum and median time of a single call in seconds"""
+
+	times = []
+	number = 1
+
+	if setup is None:
+		#double the number of calls until they take long enough to time
+		while True:
+			start = timeit.default_timer()
+			for i in range(0, number):
+				function()
+			if timeit.default_timer() - start >= min_time:
+				break
+			number *= 2
+
+	for i in range(0, repeat):
+		if setup is not None:
+			arg = setup()
+			start = timeit.default_timer()
+			function(arg)
+		else:
+			start = timeit.default_timer()
+			for j in range(0, number):
+				function()
+		times.append((timeit.default_timer() - start) / number)
+
+	times.sort()
+	return {'min': times[0], 'median': times[len(times) // 2], 'repeat': repeat, 'number': number}
+
+
+def generate_protocol(filename, lines):
+	"""Write a valid user input file with the given number of instruction lines
+	Each block of the protocol creates, mixes, moves and splits droplets, leaving one droplet behind"""
+
+	rand = random.Random(lines)
+	block = ["NEW A%i > %i,%i", "NEW B%i > %i,%i", "MIX A%i + B%i > C%i", "MOVE C%i > %i,%i", "SPLIT C%i > D%i,E%i", "MIX D%i + E%i > F%i"]
+
+	output = open(filename, "w")
+	for line in range(0, lines):
+		n = line // len(block)
+		template = block[line % len(block)]
+
+		if template.startswith("NEW") or template.startswith("MOVE"):
+			output.write(template % (n, rand.randint(1, 8), rand.randint(1, 9)) + "\n")
+		else:
+			output.write(template % (n, n, n) + "\n")
+	output.close()
+
+
+def benchmark_parser(sizes, directory):
+	"""Time UserInput.load_input_file and the streaming UserInput.read_input_file on generated protocols of each size"""
+
+	results = {}
+
+	for size in sizes:
+		filename = os.path.join(directory, "protocol_%i.txt" % (size,))
+		generate_protocol(filename, size)
+
+		results["parser.load_input_file.%i" % (size,)] = measure(lambda: userInput.UserInput().load_input_file(filename), repeat=3 if size < 100000 else 1)
+		results["parser.read_input_file.%i" % (size,)] = measure(lambda: sum(1 for instruction in userInput.UserInput().read_input_file(filename)), repeat=3 if size < 100000 else 1)
+
+	return results
+
+
+def benchmark_planning():
+	"""Time the path planning: Droplet.add_path, the multi droplet router and Grid.run_program against a fake serial port"""
+
+	results = {}
+	dimensions = {'maxX': 8, 'maxY': 9}
+	rand = random.Random(1)
+
+	pairs = [({'x': rand.randint(1, 8), 'y': rand.randint(1, 9)}, {'x': rand.randint(1, 8), 'y': rand.randint(1, 9)}) for i in range(0, 1000)]
+
+	def add_paths():
+		for start, goal in pairs:
+			droplet_program.Droplet(dict(start), 0).add_path(goal)
+
+	results["planning.add_path.1000"] = measure(add_paths)
+
+	#four droplets that have to cross each other to reach the other side of the grid
+	moves = {
+		'A': ({'x': 1, 'y': 1}, {'x': 8, 'y': 7}),
+		'B': ({'x': 8, 'y': 1}, {'x': 1, 'y': 7}),
+		'C': ({'x': 1, 'y': 4}, {'x': 8, 'y': 9}),
+		'D': ({'x': 8, 'y': 4}, {'x': 1, 'y': 9}),
+	}
+	router = pathPlanner.Router(dimensions)
+	results["planning.router.4_crossing"] = measure(lambda: router.plan(moves))
+
+	#run the same four droplets across the grid as a program, through the serial protocol (without waiting between steps)
+	instructions = [(userInput.Instructions.NEW, [key, str(moves[key][0]["x"]), str(moves[key][0]["y"])]) for key in sorted(moves.keys())]
+	instructions += [(userInput.Instructions.MOVE, [key, str(moves[key][1]["x"]), str(moves[key][1]["y"])]) for key in sorted(moves.keys())]
+
+	def setup_grid():
+		connection = FakeSerialConnection()
+		grid = droplet_program.Grid(arduinoComms.ArduinoCommunication("", connection=connection, version=connection.version), cameraInput.CameraInput())
+		grid.waiting_time = 0
+		return grid
+
+	results["planning.run_program.4_crossing"] = measure(lambda grid: grid.run_program(instructions), setup=setup_grid)
+
+	return results
+
+
+def benchmark_vision(images):
+	"""Time every stage of CameraInput.find_drop_positions on the test images"""
+
+	results = {}
+	cam = cameraInput.CameraInput()
+
+	for filename in images:
+		name = os.path.splitext(os.path.basename(filename))[0]
+		img = cameraInput.cv2.imread(filename)
+
+		gaus_blur = cam.prepare_image(img)
+		cam.visualisation = cameraInput.np.zeros(gaus_blur.shape, cameraInput.np.uint8)
+		board = cam.find_board_edges(gaus_blur)
+		droplets = cam.find_circles(gaus_blur)
+
+		results["vision.%s.prepare_image" % (name,)] = measure(lambda: cam.prepare_image(img))
+		results["vision.%s.find_board_edges" % (name,)] = measure(lambda: cam.find_board_edges(gaus_blur))
+		results["vision.%s.find_circles" % (name,)] = measure(lambda: cam.find_circles(gaus_blur))
+		results["vision.%s.get_grid_positions" % (name,)] = measure(lambda: cam.get_grid_positions(droplets, board))
+		results["vision.%s.total" % (name,)] = measure(lambda: cam.find_drop_positions(frame=img))
+
+		#the per plate classifier, using the calibration of this image
+		occupancy = cameraInput.CameraInput()
+		occupancy.detection_mode = "occupancy"
+		occupancy.calibrate(frame=img)
+		results["vision.%s.occupancy" % (name,)] = measure(lambda: occupancy.find_drop_positions(frame=img))
+
+	return results
+
+
+def benchmark_serial(burst_sizes):
+	"""Time SerialCommunication.read splitting a burst of acknowledgements, all arriving at once or a few bytes at a time"""
+
+	results = {}
+
+	for size in burst_sizes:
+		burst = "".join("ACK S%i%i\r\n" % (i % 8 + 1, i % 9 + 1) for i in range(0, size))
+
+		def setup_burst():
+			connection = FakeSerialConnection()
+			connection.feed(burst)
+			return serialComms.SerialCommunication(connection=connection)
+
+		results["serial.read.burst_%i" % (size,)] = measure(lambda comm: comm.read(), setup=setup_burst)
+
+		def read_trickle(comm):
+			#the bytes arrive 7 at a time, so most reads end part way through a message
+			for i in range(0, len(burst), 7):
+				comm.connection.feed(burst[i:i + 7])
+				comm.read()
+
+		results["serial.read.trickle_%i" % (size,)] = measure(read_trickle, setup=lambda: serialComms.SerialCommunication(connection=FakeSerialConnection()))
+
+	return results
+
+
+def compare(results, baseline, tolerance):
+	"""Compare the results with the baseline, using the minimum times (the run least disturbed by anything else)
+	A benchmark only counts as slower if it is slower by more than the tolerance (a fraction) plus the noise seen
+	in either run (how far the median is above the minimum)
+	Returns the list of benchmark names that are slower than the baseline"""
+
+	regressions = []
+
+	print("%-50s %12s %12s %8s %8s" % ("benchmark", "baseline (s)", "current (s)", "ratio", "allowed"))
+	for name in sorted(results.keys()):
+		if name not in baseline:
+			print("%-50s %12s %12.6f %8s" % (name, "-", results[name]['min'], "new"))
+			continue
+
+		noise = max(get_noise(results[name]), get_noise(baseline[name]))
+		ratio = results[name]['min'] / max(baseline[name]['min'], 1e-9)
+		flag = ""
+		if ratio > 1 + tolerance + noise:
+			regressions.append(name)
+			flag = " SLOWER"
+		elif ratio < 1 - tolerance - noise:
+			flag = " faster"
+
+		print("%-50s %12.6f %12.6f %8.2f %8.2f%s" % (name, baseline[name]['min'], results[name]['min'], ratio, 1 + tolerance + noise, flag))
+
+	return regressions
+
+
+def get_noise(timing):
+	"""How far (as a fraction) the median time is above the minimum time"""
+
+	return (timing['median'] - timing['min']) / max(timing['min'], 1e-9)
+
+
+def run_rounds(suites, quick=False, rounds=3):
+	"""Run the chosen benchmark suites rounds times, returning a dictionary of benchmark name -> timings
+	The times of each benchmark are spread over the rounds, so that a spell of the machine running slowly
+	cannot slow down every run of a benchmark, the minimum is the fastest of any round"""
+
+	all_results = [run(suites, quick) for i in range(0, rounds)]
+
+	results = {}
+	for name in all_results[0]:
+		timings = [round_results[name] for round_results in all_results]
+		medians = sorted(timing['median'] for timing in timings)
+		results[name] = {
+			'min': min(timing['min'] for timing in timings),
+			'median': medians[len(medians) // 2],
+			'repeat': sum(timing['repeat'] for timing in timings),
+			'number': timings[0]['number'],
+		}
+
+	return results
+
+
+def run(suites, quick=False):
+	"""Run the chosen benchmark suites once, returning a dictionary of benchmark name -> timings"""
+
+	results = {}
+	directory = tempfile.mkdtemp()
+
+	try:
+		if "parser" in suites:
+			sizes = [10, 100, 1000] if quick else [10, 100, 1000, 10000, 100000]
+			results.update(benchmark_parser(sizes, directory))
+		if "planning" in suites:
+			results.update(benchmark_planning())
+		if "vision" in suites:
+			here = os.path.dirname(os.path.abspath(__file__))
+			images = [os.path.join(here, name) for name in ["test_4_5.jpg", "test_4_6.jpg", "test_5_5.jpg", "test_6_5.jpg"]]
+			results.update(benchmark_vision(images))
+		if "serial" in suites:
+			results.update(benchmark_serial([100, 1000] if quick else [100, 1000, 10000]))
+	finally:
+		shutil.rmtree(directory)
+
+	return results
+
+
+if __name__=="__main__":
+
+	parser = argparse.ArgumentParser(description="Benchmark the droplet software")
+	parser.add_argument("--output", help="write the results to this JSON file")
+	parser.add_argument("--baseline", help="compare the results against this JSON file (exits with status 1 on any regression)")
+	parser.add_argument("--save-baseline", help="write the results to this JSON file as the new baseline")
+	parser.add_argument("--tolerance", type=float, default=0.25, help="fraction slower than the baseline that counts as a regression")
+	parser.add_argument("--suites", default="parser,planning,vision,serial", help="comma separated list of the suites to run")
+	parser.add_argument("--quick", action="store_true", help="use smaller input sizes")
+	parser.add_argument("--rounds", type=int, default=3, help="the number of times to run the suites (default %(default)i)")
+	args = parser.parse_args()
+
+	random.seed(0)
+	results = run_rounds(args.suites.split(","), args.quick, args.rounds)
+
+	report = {
+		'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'quick': args.quick},
+		'results': results,
+	}
+
+	if args.output:
+		json.dump(report, open(args.output, "w"), indent=1, sort_keys=True)
+	if args.save_baseline:
+		json.dump(report, open(args.save_baseline, "w"), indent=1, sort_keys=True)
+
+	if args.baseline:
+		regressions = compare(results, json.load(open(args.baseline))['results'], args.tolerance)
+
+		if regressions != []:
+			print("")
+			print("%i benchmarks are slower than the baseline" % (len(regressions),))
+			sys.exit(1)
+	else:
+		for name in sorted(results.keys()):
+			print("%-50s %12.6f s" % (name, results[name]['min']))
@@ -2,27 +2,195 @@ import cv2
 import numpy as np
 import time
 import math
+import json
+import os.path
+import threading
+import sys
+import csv
+import collections
+import multiprocessing
+
+import telemetry
+
+class FrameGrabber:
+	"""Reads frames from a capture on a background thread, keeping only the newest frame
+	so that reading a frame never waits on the camera and is never an old frame from the driver's buffer
+	The frames are copied into two buffers that are allocated once (the one being filled and the newest complete frame)"""
+	
+	def __init__(self, capture):
+		"""Initialise the grabber on an open capture object (anything with read() like cv2.VideoCapture)"""
+		
+		self.capture = capture
+		
+		#the newest complete frame and the buffer that the next frame is copied into
+		self.frame = None
+		self.next_frame = None
+		#the time the newest frame was read and the number of frames read so far
+		self.timestamp = 0
+		self.count = 0
+		
+		self.lock = threading.Condition()
+		self.running = False
+		self.thread = None
+	
+	
+	def start(self):
+		"""Start the background capture thread"""
+		
+		self.running = True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	
+	def stop(self):
+		"""Stop the background capture thread"""
+		
+		self.running = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		
+		#wake anything still waiting for a frame
+		with self.lock:
+			self.lock.notify_all()
+	
+	
+	def run(self):
+		"""The capture thread: read frames as fast as the capture gives them"""
+		
+		while self.running:
+			ret, img = self.capture.read()
+			timestamp = time.time()
+			
+			if not ret or img is None:
+				#no frame available, try again shortly
+				time.sleep(0.01)
+				continue
+			
+			#copy the frame into the spare buffer (reallocating only if the frame size changes)
+			if self.next_frame is None or self.next_frame.shape != img.shape or self.next_frame.dtype != img.dtype:
+				self.next_frame = np.empty_like(img)
+			np.copyto(self.next_frame, img)
+			
+			#the spare buffer becomes the newest frame and the old newest frame becomes the spare buffer
+			with self.lock:
+				self.frame, self.next_frame = self.next_frame, self.frame
+				self.timestamp = timestamp
+				self.count += 1
+				self.lock.notify_all()
+	
+	
+	def latest_frame(self):
+		"""Return a copy of the newest frame and the time it was read without waiting
+		Returns (None, 0) if no frame has been read yet"""
+		
+		with self.lock:
+			if self.frame is None:
+				return None, 0
+			return self.frame.copy(), self.timestamp
+	
+	
+	def wait_for_frame(self, after=0, timeout=None):
+		"""Wait for a frame read later than the time after (from time.time) and return a copy of it and the time it was read
+		Returns (None, 0) if there is no such frame within the timeout (in seconds)"""
+		
+		end = None
+		if timeout is not None:
+			end = time.time() + timeout
+		
+		with self.lock:
+			while self.frame is None or self.timestamp <= after:
+				if not self.running:
+					return None, 0
+				
+				remaining = None
+				if end is not None:
+					remaining = end - time.time()
+					if remaining <= 0:
+						return None, 0
+				
+				self.lock.wait(remaining)
+			
+			return self.frame.copy(), self.timestamp
+
 
 class CameraInput:
 	"""Class to contain the camera input code,
 	includes methods used by the main methods,
 	also setup of the input stream"""
 	
-	def __init__(self, device_name=""):
-		"""Setup the camera for input at the given device name"""
-		if device_name=="":
+	def __init__(self, device_name="", capture=None, calibration_file=""):
+		"""Setup the camera for input at the given device name
+		Alternatively an already open capture object can be given (anything with read() and release() like cv2.VideoCapture),
+		frames from a given capture are processed, frames from the camera device are not (the camera code is not in use)
+		If a calibration file is given, the calibration is loaded from it (if it exists) and saved to it when calibrating"""
+		
+		#whether the frames read from the capture are processed
+		self.capture_in_use = capture is not None
+		
+		if capture is not None:
+			self.capture = capture
+		elif device_name=="":
 			self.capture=None
 		else:
 			self.capture = cv2.VideoCapture(device_name)
 		
+		#the image that the visualisation of the output is drawn onto
+		self.visualisation = None
+		
+		#the number of plates along each side of the board that the camera can see
+		self.cells = 8
+		#the size in pixels of each plate once the board has been straightened by the calibration
+		self.cell_size = 32
+		
+		#how droplets are found: "circles" (hough circles) or "occupancy" (classifying each plate, needs calibrating)
+		self.detection_mode = "circles"
+		#how far (in grey levels) a plate's average brightness and variation have to be from the typical plate to count as a droplet
+		self.mean_threshold = 15.0
+		self.deviation_threshold = 10.0
+		
+		#the background frame grabber (None when frames are read straight from the capture)
+		self.grabber = None
+		#the longest time in seconds to wait for a new frame from the grabber
+		self.frame_timeout = 1.0
+		
+		#the board corners and perspective transform found by calibrate (None until calibrated)
+		self.calibration = None
+		self.calibration_file = calibration_file
+		
+		#every frame read from the capture is given to the recorder if there is one (see recorder.Recorder)
+		self.recorder = None
+		if calibration_file != "" and os.path.isfile(calibration_file):
+			self.load_calibration(calibration_file)
+		
 
 	def release_video_capture(self):
 		"""Release the video capture"""
 		
+		self.stop_grabber()
+		
 		if self.capture != None:
 			self.capture.release()
 	
 	
+	def start_grabber(self):
+		"""Start reading frames from the capture on a background thread
+		Frames are then taken from the grabber, so finding the droplets does not wait for the camera"""
+		
+		if self.capture is not None and self.grabber is None:
+			self.grabber = FrameGrabber(self.capture)
+			self.grabber.start()
+	
+	
+	def stop_grabber(self):
+		"""Stop the background frame grabber, frames are read straight from the capture again"""
+		
+		if self.grabber is not None:
+			self.grabber.stop()
+			self.grabber = None
+	
+	
 	def get_line_intersection(self, r1, theta1, r2, theta2):
 		"""Solves line intersection for lines represented in the form:
 		x cos(theta) + y sin(theta) = rho
@@ -69,30 +237,114 @@ class CameraInput:
 		return (x * np.cos(theta)) + (y * np.sin(theta))
 	
 	
-	def find_drop_positions(self, filename=""):
-		"""Find the droplet positions in the current image"""
+	def get_image(self, filename="", frame=None, after=0):
+		"""Get the image from the given file, the given frame or the capture
+		When the frame grabber is running the image is the newest frame read later than the time after (from time.time)
+		Returns None if there is no image to process"""
 		
-		if filename == "":
-			#get image from camera
-			ret, img = self.capture.read()
+		if frame is not None:
+			img = frame
+		elif filename == "":
+			#there is no camera to read from
+			if self.capture is None:
+				return None
+			
+			if self.grabber is not None:
+				#get the newest image from the grabber
+				img, timestamp = self.grabber.wait_for_frame(after, self.frame_timeout)
+			else:
+				#get image from camera
+				ret, img = self.capture.read()
+				timestamp = time.time()
 			
 			#camera code not in use!
-			return []
+			if not self.capture_in_use:
+				return None
+			
+			if self.recorder is not None and img is not None:
+				self.recorder.record_frame(img, timestamp)
 		else:
 			#read the image from the given file
 			img = cv2.imread(filename)
+		
+		return img
+	
+	
+	def find_drop_positions(self, filename="", frame=None, after=0):
+		"""Find the droplet positions in the current image
+		The image is either read from the given file, given as a frame or read from the capture
+		(when the frame grabber is running, the newest frame read later than the time after)
+		Once calibrated the board edges are not searched for again, unless the board has moved"""
+		
+		#the time taken by each stage is recorded when the telemetry is enabled
+		start = telemetry.start()
+		img = self.get_image(filename, frame, after)
+		telemetry.stop("camera.get_image", start)
+		if img is None:
+			return []
+		
+		start = telemetry.start()
+		gaus_blur = self.prepare_image(img)
+		telemetry.stop("camera.prepare", start)
+		
+		#create a blank image of the same size to draw the visualisation of the output
+		self.visualisation = np.zeros(gaus_blur.shape, np.uint8)
+		
+		#recalibrate if the board is no longer where it was at calibration (before either mode uses the calibration)
+		start = telemetry.start()
+		if self.calibration is not None and self.has_drifted(gaus_blur):
+			self.calibrate_image(gaus_blur)
+			telemetry.count("camera.recalibrations")
+		telemetry.stop("camera.drift_check", start)
+		
+		if self.detection_mode == "occupancy":
+			start = telemetry.start()
+			scores = self.get_plate_scores(img)
+			telemetry.stop("camera.plate_scores", start)
 			
+			start = telemetry.start()
+			drop_pos = self.get_occupied_positions(scores)
+			telemetry.stop("camera.positions", start)
+			return drop_pos
+		
+		start = telemetry.start()
+		droplets = self.find_circles(gaus_blur)
+		telemetry.stop("camera.find_circles", start)
+		
+		start = telemetry.start()
+		if self.calibration is not None:
+			drop_pos = self.get_calibrated_positions(droplets)
+		else:
+			board = self.find_board_edges(gaus_blur)
+			drop_pos = self.get_grid_positions(droplets, board)
+		telemetry.stop("camera.positions", start)
+		
+		##for visualising the output:
+		#cv2.imshow("Output", self.visualisation)
+		#cv2.waitKey(0)
+		
+		#return the list of droplet grid positions
+		return drop_pos
+	
+	
+	def prepare_image(self, img):
+		"""Blur the image and convert it to grayscale, ready for the edge and circle detection"""
+		
 		#apply a small amount of blur
 		img = cv2.medianBlur(img, 3)
 		#convert the image to grayscale
 		gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
 
-		#create a blank image of the same size to draw the visualisation of the output
-		s = gray.shape
-		blank = np.zeros(s, np.uint8)
-
 		#apply another larger blurring function
-		gaus_blur = cv2.GaussianBlur(gray,(5,5),0)
+		return cv2.GaussianBlur(gray,(5,5),0)
+	
+	
+	def find_board_edges(self, gaus_blur):
+		"""Find the edges of the board in the (blurred, grayscale) image
+		Returns a dictionary of the top, left, bottom and right lines, the top left corner point
+		and the lengths of the top and left edges"""
+		
+		blank = self.visualisation
 
 		#use the canny algorithm to find all the edges in the image
 		edges = cv2.Canny(gaus_blur, 150, 150)
@@ -139,11 +391,6 @@ class CameraInput:
 					right['value'] = x0
 					right['rho'] = rho
 					right['theta'] = theta    
-			
-
-		# http://docs.opencv.org/2.4/modules/imgproc/doc/feature_detection.html?highlight=houghcircles#cv2.HoughCircles
-		#use hough circle detection to find all the circles of a particular size (droplets) in the image
-		droplets = cv2.HoughCircles(gaus_blur, cv2.cv.CV_HOUGH_GRADIENT, 1, 15, param1=50, param2=30, minRadius=20, maxRadius=50)
 		
 		top_left_point = self.get_line_intersection(top['rho'], top['theta'], left['rho'], left['theta'])
 		cv2.circle(blank, top_left_point, 7, (255,255,255), 1)
@@ -157,7 +404,231 @@ class CameraInput:
 		# next calculate the length of the top line and the left line
 		top['length']  = self.get_euclidean_distance(top_left_point, top_right_point)
 		left['length'] = self.get_euclidean_distance(top_left_point, bottom_left_point)
-
+		
+		return {'top': top, 'left': left, 'bottom': bottom, 'right': right, 'top_left': top_left_point,
+				'top_right': top_right_point, 'bottom_left': bottom_left_point}
+	
+	
+	def calibrate(self, filename="", frame=None):
+		"""Find the board in the image and store its corners and the perspective transform that straightens it
+		Later images only need the droplets finding, the board is not searched for again unless it moves
+		Returns False if there was no image to calibrate from"""
+		
+		img = self.get_image(filename, frame)
+		if img is None:
+			return False
+		
+		gaus_blur = self.prepare_image(img)
+		self.visualisation = np.zeros(gaus_blur.shape, np.uint8)
+		self.calibrate_image(gaus_blur)
+		
+		return True
+	
+	
+	def calibrate_image(self, gaus_blur):
+		"""Calibrate from the (blurred, grayscale) image"""
+		
+		board = self.find_board_edges(gaus_blur)
+		
+		bottom_right_point = self.get_line_intersection(board['bottom']['rho'], board['bottom']['theta'], board['right']['rho'], board['right']['theta'])
+		corners = [board['top_left'], board['top_right'], bottom_right_point, board['bottom_left']]
+		
+		#the transform from the image to a straightened board with each plate cell_size pixels square
+		size = self.cells * self.cell_size
+		transform = cv2.getPerspectiveTransform(np.float32(corners), np.float32([(0, 0), (size, 0), (size, size), (0, size)]))
+		
+		self.calibration = {'corners': corners, 'transform': transform}
+		self.calibration['edge_contrast'] = self.get_edge_contrast(gaus_blur)
+		
+		if self.calibration_file != "":
+			self.save_calibration(self.calibration_file)
+	
+	
+	def get_edge_sample_points(self):
+		"""Get points just inside and just outside each edge of the calibrated board
+		Returns two arrays of (x, y) points: (inside points, outside points)"""
+		
+		corners = np.float32(self.calibration['corners'])
+		centre = corners.mean(axis=0)
+		
+		inside = []
+		outside = []
+		
+		for i in range(0, 4):
+			start = corners[i]
+			end = corners[(i + 1) % 4]
+			
+			for t in np.linspace(0.1, 0.9, 16):
+				point = start + t * (end - start)
+				
+				#move 4 pixels towards and away from the centre of the board
+				normal = centre - point
+				normal = 4 * normal / np.linalg.norm(normal)
+				
+				inside.append(point + normal)
+				outside.append(point - normal)
+		
+		return (np.int32(inside), np.int32(outside))
+	
+	
+	def get_edge_contrast(self, gaus_blur):
+		"""Get the difference in brightness between just inside and just outside each sample point along the board edges"""
+		
+		inside, outside = self.get_edge_sample_points()
+		
+		height, width = gaus_blur.shape
+		inside = np.clip(inside, 0, [width - 1, height - 1])
+		outside = np.clip(outside, 0, [width - 1, height - 1])
+		
+		return gaus_blur[inside[:, 1], inside[:, 0]].astype(np.float32) - gaus_blur[outside[:, 1], outside[:, 0]].astype(np.float32)
+	
+	
+	def has_drifted(self, gaus_blur, threshold=0.5):
+		"""Check whether the board has moved since calibration
+		The edges of the board are checked to still be where they were (the contrast across them has not dropped away)"""
+		
+		calibrated = self.calibration['edge_contrast']
+		current = self.get_edge_contrast(gaus_blur)
+		
+		#the sample points where the edge still has the same contrast (in the same direction) as when calibrated
+		matching = np.abs(current - calibrated) < np.abs(calibrated) * threshold + 10
+		
+		return matching.mean() < threshold
+	
+	
+	def get_calibrated_positions(self, droplets):
+		"""Calculate the grid position of each of the droplets using the calibrated perspective transform"""
+		
+		drop_pos = []
+		
+		#only decode the droplets if there are some that have been detected
+		if droplets != None:
+			
+			#straighten the droplet centres onto the board
+			centres = cv2.perspectiveTransform(np.float32(droplets[0][:, 0:2]).reshape(1, -1, 2), self.calibration['transform'])[0]
+			
+			for i in range(0, len(centres)):
+				# grid position = (distance / plate size)  (+1 to start from 1 not 0)
+				drop_pos.append((int(centres[i][0] / self.cell_size) + 1, int(centres[i][1] / self.cell_size) + 1))
+				
+				droplet = droplets[0][i]
+				cv2.circle(self.visualisation,(droplet[0],droplet[1]),droplet[2],(255,255,255),2)
+		
+		return drop_pos
+	
+	
+	def find_occupancy(self, filename="", frame=None):
+		"""Find which plates have a droplet on them by classifying every plate of the straightened board at once
+		Returns a boolean array of shape (cells, cells) indexed [y-1, x-1] (None if there is no image)
+		The board is calibrated from the image first if it has not been calibrated yet"""
+		
+		img = self.get_image(filename, frame)
+		if img is None:
+			return None
+		
+		return self.get_plate_scores(img) > 1
+	
+	
+	def get_plate_scores(self, img):
+		"""Score how likely each plate is to have a droplet on it, anything over 1 counts as a droplet
+		Each plate of the straightened board is compared with the typical plate (the median over the whole board),
+		a droplet makes the plate darker or lighter on average or adds more variation (its edges and reflections)"""
+		
+		gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+		
+		if self.calibration is None:
+			self.visualisation = np.zeros(gray.shape, np.uint8)
+			self.calibrate_image(self.prepare_image(img))
+		
+		size = self.cells * self.cell_size
+		board = cv2.warpPerspective(gray, self.calibration['transform'], (size, size))
+		
+		#split the board into plates, leaving out a margin around each plate so the gaps between plates are not included
+		margin = self.cell_size // 8
+		plates = board.reshape(self.cells, self.cell_size, self.cells, self.cell_size)[:, margin:-margin, :, margin:-margin].astype(np.float32)
+		
+		means = plates.mean(axis=(1, 3))
+		deviations = plates.std(axis=(1, 3))
+		
+		#take away the gradual change in lighting across the board (a flat plane fitted to the plate brightness and variation)
+		means = self.remove_trend(means, self.mean_threshold)
+		deviations = self.remove_trend(deviations, self.deviation_threshold)
+		
+		return np.maximum(np.abs(means - np.median(means)) / self.mean_threshold, (deviations - np.median(deviations)) / self.deviation_threshold)
+	
+	
+	def remove_trend(self, values, threshold):
+		"""Take away a flat plane fitted to the (cells, cells) array of plate values
+		The plane is fitted again without the plates that are more than threshold from it so that the droplets do not tilt it"""
+		
+		ys, xs = np.mgrid[0:self.cells, 0:self.cells]
+		a = np.column_stack([np.ones(self.cells * self.cells), xs.ravel(), ys.ravel()])
+		fit = np.ones(self.cells * self.cells, bool)
+		for i in range(0, 2):
+			plane = a.dot(np.linalg.lstsq(a[fit], values.ravel()[fit], rcond=-1)[0])
+			residuals = values.ravel() - plane
+			fit = np.abs(residuals - np.median(residuals)) < threshold
+		
+		return residuals.reshape(self.cells, self.cells)
+	
+	
+	def get_occupied_positions(self, scores):
+		"""Get the grid positions of the droplets from the plate scores
+		A droplet can overlap onto the plates around it, so a droplet is only placed on the plates that score
+		the most (along with the plates either side of them) out of all the plates around them,
+		as long as that plate or one either side of it counts as having a droplet"""
+		
+		#the scores of each plate and the plates either side of it, in a stack of 5 arrays
+		padded = np.pad(scores, 1, 'constant')
+		plus = np.array([padded[1:-1, 1:-1], padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]])
+		
+		#the plate's own score counts (just over) twice, so that a plate between two droplets does not win over the droplets
+		totals = plus.sum(axis=0) + scores * 1.01
+		occupied = plus.max(axis=0) > 1
+		
+		#find the highest total out of each plate and the 8 plates around it
+		padded = np.pad(totals, 1, 'constant', constant_values=-np.inf)
+		neighbourhood = np.max([padded[dy:dy + self.cells, dx:dx + self.cells] for dy in range(0, 3) for dx in range(0, 3)], axis=0)
+		
+		ys, xs = np.nonzero(occupied & (totals >= neighbourhood))
+		
+		return [(int(x) + 1, int(y) + 1) for x, y in zip(xs, ys)]
+	
+	
+	def save_calibration(self, filename):
+		"""Save the calibration to the given (JSON) file"""
+		
+		json.dump({'corners': [list(point) for point in self.calibration['corners']],
+				'transform': self.calibration['transform'].tolist(),
+				'edge_contrast': self.calibration['edge_contrast'].tolist()}, open(filename, "w"))
+	
+	
+	def load_calibration(self, filename):
+		"""Load the calibration from the given (JSON) file"""
+		
+		data = json.load(open(filename))
+		
+		self.calibration = {'corners': [tuple(point) for point in data['corners']],
+				'transform': np.array(data['transform']),
+				'edge_contrast': np.float32(data['edge_contrast'])}
+	
+	
+	def find_circles(self, gaus_blur):
+		"""Find the droplets in the (blurred, grayscale) image
+		Returns the circles found by cv2.HoughCircles (None if there are none)"""
+		
+		# http://docs.opencv.org/2.4/modules/imgproc/doc/feature_detection.html?highlight=houghcircles#cv2.HoughCircles
+		#use hough circle detection to find all the circles of a particular size (droplets) in the image
+		return cv2.HoughCircles(gaus_blur, cv2.cv.CV_HOUGH_GRADIENT, 1, 15, param1=50, param2=30, minRadius=20, maxRadius=50)
+	
+	
+	def get_grid_positions(self, droplets, board):
+		"""Calculate the grid position of each of the droplets from the edges of the board"""
+		
+		top = board['top']
+		left = board['left']
+		top_left_point = board['top_left']
+		
 		drop_pos = []
 		
 		#only decode the droplets if there are some that have been detected
@@ -177,23 +648,159 @@ class CameraInput:
 				distx = self.get_euclidean_distance(top_left_point, intersectionx)
 				disty = self.get_euclidean_distance(top_left_point, intersectiony)
 	
-				# x 'grid position' = (distance / top length) * 8  (+1 to start from 1 not 0)
-				xgridpos = (8 * distx / top['length']) + 1
-				ygridpos = (8 * disty / left['length']) + 1
+				# x 'grid position' = (distance / top length) * cells  (+1 to start from 1 not 0)
+				xgridpos = (self.cells * distx / top['length']) + 1
+				ygridpos = (self.cells * disty / left['length']) + 1
 	
 				drop_pos.append((int(xgridpos),int(ygridpos)))
 			
-				cv2.circle(blank,(droplet[0],droplet[1]),droplet[2],(255,255,255),2)
-
-		##for visualising the output:
-		#cv2.imshow("Output", blank)
-		#cv2.waitKey(0)
+				cv2.circle(self.visualisation,(droplet[0],droplet[1]),droplet[2],(255,255,255),2)
 		
-		#return the list of droplet grid positions
 		return drop_pos
 
 
+#the CameraInput object of each batch worker process
+batch_camera = None
+#whether the batch worker calibrates each image from a directory on its own (they are separate photos, not a fixed camera)
+batch_recalibrate = False
+
+#the file extensions read as images when a directory is given to the batch mode
+image_extensions = [".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"]
+
+def get_batch_frames(source):
+	"""Get the frames to process from a directory of images (in name order) or a video file
+	Yields (frame number, name, filename, image) for each frame, images in a directory are given by filename
+	(so that each worker reads its own), video frames are given as the image (one at a time, the video is never all in memory)"""
+	
+	if os.path.isdir(source):
+		names = sorted(name for name in os.listdir(source) if os.path.splitext(name)[1].lower() in image_extensions)
+		
+		for number in range(0, len(names)):
+			yield number, names[number], os.path.join(source, names[number]), None
+	else:
+		video = cv2.VideoCapture(source)
+		if not video.isOpened():
+			raise IOError("Could not open %s as a video or a directory of images" % (source,))
+		
+		number = 0
+		while True:
+			ret, img = video.read()
+			if not ret:
+				break
+			
+			yield number, str(number), "", img
+			number += 1
+		
+		video.release()
+
+
+def init_batch_worker(detection_mode, calibration_file):
+	"""Setup the CameraInput object of a batch worker process
+	The calibration is loaded from the calibration file (if given) but never saved, as the workers would all write to it,
+	without a calibration file each image in a directory is calibrated on its own"""
+	
+	global batch_camera, batch_recalibrate
+	
+	batch_camera = CameraInput(calibration_file=calibration_file)
+	batch_camera.calibration_file = ""
+	batch_camera.detection_mode = detection_mode
+	batch_recalibrate = calibration_file == ""
+
+
+def find_batch_positions(frame_details):
+	"""Find the droplet positions in one frame in a batch worker process
+	Returns the frame number, name, droplet positions and the time taken in seconds"""
+	
+	number, name, filename, img = frame_details
+	
+	start = time.time()
+	if batch_recalibrate and filename != "":
+		batch_camera.calibration = None
+	positions = batch_camera.find_drop_positions(filename, img)
+	
+	return number, name, positions, time.time() - start
+
+
+def run_batch(source, output, output_format="csv", processes=None, detection_mode="circles", calibration_file=""):
+	"""Find the droplet positions in every frame of the directory of images or video file, spread over a pool of processes
+	The positions and timing of each frame are written to the output file object in frame order, as CSV or JSON lines ("jsonl")
+	Only a few frames per process are held at once, so the memory used does not grow with the length of the video
+	Returns the number of frames processed"""
+	
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	
+	if output_format == "csv":
+		writer = csv.writer(output)
+		writer.writerow(["frame", "name", "seconds", "count", "positions"])
+	elif output_format != "jsonl":
+		raise ValueError("Unknown output format %s (csv or jsonl)" % (output_format,))
+	
+	pool = multiprocessing.Pool(processes, init_batch_worker, (detection_mode, calibration_file))
+	
+	#the frames that have been sent to the pool, in frame order
+	pending = collections.deque()
+	count = 0
+	
+	frames = get_batch_frames(source)
+	finished = False
+	
+	while not finished or len(pending) > 0:
+		#keep every process busy with a couple of frames queued up
+		while not finished and len(pending) < processes * 2:
+			try:
+				pending.append(pool.apply_async(find_batch_positions, (next(frames),)))
+			except StopIteration:
+				finished = True
+		
+		if len(pending) == 0:
+			break
+		
+		#write out the oldest frame once it is done, so the output stays in frame order
+		number, name, positions, seconds = pending.popleft().get()
+		
+		if output_format == "csv":
+			writer.writerow([number, name, "%.6f" % (seconds,), len(positions), " ".join("%i,%i" % tuple(position) for position in positions)])
+		else:
+			output.write(json.dumps({'frame': number, 'name': name, 'seconds': seconds, 'positions': [list(position) for position in positions]}) + "\n")
+		
+		count += 1
+	
+	pool.close()
+	pool.join()
+	
+	return count
+
+
 if __name__=="__main__":
+	
+	if len(sys.argv) > 1:
+		#batch mode: find the droplets in every frame of a directory of images or a video file
+		import argparse
+		
+		parser = argparse.ArgumentParser(description="Find the droplet positions in every frame of a directory of images or a video file")
+		parser.add_argument("source", help="directory of images or video file")
+		parser.add_argument("--output", help="file to write the positions to (standard output if not given)")
+		parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="output format")
+		parser.add_argument("--processes", type=int, help="number of worker processes (the number of cores if not given)")
+		parser.add_argument("--mode", choices=["circles", "occupancy"], default="circles", help="droplet detection mode")
+		parser.add_argument("--calibration", default="", help="calibration file to load")
+		args = parser.parse_args()
+		
+		output = sys.stdout
+		if args.output:
+			output = open(args.output, "w")
+		
+		start = time.time()
+		count = run_batch(args.source, output, args.format, args.processes, args.mode, args.calibration)
+		taken = time.time() - start
+		
+		if args.output:
+			output.close()
+		
+		sys.stderr.write("Processed %i frames in %.2f s (%.1f frames per second)\n" % (count, taken, count / max(taken, 1e-9)))
+		sys.exit(0)
+	
 	#test suite
 	
 	camIn = CameraInput()
@@ -208,6 +815,17 @@ if __name__=="__main__":
 			print "SUCCESS: Program found the position of the droplet"
 		else:
 			print "FAILED: Program did not find the position of the droplet in",images[i][0]
+	
+	#the occupancy mode must find the droplet and nothing else (each image is calibrated on its own)
+	for i in range(0,4):
+		camIn = CameraInput()
+		camIn.detection_mode = "occupancy"
+		drop_positions = camIn.find_drop_positions(images[i][0])
+		
+		if drop_positions == [images[i][1]]:
+			print "SUCCESS: Occupancy mode found only the position of the droplet"
+		else:
+			print "FAILED: Occupancy mode found",drop_positions,"instead of",[images[i][1]],"in",images[i][0]
 
 	
 	
@@ -0,0 +1,347 @@
+"""This module drives several devices (an arduino and a camera each) from one program
+Each device is run by its own worker process with its own Grid, protocols are queued and taken by whichever device is free
+The workers share nothing but the queues, so the number of protocols run in a given time grows with the number of devices"""
+
+import multiprocessing
+import Queue
+import threading
+import time
+
+import arduinoComms
+import cameraInput
+import droplet_program
+import protocolCache
+
+class ProtocolJob:
+	"""A protocol that has been queued on the pool
+	The result is a dictionary of the device it ran on and how long it took"""
+
+	def __init__(self, protocol):
+		"""Initialise object state
+		protocol is a user input filename or a checked instruction set"""
+
+		self.protocol = protocol
+		self.device = None
+		self.run_time = None
+		self.error = None
+		self.callbacks = []
+		self.event = threading.Event()
+
+	def done(self):
+		"""Check whether the protocol has been run (or has failed)"""
+
+		return self.event.is_set()
+
+	def result(self, timeout=None):
+		"""Wait for the protocol to be run and return the result
+		Raises the error if the protocol could not be run"""
+
+		if not self.event.wait(timeout):
+			raise IOError("Timed out waiting for the protocol to be run")
+
+		if self.error is not None:
+			raise self.error
+
+		return {"device": self.device, "run_time": self.run_time}
+
+	def add_done_callback(self, callback):
+		"""Call the callback with this job once the protocol has been run (or has failed)"""
+
+		if self.done():
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+
+	def finish(self, error=None):
+		"""Set the job as done, wake up anything waiting for it and run the callbacks"""
+
+		self.error = error
+		self.event.set()
+
+		for callback in self.callbacks:
+			callback(self)
+
+
+def run_device(name, make_grid, jobs, results, current):
+	"""Run the queued protocols on one device until a stop marker is taken (the body of each worker process)
+	jobs holds (job id, protocol) pairs, ("done", job id, device name, run time, error) is put on results as each is finished
+	and a device that cannot be opened puts ("closed", None, device name, None, error) and stops
+	current (a shared multiprocessing.Value) is set to the id of each job as it is taken, so the job is known if the worker dies"""
+
+	try:
+		grid = make_grid()
+	except Exception as e:
+		print "Device %s could not be opened: %s" % (name, e)
+		grid = None
+		open_error = IOError("Device %s could not be opened: %s" % (name, e))
+
+	while True:
+		job = jobs.get()
+		if job is None:
+			break
+
+		if grid is None:
+			#leave the job for a working device, this device takes no more jobs
+			jobs.put(job)
+			results.put(("closed", None, name, None, open_error))
+			break
+
+		job_id, protocol = job
+		#set straight away, unlike results which is only sent by a background thread (lost if the worker dies)
+		current.value = job_id
+
+		try:
+			if isinstance(protocol, basestring):
+				protocolCache.load_protocol(grid.ui, protocol)
+				instruction_set = grid.ui.instruction_set
+			else:
+				instruction_set = protocol
+
+			grid.reset()
+
+			start = time.time()
+			completed = grid.run_program(instruction_set)
+			run_time = time.time() - start
+
+			#a protocol that stopped early (see Grid.run_program) has failed, even though nothing was raised
+			error = None
+			if not completed:
+				error = IOError("The instruction set could not be completed")
+			results.put(("done", job_id, name, run_time, error))
+		except Exception as e:
+			results.put(("done", job_id, name, None, IOError("%s: %s" % (e.__class__.__name__, e))))
+
+
+class DevicePool:
+	"""Runs queued protocols on whichever device is free
+	Each device has its own worker process (so the image processing of one device never holds up another)
+	A worker that stops while running a protocol fails that protocol, and once no worker is left every queued protocol fails"""
+
+	def __init__(self, check_interval=0.5):
+		"""Initialise an empty pool, devices are added with add_device or add_board
+		The workers are checked to still be running every check_interval seconds"""
+
+		self.jobs = multiprocessing.Queue()
+		self.results = multiprocessing.Queue()
+
+		#device name -> worker process
+		self.workers = {}
+		#job id -> ProtocolJob for the jobs that have not finished
+		self.pending = {}
+		self.next_id = 0
+		self.lock = threading.Lock()
+
+		self.check_interval = check_interval
+		#device name -> shared value of the id of the last job the worker took (-1 before its first job)
+		self.current_jobs = {}
+		#device name -> the reason it stopped, for the workers that are no longer running
+		self.stopped = {}
+
+		#the results are passed back to the jobs by a background thread
+		self.collector = threading.Thread(target=self.collect_results)
+		self.collector.daemon = True
+		self.collector.start()
+
+	def add_device(self, name, make_grid):
+		"""Add a device and start its worker
+		make_grid is a function that returns the Grid for the device, it is called in the worker process
+		so that every device opens its own serial port and camera"""
+
+		with self.lock:
+			if name in self.workers:
+				raise ValueError("There is already a device called %s" % (name,))
+
+			current = multiprocessing.Value("l", -1)
+			worker = multiprocessing.Process(target=run_device, args=(name, make_grid, self.jobs, self.results, current))
+			worker.daemon = True
+			self.workers[name] = worker
+			self.current_jobs[name] = current
+
+		worker.start()
+
+	def add_board(self, port_name, camera_name):
+		"""Add an arduino and camera pair, named after the serial port"""
+
+		self.add_device(port_name, lambda: droplet_program.Grid(arduinoComms.ArduinoCommunication(port_name), cameraInput.CameraInput(camera_name)))
+
+	def submit(self, protocol):
+		"""Queue a protocol (a user input filename or a checked instruction set) to run on the next free device
+		Returns a ProtocolJob for the result"""
+
+		job = ProtocolJob(protocol)
+
+		with self.lock:
+			job_id = self.next_id
+			self.next_id += 1
+			self.pending[job_id] = job
+
+		self.jobs.put((job_id, protocol))
+
+		return job
+
+	def map(self, protocols, timeout=None):
+		"""Run all the protocols and wait for them to finish, returns the list of jobs in the same order
+		Raises an IOError if they have not all finished within timeout seconds (None waits for as long as they take)"""
+
+		jobs = [self.submit(protocol) for protocol in protocols]
+
+		end = None
+		if timeout is not None:
+			end = time.time() + timeout
+
+		for job in jobs:
+			if end is None:
+				job.event.wait()
+			elif not job.event.wait(max(0.0, end - time.time())):
+				raise IOError("Timed out waiting for the protocols to be run")
+
+		return jobs
+
+	def collect_results(self):
+		"""Finish each job as its result comes back from a worker, checking the workers are still running in between"""
+
+		while True:
+			try:
+				result = self.results.get(timeout=self.check_interval)
+			except Queue.Empty:
+				self.check_workers()
+				continue
+
+			if result is None:
+				break
+
+			self.handle_result(result)
+
+	def handle_result(self, result):
+		"""Finish the job when its result comes back, or keep the reason a device could not be opened"""
+
+		event, job_id, name, run_time, error = result
+
+		if event == "closed":
+			with self.lock:
+				self.stopped[name] = error
+			return
+
+		with self.lock:
+			#the job has already been failed if it was given up on (e.g. there was no device left)
+			job = self.pending.pop(job_id, None)
+
+		if job is not None:
+			job.device = name
+			job.run_time = run_time
+			job.finish(error)
+
+	def check_workers(self):
+		"""Fail the job of any worker that has stopped while running it, and every job if no worker is left"""
+
+		with self.lock:
+			workers = self.workers.items()
+
+		#a worker puts everything on results before it stops, so once it has stopped take what it left first
+		dead = [name for name, worker in workers if not worker.is_alive()]
+		while True:
+			try:
+				result = self.results.get_nowait()
+			except Queue.Empty:
+				break
+
+			if result is None:
+				#leave the marker for collect_results to stop on
+				self.results.put(None)
+				break
+
+			self.handle_result(result)
+
+		failed = []
+		with self.lock:
+			for name in dead:
+				if name in self.stopped:
+					continue
+
+				self.stopped[name] = IOError("Device %s stopped (exit code %s)" % (name, self.workers[name].exitcode))
+
+				#the last job it took is still pending if its result never came back
+				job_id = self.current_jobs[name].value
+				if job_id in self.pending:
+					failed.append((self.pending.pop(job_id), name, self.stopped[name]))
+
+			#the queued jobs can never be run once every device has stopped
+			if len(workers) > 0 and len(self.stopped) == len(workers):
+				reasons = "; ".join(str(self.stopped[name]) for name, worker in workers)
+				for job_id in sorted(self.pending):
+					failed.append((self.pending[job_id], None, IOError("There is no device left to run the protocol (%s)" % (reasons,))))
+				self.pending = {}
+
+		for job, name, error in failed:
+			job.device = name
+			job.finish(error)
+
+	def stop(self):
+		"""Stop every worker once the protocols already queued have been run"""
+
+		with self.lock:
+			workers = self.workers.values()
+
+		#one stop marker for each worker, after all the jobs
+		for worker in workers:
+			self.jobs.put(None)
+
+		for worker in workers:
+			worker.join()
+
+		self.results.put(None)
+		self.collector.join()
+
+
+if __name__=="__main__":
+	#run user input files on several devices at once
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Run user input files on whichever device is free")
+	parser.add_argument("files", nargs="+", help="the user input files to run")
+	parser.add_argument("--board", nargs=2, action="append", default=[], metavar=("PORT", "CAMERA"), help="an arduino port and camera (can be given more than once)")
+	parser.add_argument("--virtual", type=int, default=0, metavar="N", help="add N virtual devices (see virtualDevice)")
+	parser.add_argument("--timeout", type=float, metavar="SECONDS", help="give up if the files have not all been run in this time")
+	args = parser.parse_args()
+
+	pool = DevicePool()
+
+	for port_name, camera_name in args.board:
+		pool.add_board(port_name, camera_name)
+
+	if args.virtual > 0:
+		import virtualDevice
+
+		def make_virtual_grid():
+			simulator = virtualDevice.DropletSimulator()
+			arduino = virtualDevice.VirtualArduino(simulator)
+
+			grid = droplet_program.Grid(arduinoComms.ArduinoCommunication(arduino.port_name), cameraInput.CameraInput(capture=virtualDevice.VirtualCamera(simulator)))
+			grid.clock = virtualDevice.ScaledClock(100)
+			#the droplets are put onto the simulated grid as the program adds them
+			grid.droplet_added = lambda droplet: simulator.add_droplet(droplet.position["x"], droplet.position["y"])
+			return grid
+
+		for number in range(0, args.virtual):
+			pool.add_device("virtual%i" % (number,), make_virtual_grid)
+
+	if pool.workers == {}:
+		parser.error("no devices were given, use --board or --virtual")
+
+	start = time.time()
+	try:
+		jobs = pool.map(args.files, args.timeout)
+	except IOError as e:
+		parser.exit(1, "%s\n" % (e,))
+	run_time = time.time() - start
+
+	for job in jobs:
+		try:
+			result = job.result()
+			print "%s: ran on %s in %.2f s" % (job.protocol, result["device"], result["run_time"])
+		except Exception as e:
+			print "%s: failed on %s (%s)" % (job.protocol, job.device, e)
+
+	print "%i protocols in %.2f s" % (len(jobs), run_time)
+
+	pool.stop()
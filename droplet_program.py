@@ -4,13 +4,20 @@ The computer vision section will be used to track if a droplet has moved success
 
 #import the my custom modules
 import arduinoComms
+import pathPlanner
+import scheduler
 from userInput import Instructions
 import userInput
 import cameraInput
+import protocolCache
+import telemetry
 
 #import the time module to use the time.sleep function
 import time
 
+import collections
+import numpy as np
+
 #import the sys module so that we can take command line options
 import sys
 
@@ -24,23 +31,28 @@ class Droplet:
 		self.name = ""
 		self.path = []
 	
-	def update_along_path(self,arduino_comm):
-		"""Update the droplet along the its path"""
+	def update_along_path(self, arduino_comm=None):
+		"""Update the droplet along the its path
+		If no arduino_comm is given only the position is updated (the plates are set later as a whole frame)"""
 		
 		#only move the droplet if the path is not empty
 		if self.path != []:
 			currentdir = self.path.pop()
-			self.move(currentdir, arduino_comm)
+			
+			#a direction of 0,0 means the droplet waits where it is for this step
+			if currentdir["xDir"] != 0 or currentdir["yDir"] != 0:
+				self.move(currentdir, arduino_comm)
 			
 			# return whether the path is complete yet
 			return self.path != []
 		else:
 			return False
 	
-	def move(self, direction, arduino_comm):
+	def move(self, direction, arduino_comm=None):
 		"""Move the droplet in the direction given
 		Direction is in the form: {xDir: -1, yDir: 0} -- that would move left one block
-		Diagonals are not allowed"""
+		Diagonals are not allowed
+		If no arduino_comm is given only the position is updated"""
 		
 		#validate the direction
 		if direction["xDir"] != 0 and direction["yDir"] != 0:
@@ -48,21 +60,35 @@ class Droplet:
 			raise ValueError("Droplets cannot move in diagonals")
 		
 		#clear current position
-		arduino_comm.clear_plate(self.position["x"], self.position["y"])
+		if arduino_comm is not None:
+			arduino_comm.stage_plate(self.position["x"], self.position["y"], False)
 		
 		#set new position (to attract the droplet to)
 		self.position["x"] += direction["xDir"]
 		self.position["y"] += direction["yDir"]
-		arduino_comm.set_plate(self.position["x"], self.position["y"])
+		if arduino_comm is not None:
+			arduino_comm.stage_plate(self.position["x"], self.position["y"])
+			#only the plates that changed are sent
+			arduino_comm.commit()
+		
+	def set_path(self, directions):
+		"""Set the path of the droplet to the given list of directions (in the order they are to be taken)
+		The path is stored in reverse so that the next direction can be popped from the end"""
+		
+		self.path = list(reversed(directions))
 		
 	def add_path(self, position_aim):
 		"""Create a path that moves the droplet towards the position_aim plate
 		The path consists of a list of directions that describe the step by step path of the droplet
 		Directions can only be horizontal or vertial (not both: diagonal)
-		A direction is a dictionary with xDir and yDir elements, each of which is an integer between -1 and 1"""
+		A direction is a dictionary with xDir and yDir elements, each of which is an integer between -1 and 1
+		Other droplets are not avoided (see pathPlanner.Router.find_route)"""
 		
 		path_position = {'x': self.position["x"], 'y': self.position["y"]}
 		
+		#the path is built in the order it is taken and added to the end of any path the droplet already has
+		directions = []
+		
 		while path_position != position_aim:
 		
 			diffx = position_aim["x"] - path_position["x"]
@@ -79,7 +105,7 @@ class Droplet:
 					direction = {'xDir': 0 , 'yDir': 0}
 					
 				#add the direction to the path
-				self.path.append(direction)
+				directions.append(direction)
 				
 				#update the path_position
 				path_position["x"] += direction["xDir"]
@@ -94,34 +120,232 @@ class Droplet:
 					direction = {'xDir': 0, 'yDir': 0}
 				
 				#add the direction to the path
-				self.path.append(direction)
+				directions.append(direction)
 				
 				#update the path_position
 				path_position["y"] += direction["yDir"]
+		
+		self.set_path(list(reversed(self.path)) + directions)
+
+
+class DropletRegistry:
+	"""Holds the droplets on the grid keyed by their id, along with a count of the droplets on each plate
+	so that finding a droplet and checking whether a plate (or the plates around it) has a droplet on it do not search every droplet"""
+	
+	def __init__(self, dimensions):
+		"""Initialise the registry with no droplets"""
+		
+		self.dimensions = dimensions
+		self.droplets = collections.OrderedDict()
+		#the position each droplet is counted at in the occupancy grid (droplet id -> (x, y))
+		self.positions = {}
+		#the number of droplets on each plate indexed [y, x], with an empty border so the plates around any plate can be looked at directly
+		self.occupancy = np.zeros((dimensions["maxY"] + 2, dimensions["maxX"] + 2), np.int32)
+	
+	def __len__(self):
+		"""The number of droplets"""
+		
+		return len(self.droplets)
+	
+	def __iter__(self):
+		"""Iterate over the droplets (in the order they were added)"""
+		
+		return iter(self.droplets.values())
+	
+	def __contains__(self, droplet_id):
+		"""Check whether there is a droplet with the given id"""
+		
+		return droplet_id in self.droplets
+	
+	def in_grid(self, x, y):
+		"""Check whether the position is on the grid"""
+		
+		return 1 <= x <= self.dimensions["maxX"] and 1 <= y <= self.dimensions["maxY"]
+	
+	def add(self, droplet):
+		"""Add the droplet, raises a ValueError if there is already a droplet with the same id"""
+		
+		if droplet.id in self.droplets:
+			raise ValueError("Droplet %s is already on the grid" % (droplet.id,))
+		
+		self.droplets[droplet.id] = droplet
+		self.place(droplet)
+	
+	def remove(self, droplet_id):
+		"""Remove the droplet with the given id, returning it (None if there is no such droplet)"""
+		
+		droplet = self.droplets.pop(droplet_id, None)
+		
+		if droplet is not None:
+			self.unplace(droplet_id)
+		
+		return droplet
+	
+	def get(self, droplet_id):
+		"""Get the droplet that has the given id value (None if there is no such droplet)"""
+		
+		return self.droplets.get(droplet_id)
+	
+	def update(self, droplet):
+		"""Update the occupancy grid after the droplet has moved"""
+		
+		if self.positions.get(droplet.id) != (droplet.position["x"], droplet.position["y"]):
+			self.unplace(droplet.id)
+			self.place(droplet)
+	
+	def place(self, droplet):
+		"""Count the droplet on the plate at its position (droplets off the grid are not counted)"""
+		
+		x = droplet.position["x"]
+		y = droplet.position["y"]
+		self.positions[droplet.id] = (x, y)
+		
+		if self.in_grid(x, y):
+			self.occupancy[y, x] += 1
+	
+	def unplace(self, droplet_id):
+		"""Stop counting the droplet on the plate it was last counted at"""
+		
+		x, y = self.positions.pop(droplet_id)
+		
+		if self.in_grid(x, y):
+			self.occupancy[y, x] -= 1
+	
+	def get_positions(self):
+		"""Return the positions of all the droplets as a list of (x, y) tuples"""
+		
+		return [(droplet.position["x"], droplet.position["y"]) for droplet in self.droplets.values()]
+	
+	def is_occupied(self, x, y):
+		"""Check whether there is a droplet on the plate at x, y"""
+		
+		return self.in_grid(x, y) and self.occupancy[y, x] > 0
+	
+	def is_near(self, x, y, ignore=[]):
+		"""Check whether there is a droplet on the plate at x, y or on any of the plates either side of it
+		(close enough to merge with a droplet at x, y), not counting the droplets with ids in the ignore list"""
+		
+		if not self.in_grid(x, y):
+			return False
+		
+		count = self.occupancy[y, x] + self.occupancy[y - 1, x] + self.occupancy[y + 1, x] + self.occupancy[y, x - 1] + self.occupancy[y, x + 1]
+		
+		for droplet_id in ignore:
+			position = self.positions.get(droplet_id)
+			if position is not None and self.in_grid(position[0], position[1]) and abs(position[0] - x) + abs(position[1] - y) <= 1:
+				count -= 1
+		
+		return count > 0
 
 
 class Grid:
 	"""Keeps track of the grid and each droplet on it"""
 	
-	def __init__(self):
-		"""Initialise object state"""
+	def __init__(self, arduino_comm=None, cam_input=None):
+		"""Initialise object state
+		The arduino connection and camera input can be given (e.g. a virtual device),
+		otherwise the default devices are opened when they are first used (see __getattr__)
+		The grid is the size of the given arduino connection, otherwise 8 x 9 until the default arduino is opened"""
+		
+		#the devices that are opened if none are given
+		self.port_name = "/dev/ttyACM0"
+		self.camera_name = "/dev/video1"
 		
 		self.dimensions = {'maxX': 8, 'maxY': 9}
-		self.droplet_list = []
-		self.arduino_comm = arduinoComms.ArduinoCommunication("/dev/ttyACM0")
-		self.ui = userInput.UserInput()
-		self.camInput = cameraInput.CameraInput("/dev/video1")
+		
+		if arduino_comm is not None:
+			self.arduino_comm = arduino_comm
+			self.dimensions = {'maxX': arduino_comm.maxX, 'maxY': arduino_comm.maxY}
+		if cam_input is not None:
+			self.camInput = cam_input
+		
+		#the droplets on the grid (droplet id -> droplet)
+		self.droplets = DropletRegistry(self.dimensions)
 		self.waiting_time = 1
+		#wait only until the camera sees the droplets arrive rather than the whole waiting_time (needs the camera in use),
+		#the plates are set again up to step_retries times if the droplets have not arrived within the waiting_time
+		self.closed_loop = False
+		self.step_retries = 2
+		#the most unfinished instructions held at once when the instructions are read as the program runs
+		self.lookahead = 1000
+		#send the whole grid in one frame message each step rather than a message per plate
+		self.use_frames = True
+		self.router = pathPlanner.Router(self.dimensions)
+		#the clock used for all the waiting (anything with time() and sleep() functions)
+		self.clock = time
+		#called with (instructions completed, instructions read so far) whenever an instruction completes (None for no progress reports)
+		self.progress = None
+		#called with each droplet that a NEW instruction adds to the grid (None for nothing)
+		self.droplet_added = None
+		self.in_progress = {}
+		#the NEW instructions held back until no droplet is near their plate
+		self.waiting_new = []
+		
+	
+	def __getattr__(self, name):
+		"""Open the arduino connection (arduino_comm), the camera (camInput) and the user input (ui) the first time they are used,
+		so that nothing is opened that a run does not need
+		The size of the grid is read from the arduino, unless droplets have already been placed on the grid"""
+		
+		if name == "arduino_comm":
+			if len(self.droplets) == 0:
+				value = arduinoComms.ArduinoCommunication(self.port_name, None)
+				self.set_dimensions(value.maxX, value.maxY)
+			else:
+				value = arduinoComms.ArduinoCommunication(self.port_name, [self.dimensions["maxX"], self.dimensions["maxY"]])
+		elif name == "camInput":
+			value = cameraInput.CameraInput(self.camera_name)
+		elif name == "ui":
+			value = userInput.UserInput()
+		else:
+			raise AttributeError(name)
+		
+		setattr(self, name, value)
+		return value
+		
+	
+	def camera_in_use(self):
+		"""Check whether the droplets are being found from camera frames (without opening the camera if it has not been used)"""
+		
+		return "camInput" in self.__dict__ and self.camInput.capture_in_use
+		
+	
+	def set_dimensions(self, maxX, maxY):
+		"""Change the size of the grid (only while there are no droplets on it)"""
+		
+		if len(self.droplets) > 0:
+			raise ValueError("The size of the grid cannot be changed while there are droplets on it")
+		
+		self.dimensions = {'maxX': maxX, 'maxY': maxY}
+		self.droplets = DropletRegistry(self.dimensions)
+		self.router = pathPlanner.Router(self.dimensions)
+		
+	
+	def open_devices(self):
+		"""Open the arduino connection now rather than when it is first used (e.g. so that the first run does not wait for it)
+		and take the size of the grid from it"""
+		
+		return self.arduino_comm
+		
+	
+	def reset(self):
+		"""Forget every droplet and turn all the plates off, ready for a new chip"""
+		
+		self.droplets = DropletRegistry(self.dimensions)
+		self.in_progress = {}
+		self.waiting_new = []
+		self.arduino_comm.clear_all_plates()
 		
 	
 	def load_program(self, filename):
-		"""Load the ui program"""
+		"""Load the ui program
+		The compiled version of the file is used if it is up to date (see protocolCache), otherwise the file is parsed and compiled"""
 		
 		runprogram = True
 		
 		# try to load the input file, catching the exception of any issues in the instruction set
 		try:
-			self.ui.load_input_file(filename)
+			protocolCache.load_protocol(self.ui, filename)
 		except ValueError as e:
 		
 			#print the issues that have risen from loading the instruction set
@@ -136,214 +360,565 @@ class Grid:
 		
 		return runprogram
 		
-	def run_program(self):
+	def run_program(self, instructions=None):
 		"""Run the program from the user input
 		The program is stored in the self.ui object as a set of sequential instructions
-		The system does not move on to the next instruction until the current instruction is complete"""
+		The instructions are compiled into a dependency graph so that any instructions that work on
+		different droplets are run at the same time, an instruction only starts once the earlier
+		instructions on the same droplets are complete
+		Any iterable of instructions can be given instead (e.g. self.ui.read_input_file(filename)),
+		they are taken as they are needed, holding no more than lookahead unfinished instructions at once
+		Returns whether every instruction was completed"""
+		
+		#read the camera on a background thread so that the steps never wait on the camera
+		started_grabber = False
+		if self.camera_in_use() and self.camInput.grabber is None:
+			self.camInput.start_grabber()
+			started_grabber = True
+		
+		#find the board once at the start so that each step only has to find the droplets
+		if self.camera_in_use() and self.camInput.calibration is None:
+			self.camInput.calibrate()
+		
+		if instructions is None:
+			graph = scheduler.InstructionGraph(self.ui.instruction_set)
+			instructions = []
+		else:
+			graph = scheduler.InstructionGraph([], keep_nodes=False)
+		program = scheduler.Scheduler(graph, self.clock)
+		
+		instructions = iter(instructions)
+		more_instructions = True
+		
+		#the number of instructions read and the number completed when progress was last reported
+		read_count = program.remaining
+		reported = 0
+		
+		#the instructions that are currently moving droplets (droplet id -> instruction node)
+		self.in_progress = {}
+		self.waiting_new = []
+		
+		while more_instructions or not program.done():
+			#take the next instructions so that later instructions on other droplets can start early
+			while more_instructions and program.remaining < self.lookahead:
+				try:
+					program.add(next(instructions))
+					read_count += 1
+				except StopIteration:
+					more_instructions = False
+			
+			#start all the instructions whose droplets are ready
+			nodes = program.ready()
+			self.dispatch(nodes, program)
+			
+			if self.in_progress != {}:
+				#move every droplet that is in progress by one step
+				self.step_droplets([self.droplets.get(droplet_id) for droplet_id in self.in_progress])
+				self.finish_moves(program)
+			elif program.next_timer() is not None:
+				#nothing to move, so wait for the next WAIT instruction to finish
+				program.wait_for_timer()
+			elif self.waiting_new != [] and program.ready_nodes == []:
+				#nothing else can move the droplets out of the way, so add the held back droplets where they are
+				self.add_waiting_droplets(program)
+			elif nodes == [] and self.waiting_new == [] and not program.done():
+				#nothing left that can be run
+				print "Instruction set could not be completed"
+				break
+			
+			if self.progress is not None and read_count - program.remaining != reported:
+				reported = read_count - program.remaining
+				self.progress(reported, read_count)
+		
+		if started_grabber:
+			self.camInput.stop_grabber()
 		
-		#for each instruction in the set, execute it on the hardware
-		for instruction in self.ui.instruction_set:
+		return program.done()
+	
+	def dispatch(self, nodes, program):
+		"""Start running the given instruction nodes
+		Instructions that take a single step are completed straight away,
+		any MOVE or MIX instructions have their paths planned together and are completed once the droplets arrive
+		A NEW instruction is held back (and tried again with the next nodes) while a droplet is on or next to its plate,
+		or will be as it moves along its path"""
+		
+		targets = {}
+		groups = {}
+		
+		#the NEW instructions held back last time are tried first, they came earlier in the instruction set
+		nodes = self.waiting_new + nodes
+		self.waiting_new = []
+		
+		for node in nodes:
+			instruction = node.instruction
+			
 			if instruction[0] == Instructions.NEW:
 				
-				#add a new droplet to the droplet_list
-				new_droplet = Droplet({'x': int(instruction[1][1]), 'y': int(instruction[1][2])}, instruction[1][0])
-				self.droplet_list.append(new_droplet)
-				
-			elif instruction[0] == Instructions.MIX:
-				
-				#find the droplet index of both the referred droplets
-				droplet1 = self.get_droplet_index(instruction[1][0])
-				droplet2 = self.get_droplet_index(instruction[1][1])
-				
-				#add a path for the first droplet from its current position to the position of the other droplet
-				self.droplet_list[droplet1].add_path(self.droplet_list[droplet2].position)
-				
-				#update droplet1 along its path until there is no change
-				self.move_along_paths([droplet1])
-				
-				#declare the droplets as merged by creating a new droplet with the new id at the position of droplet2
-				new_droplet = Droplet({'x': self.droplet_list[droplet2].position["x"], 'y': self.droplet_list[droplet2].position["y"]}, instruction[1][2])
-				
-				#add the new droplet to the list
-				self.droplet_list.append(new_droplet)
-				
-				#remove the old droplets (droplet1 and droplet2)
-				del self.droplet_list[droplet1]
-				del self.droplet_list[droplet2]
+				#add a new droplet to the grid once the other droplets are out of the way
+				x = int(instruction[1][1])
+				y = int(instruction[1][2])
+				if self.droplets.is_near(x, y) or self.is_moving_near(x, y):
+					self.waiting_new.append(node)
+				else:
+					self.add_new_droplet(node, program)
 				
 			elif instruction[0] == Instructions.SPLIT:
 				
 				#perform the split in any direction by turning on two of the plates either side of the droplet
-				index = self.get_droplet_index(instruction[1][0])
-				new_positions = self.split_droplet(index)
-				
-				#if the split occurred sort out the old and new droplets
-				if len(new_positions) == 2:
-					#create the two new droplets and assign their names
-					new_droplet1 = Droplet(new_positions[0], instruction[1][1])
-					new_droplet2 = Droplet(new_positions[1], instruction[1][2])
-					
-					#add the droplets to the list
-					self.droplet_list.append(new_droplet1)
-					self.droplet_list.append(new_droplet2)
+				if instruction[1][0] in self.droplets:
+					new_positions = self.split_droplet(instruction[1][0])
 					
-					#delete the old droplet
-					del self.droplet_list[index]
+					#if the split occurred sort out the old and new droplets
+					if len(new_positions) == 2:
+						#delete the old droplet
+						self.droplets.remove(instruction[1][0])
+						
+						#create the two new droplets and assign their names
+						self.droplets.add(Droplet(new_positions[0], instruction[1][1]))
+						self.droplets.add(Droplet(new_positions[1], instruction[1][2]))
+				
+				program.complete(node)
 				
-			elif instruction[0] == Instructions.WAIT:
+			elif instruction[0] == Instructions.MIX:
+				
+				droplet1 = self.droplets.get(instruction[1][0])
+				droplet2 = self.droplets.get(instruction[1][1])
+				
+				if droplet1 is None or droplet2 is None:
+					program.complete(node)
+					continue
 				
-				#simply wait for a specific number of time
-				time.sleep(float(instruction[1][0]))
+				#move both droplets towards each other to meet in the middle
+				#both droplets are in the same group so they are allowed to touch
+				meeting_position = self.get_meeting_position(droplet1, droplet2)
+				targets[droplet1.id] = meeting_position
+				targets[droplet2.id] = meeting_position
+				groups[droplet1.id] = node.index
+				groups[droplet2.id] = node.index
+				self.in_progress[droplet1.id] = node
+				self.in_progress[droplet2.id] = node
 				
 			elif instruction[0] == Instructions.MOVE:
 				
-				#find the index of the droplet
-				droplet_index = self.get_droplet_index(instruction[1][0])
+				droplet = self.droplets.get(instruction[1][0])
 				
-				#add a path for the indicated droplet from its current position to the indicated position
-				self.droplet_list[droplet_index].add_path({'x': int(instruction[1][1]), 'y': int(instruction[1][2])})
+				if droplet is None:
+					program.complete(node)
+					continue
 				
-				#move the droplet along the path
-				self.move_along_paths([droplet_index])
+				#move the indicated droplet from its current position to the indicated position
+				targets[droplet.id] = {'x': int(instruction[1][1]), 'y': int(instruction[1][2])}
+				self.in_progress[droplet.id] = node
+		
+		if targets != {}:
+			self.plan_paths(targets, groups)
+			
+		#some of the moves may already be at their target
+		self.finish_moves(program)
+	
+	def add_new_droplet(self, node, program):
+		"""Add the droplet of the NEW instruction node to the grid and complete the instruction"""
+		
+		instruction = node.instruction
+		new_droplet = Droplet({'x': int(instruction[1][1]), 'y': int(instruction[1][2])}, instruction[1][0])
+		if self.droplets.is_near(new_droplet.position["x"], new_droplet.position["y"]):
+			print "Droplet %s is being added next to another droplet and may merge with it" % (new_droplet.id,)
+		self.droplets.add(new_droplet)
+		if self.droplet_added is not None:
+			self.droplet_added(new_droplet)
+		program.complete(node)
+	
+	def add_waiting_droplets(self, program):
+		"""Add the droplets of the held back NEW instructions where they are, even if they are next to another droplet
+		(used once nothing else is left that could move the other droplets away)"""
 		
+		nodes = self.waiting_new
+		self.waiting_new = []
 		
-	def get_droplet_index(self, droplet_id):
-		"""Get the index of the droplet that has the given id value in the droplet list"""
+		for node in nodes:
+			self.add_new_droplet(node, program)
+	
+	def is_moving_near(self, x, y):
+		"""Check whether a droplet that is moving (or about to move) is on or next to the plate at x, y now or along the rest of its path"""
 		
-		#initialise droplet_index
-		droplet_index = -1
+		for droplet_id in self.in_progress:
+			droplet = self.droplets.get(droplet_id)
+			if droplet is None:
+				continue
+			
+			position = (droplet.position["x"], droplet.position["y"])
+			for direction in [None] + list(reversed(droplet.path)):
+				if direction is not None:
+					position = (position[0] + direction["xDir"], position[1] + direction["yDir"])
+				if abs(position[0] - x) + abs(position[1] - y) <= 1:
+					return True
+		
+		return False
+	
+	def get_meeting_position(self, droplet1, droplet2):
+		"""Find the plate where the two droplets should meet to be mixed
+		The plate is on a shortest path between the droplets and as close to half way as possible (so both droplets
+		get there in the fewest steps), preferring plates away from the other droplets and then plates nearer droplet2"""
+		
+		x1 = droplet1.position["x"]
+		y1 = droplet1.position["y"]
+		x2 = droplet2.position["x"]
+		y2 = droplet2.position["y"]
+		
+		best = None
+		
+		#every plate in the rectangle between the two droplets is on a shortest path between them
+		for x in range(min(x1, x2), max(x1, x2) + 1):
+			for y in range(min(y1, y2), max(y1, y2) + 1):
+				distance1 = abs(x - x1) + abs(y - y1)
+				distance2 = abs(x - x2) + abs(y - y2)
+				crowded = self.droplets.is_near(x, y, [droplet1.id, droplet2.id])
+				
+				score = (max(distance1, distance2), crowded, distance2)
+				if best is None or score < best[0]:
+					best = (score, {'x': x, 'y': y})
 		
-		#loop through each droplet in the droplet list
-		for i in range(0,len(self.droplet_list)):
-			if self.droplet_list[i].id == droplet_id:
-				droplet_index = -1
+		return best[1]
+	
+	def plan_paths(self, targets, groups):
+		"""Plan the paths of the droplets in targets (droplet id -> target position) around all the other droplets
+		Droplets that are already moving keep their paths and the new paths are planned around them"""
+		
+		moves = {}
+		in_flight = {}
+		obstacles = []
+		
+		for droplet in self.droplets:
+			if droplet.id in targets:
+				moves[droplet.id] = (droplet.position, targets[droplet.id])
+			elif droplet.id in self.in_progress:
+				in_flight[droplet.id] = (droplet.position, list(reversed(droplet.path)))
+				groups.setdefault(droplet.id, self.in_progress[droplet.id].index)
+			else:
+				obstacles.append(droplet.position)
 		
-		#return the found droplet_index
-		return droplet_index
+		try:
+			paths = self.router.plan(moves, obstacles, groups, in_flight)
+			for droplet_id in paths:
+				self.droplets.get(droplet_id).set_path(paths[droplet_id])
+		except ValueError as e:
+			#fall back to routes that only avoid the droplets that are not moving
+			print "Routing failed (%s), using separate paths instead" % (e.args[0],)
+			self.add_separate_paths(targets, obstacles)
 	
+	def add_separate_paths(self, targets, obstacles):
+		"""Give each droplet in targets (droplet id -> target position) the shortest path around the obstacles,
+		planned on its own (so the moving droplets may come close to each other),
+		a droplet that cannot get around the obstacles is given a direct path"""
+		
+		for droplet_id in targets:
+			droplet = self.droplets.get(droplet_id)
+			
+			try:
+				droplet.set_path(self.router.find_route(droplet.position, targets[droplet_id], obstacles))
+			except ValueError:
+				droplet.add_path(targets[droplet_id])
 	
-	def move_along_paths(self, droplet_indexes):
-		"""Move each droplet in the droplet_indexes list along its path one at a time, 
-		waiting inbetween each total step"""
+	def finish_moves(self, program):
+		"""Complete any MOVE or MIX instructions whose droplets have reached the end of their paths"""
+		
+		nodes = set(self.in_progress.values())
+		
+		for node in nodes:
+			droplet_ids = [droplet_id for droplet_id in self.in_progress if self.in_progress[droplet_id] is node]
+			
+			if all(self.droplets.get(droplet_id).path == [] for droplet_id in droplet_ids):
+				for droplet_id in droplet_ids:
+					del self.in_progress[droplet_id]
+				
+				if node.instruction[0] == Instructions.MIX:
+					#remove the old droplets
+					self.droplets.remove(node.instruction[1][0])
+					droplet2 = self.droplets.remove(node.instruction[1][1])
+					
+					#declare the droplets as merged by creating a new droplet with the new id where they met (the position of droplet2)
+					self.droplets.add(Droplet({'x': droplet2.position["x"], 'y': droplet2.position["y"]}, node.instruction[1][2]))
+				
+				program.complete(node)
+		
+	def step_droplets(self, droplets):
+		"""Move each of the droplets one step along its path, then wait for the droplets to move
+		The step is split into parts (see get_step_parts) so that no droplet is pulled by a ghost plate,
+		only the plates of the droplets moving in each part are turned on
+		Returns whether any of the droplets still have some of their path remaining"""
 		
 		#initialise a flag to distinguish if there are any paths yet unfinished
-		any_remaining = True
+		any_remaining = False
+		
+		telemetry.count("grid.steps")
 		
-		while any_remaining:
-			any_remaining = False
+		for part in self.get_step_parts(droplets):
+			start = telemetry.start()
 			
-			for index in droplet_indexes:
-				if self.droplet_list[index].update_along_path(self.arduino_comm):
+			#when using frames the droplet positions are updated first and then the plates are sent at once
+			arduino_comm = self.arduino_comm
+			if self.use_frames:
+				arduino_comm = None
+			else:
+				#the plates of the last part are turned off as the droplets move
+				self.arduino_comm.stage_plates([])
+			
+			plates = []
+			for droplet in part:
+				moving = droplet.path != [] and (droplet.path[-1]["xDir"] != 0 or droplet.path[-1]["yDir"] != 0)
+				
+				if droplet.update_along_path(arduino_comm):
 					#at least one droplet is still moving
 					any_remaining = True
+				self.droplets.update(droplet)
 				
-			#wait for a second inbetween each droplet moving 1 position step
-			time.sleep(self.waiting_time)
+				if moving:
+					plates.append((droplet.position["x"], droplet.position["y"]))
 			
-			#check that the expected position and actual position from the visual feedback match up
-			droplet_positions = self.camInput.find_drop_positions()
-			#for index in droplet_indexes:
-				#if not self.droplet_list[index].position in droplet_positions:
-					#print "Droplet " + self.droplet_list[index].id + " does not match the visual feedback!"
+			#only the plates that changed are sent (nothing if no droplet moved)
+			if self.use_frames:
+				self.arduino_comm.stage_plates(plates)
+			self.arduino_comm.commit()
 			
-
-
-	def split_droplet(self, droplet_index):
-		"""Split the droplet into two"""
+			telemetry.stop("grid.step_send", start)
+			
+			#the camera frame has to be taken after the plates were set
+			moved_time = time.time()
+			
+			#wait for the droplets to move 1 position step
+			start = telemetry.start()
+			self.wait_for_droplets(self.droplets.get_positions(), moved_time, self.use_frames, plates)
+			telemetry.stop("grid.step_wait", start)
+			
+			#take the replies to the commands of this part off the queue (when pipelined the transport does this)
+			self.arduino_comm.check_replies()
+		
+		return any_remaining
+	
+	def get_step_parts(self, droplets):
+		"""Split the droplets taking a step into parts that are moved one after another
+		The plates are wired in rows and columns, so turning on plates in different rows and columns also turns on
+		the (ghost) plates where their rows and columns cross, a droplet next to a ghost plate is pulled onto it
+		Each part holds as many of the moving droplets as can move together without a ghost plate next to any droplet,
+		the droplets that are not moving are in the first part
+		Returns a list of lists of droplets"""
+		
+		#the position of every droplet on the grid, updated as each part is moved
+		positions = dict((droplet.id, (droplet.position["x"], droplet.position["y"])) for droplet in self.droplets)
+		
+		waiting = []
+		moving = []
+		targets = {}
+		
+		for droplet in droplets:
+			if droplet.path != [] and (droplet.path[-1]["xDir"] != 0 or droplet.path[-1]["yDir"] != 0):
+				targets[droplet.id] = (droplet.position["x"] + droplet.path[-1]["xDir"], droplet.position["y"] + droplet.path[-1]["yDir"])
+				moving.append(droplet)
+			else:
+				waiting.append(droplet)
 		
-		#check if the droplet is on a horizontal edge (left or right)
-		# if so, check if it is on a vertical edge (top or bottom)
-		#  if so, move it in towards the centre by 1 in a horizontal direction before splitting
+		parts = []
 		
-		xpos = self.droplet_list[droplet_index].position["x"]
-		ypos = self.droplet_list[droplet_index].position["y"]
+		while moving != []:
+			#a droplet moving on its own never makes a ghost plate
+			part = [moving[0]]
+			
+			for droplet in moving[1:]:
+				plates = set(targets[other.id] for other in part + [droplet])
+				if not self.has_ghost_plates(plates, positions.values()):
+					part.append(droplet)
+			
+			for droplet in part:
+				positions[droplet.id] = targets[droplet.id]
+			
+			moving = [droplet for droplet in moving if droplet not in part]
+			parts.append(part)
 		
-		done_already = False
+		if parts == []:
+			return [waiting]
 		
-		new_positions = []
+		parts[0] = waiting + parts[0]
+		return parts
+	
+	def has_ghost_plates(self, plates, positions):
+		"""Check whether turning on the plates (a set of (x, y) tuples) turns on a ghost plate on or next to any of the positions
+		or the plates"""
 		
-		#check if we are at the left or right
-		if xpos == 1 or xpos == self.dimensions["maxX"]:
-			# check if we can do the split horizontally
-			if self.dimensions["maxX"] <= 2:
-				#check if we can do the split vertically
-				if self.dimensions["maxY"] <= 2:
-					print "Splitting is not available on such a small working area, needs 3 consecutive plates"
-				else:
-					#do the split vertically
-					#check if we are at the top or bottom
-					if ypos == 1 or ypos == self.dimensions["maxY"]:
-						#move the droplet towards the centre vertically
-						direction = 0
-						#find which direction to move in (up or down)
-						if ypos == 1:
-							direction = 1
-						else:
-							direction = -1
-						
-						self.droplet_list[droplet_index].move({'xDir': 0, 'yDir': direction})
-					#do the split in the vertical direction
-					done_already = True
-					
-					self.arduino_comm.set_plate(xpos, ypos - 1)
-					self.arduino_comm.set_plate(xpos, ypos + 1)
-					
-					new_positions.append({'x': xpos, 'y': ypos - 1})
-					new_positions.append({'x': xpos, 'y': ypos + 1})
-					
-			else:
-				#move the droplet towards the centre horizontally
-				direction = 0
-				#find which direction to move in (left or right)
-				if xpos == 1:
-					direction = 1
-				else:
-					direction = -1
-					
-				self.droplet_list[droplet_index].move({'xDir': direction, 'yDir': 0}, self.arduino_comm)
+		columns = set(x for x, y in plates)
+		rows = set(y for x, y in plates)
 		
-		if not done_already:
-			#do the split in the horizontal direction
-			self.arduino_comm.set_plate(xpos - 1, ypos)
-			self.arduino_comm.set_plate(xpos + 1, ypos)
-			
-			new_positions.append({'x': xpos - 1, 'y': ypos})
-			new_positions.append({'x': xpos + 1, 'y': ypos})
+		for x, y in list(positions) + list(plates):
+			for dx, dy in self.router.halo:
+				if x + dx in columns and y + dy in rows and (x + dx, y + dy) not in plates:
+					return True
+		
+		return False
+	
+	
+	def wait_for_droplets(self, positions, moved_time, frame=False, plates=None):
+		"""Wait for the droplets to move to the given positions (a list of (x, y) tuples) once the plates were set at moved_time
+		In closed loop mode the camera frames are checked until every droplet has been seen at its position,
+		if they have not all arrived within the waiting_time the plates (the positions if None) are set again
+		(as a whole frame if frame is True)
+		Otherwise the whole waiting_time is waited
+		Returns the droplet positions found by the camera"""
+		
+		if not self.closed_loop or not self.camera_in_use():
+			#wait for a second inbetween each droplet moving 1 position step
+			self.clock.sleep(self.waiting_time)
 			
-		#wait for 1 second to let the droplets move
-		time.sleep(self.waiting_time)
+			if not self.camera_in_use():
+				#the camera is not opened (or read) when its frames are not processed
+				return []
+			return self.camInput.find_drop_positions(after=moved_time)
+		
+		#only the plates in view of the camera can be checked
+		expected = set(position for position in positions if position[0] <= self.camInput.cells and position[1] <= self.camInput.cells)
 		
-		#check if the splitting happened
-		if len(new_positions) == 2:
-			#if so check the expected position of each of the resulting droplets with the visual feedback
-			droplet_positions = self.camInput.find_drop_positions()
-			#if not new_positions[0] in droplet_positions or new_positions[1] in droplet_positions:
-				#print "Droplet positions after split do not match the visual feedback!"
+		for attempt in range(0, self.step_retries + 1):
+			end = self.clock.time() + self.waiting_time
+			
+			while True:
+				droplet_positions = self.camInput.find_drop_positions(after=moved_time)
+				if expected.issubset(droplet_positions):
+					return droplet_positions
+				
+				if self.clock.time() >= end:
+					break
+				
+				#the replies are taken while waiting so that their round trip times are close to when they arrived
+				self.arduino_comm.check_replies()
+				
+				#look at the next frame
+				moved_time = time.time()
+			
+			if attempt < self.step_retries:
+				#set the plates again in case a message was lost or the droplet stuck
+				telemetry.count("grid.resends")
+				if plates is None:
+					plates = positions
+				if frame:
+					self.arduino_comm.apply_frame(plates)
+				else:
+					for plate in plates:
+						self.arduino_comm.set_plate(plate[0], plate[1])
+				moved_time = time.time()
 		
-		return new_positions
+		telemetry.count("grid.missed_steps")
+		print "Droplets did not arrive at %s" % (", ".join("%i,%i" % position for position in sorted(expected.difference(droplet_positions))),)
+		return droplet_positions
+
+
+	def split_droplet(self, droplet_id):
+		"""Split the droplet with the given id into two
+		The droplet is split along its row (or along its column if the grid is too narrow), it is first moved one step in
+		from the edge (see step_droplets) if there is no plate on one side of it
+		The split is sent as frames of its own so that no other plate is left on (and no ghost plate is lit):
+		the centre plate on (holding the droplet), then the plates either side as well (stretching it over three plates),
+		then only the plates either side (pulling it apart)
+		Returns the positions of the two new droplets (empty if the droplet cannot be split)"""
+		
+		droplet = self.droplets.get(droplet_id)
+		
+		#split along the row unless the grid is too narrow, then along the column
+		if self.dimensions["maxX"] > 2:
+			dx, dy = 1, 0
+		elif self.dimensions["maxY"] > 2:
+			dx, dy = 0, 1
+		else:
+			print "Splitting is not available on such a small working area, needs 3 consecutive plates"
+			return []
+		
+		#move the droplet in from the edge so that there is a plate either side of it
+		if (dx == 1 and droplet.position["x"] == 1) or (dy == 1 and droplet.position["y"] == 1):
+			droplet.set_path([{'xDir': dx, 'yDir': dy}])
+			self.step_droplets([droplet])
+		elif (dx == 1 and droplet.position["x"] == self.dimensions["maxX"]) or (dy == 1 and droplet.position["y"] == self.dimensions["maxY"]):
+			droplet.set_path([{'xDir': -dx, 'yDir': -dy}])
+			self.step_droplets([droplet])
+		
+		xpos = droplet.position["x"]
+		ypos = droplet.position["y"]
+		centre = (xpos, ypos)
+		sides = [(xpos - dx, ypos - dy), (xpos + dx, ypos + dy)]
+		
+		if any(self.droplets.is_near(x, y, [droplet_id]) or self.is_moving_near(x, y) for x, y in sides):
+			print "Droplet %s is being split next to another droplet and may merge with it" % (droplet_id,)
+		
+		#hold the droplet on its plate, then stretch it over the plates either side
+		for plates in [[centre], [sides[0], centre, sides[1]]]:
+			self.arduino_comm.stage_plates(plates)
+			self.arduino_comm.commit()
+		self.clock.sleep(self.waiting_time)
+		
+		#turning the centre plate off pulls the droplet apart onto the plates either side
+		self.arduino_comm.stage_plates(sides)
+		self.arduino_comm.commit()
+		
+		#the camera frame has to be taken after the plates were set
+		moved_time = time.time()
+		
+		#wait to let the droplets move (checking the expected position of each of the resulting droplets with the visual feedback)
+		self.wait_for_droplets(sides, moved_time, self.use_frames, sides)
+		
+		return [{'x': x, 'y': y} for x, y in sides]
 
 
 if __name__=="__main__":
 	#The main program
 	
-	if len(sys.argv) < 2:
-		print "Usage:   python droplet_program inputfile.txt"
+	args = sys.argv[1:]
+	
+	#estimate the run without the arduino or camera
+	dry_run = "--dry-run" in args
+	if dry_run:
+		args.remove("--dry-run")
+	
+	#record the timings and write them to a file at the end (a Prometheus text file if it ends in .prom, otherwise JSON lines)
+	telemetry_file = None
+	if "--telemetry" in args and args.index("--telemetry") + 1 < len(args):
+		telemetry_file = args.pop(args.index("--telemetry") + 1)
+		args.remove("--telemetry")
+		telemetry.enable()
+	
+	if len(args) < 1:
+		print "Usage:   python droplet_program [--dry-run] [--telemetry metrics.jsonl] inputfile.txt"
 		print
 		print "Please specify an input file"
+	elif dry_run:
+		import dryRun
+		
+		grid = dryRun.DryRunGrid()
+		
+		#the file is only read, no compiled file is written next to it (see protocolCache)
+		try:
+			grid.ui.load_input_file(args[0])
+		except ValueError as e:
+			print e.args[0]
+			print "\n".join(grid.ui.errors)
+		else:
+			dryRun.print_report(dryRun.estimate(grid.ui.instruction_set, grid.waiting_time), grid.dimensions)
 	else:
 		grid = Grid()
 		
 		#load the user input file
-		if grid.load_program(sys.argv[1]):
+		if grid.load_program(args[0]):
 			
 			#run through the protocol
 			print "Instruction set contains no issues"
 			print "Running program..."
 			
+			grid.open_devices()
+			print "Grid size %i x %i" % (grid.dimensions["maxX"], grid.dimensions["maxY"])
+			
 			grid.run_program()
 		
 		print "Done"
 	
+	if telemetry_file is not None:
+		telemetry.print_summary()
+		telemetry.export(telemetry_file)
+	
 	
 	
 	
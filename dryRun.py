@@ -0,0 +1,226 @@
+"""This module estimates how long a user input file will take to run and how hard it drives each plate, without an arduino or camera
+The instructions are run through the same path planning and stepping as on the real device, with a virtual clock
+that moves on straight away instead of waiting, so a whole protocol is estimated in milliseconds"""
+
+import arduinoComms
+import droplet_program
+
+class VirtualClock:
+	"""A clock that only moves on when it is slept, used in place of the time module for Grid.clock"""
+
+	def __init__(self):
+		"""Initialise the clock at time 0"""
+
+		self.now = 0.0
+
+	def time(self):
+		"""Return the virtual time"""
+
+		return self.now
+
+	def sleep(self, seconds):
+		"""Move the time on without waiting"""
+
+		self.now += max(0.0, seconds)
+
+
+class DryRunConnection:
+	"""Stands in for the open serial connection to the arduino (with the pyserial read, write and inWaiting methods), nothing is sent or read"""
+
+	def inWaiting(self):
+		"""There are never any bytes to read"""
+
+		return 0
+
+	def read(self, size=1):
+		"""Nothing is read"""
+
+		return ""
+
+	def write(self, data):
+		"""The data is thrown away"""
+
+		pass
+
+	def close(self):
+		"""Nothing to close"""
+
+		pass
+
+
+class DryRunArduino(arduinoComms.ArduinoCommunication):
+	"""Counts the plates that the program sets instead of sending them to an arduino"""
+
+	def __init__(self, clock, dimensions=[8,9], baudrate=9600, max_message=122):
+		"""Initialise the counts, nothing is opened (the arduino is given a connection that throws the messages away)
+		clock is used to time how long each plate is on for,
+		the messages are sent as they would be to the current arduino code (max_message long, with sparse frames)"""
+
+		arduinoComms.ArduinoCommunication.__init__(self, None, dimensions, baudrate=baudrate, connection=DryRunConnection())
+		self.max_message = max_message
+		self.sparse_frames = True
+		self.baudrate = baudrate
+		self.clock = clock
+
+		#the plates that were on after the last command and when that command was sent
+		self.last_plates = set()
+		self.last_time = clock.time()
+
+		#(x, y) -> the number of times the plate was turned on / the number of seconds it was on
+		self.activations = {}
+		self.on_time = {}
+		self.bytes_sent = 0
+
+	def send_command(self, command):
+		"""Count the command and the plates it turned on (the plate state has already been updated)"""
+
+		self.bytes_sent += len(command) + 2
+		self.update_counts()
+
+	def update_counts(self):
+		"""Add up the time the plates have been on and count the plates that have been turned on since the last command"""
+
+		now = self.clock.time()
+		for plate in self.last_plates:
+			self.on_time[plate] = self.on_time.get(plate, 0.0) + (now - self.last_time)
+
+		for plate in self.plates - self.last_plates:
+			self.activations[plate] = self.activations.get(plate, 0) + 1
+
+		self.last_plates = set(self.plates)
+		self.last_time = now
+
+	def check_replies(self):
+		"""There are no replies to check"""
+
+		pass
+
+
+class DryRunCamera:
+	"""Stands in for the camera, no droplets are ever seen so the program always waits the whole waiting time"""
+
+	def __init__(self):
+		"""There is no capture to open"""
+
+		self.capture_in_use = False
+		self.grabber = None
+		self.calibration = None
+		self.cells = 8
+
+	def find_drop_positions(self, filename="", frame=None, after=0):
+		"""No droplets are found"""
+
+		return []
+
+
+class DryRunGrid(droplet_program.Grid):
+	"""A grid that runs without a device and counts the steps and droplets"""
+
+	def __init__(self, dimensions=[8,9]):
+		"""Initialise the grid with the dry run arduino and camera, the grid is the size of dimensions ([maxX, maxY])"""
+
+		clock = VirtualClock()
+		droplet_program.Grid.__init__(self, DryRunArduino(clock, dimensions), DryRunCamera())
+		self.clock = clock
+
+		self.steps = 0
+		self.peak_droplets = 0
+
+	def dispatch(self, nodes, program):
+		"""Start running the instructions, keeping track of the most droplets on the grid at once"""
+
+		droplet_program.Grid.dispatch(self, nodes, program)
+		self.peak_droplets = max(self.peak_droplets, len(self.droplets))
+
+	def step_droplets(self, droplets):
+		"""Move the droplets one step, counting the step"""
+
+		self.steps += 1
+		return droplet_program.Grid.step_droplets(self, droplets)
+
+	def split_droplet(self, droplet_id):
+		"""Split the droplet, counting the steps taken (an extra one if it is moved in from the edge first)"""
+
+		self.steps += 1
+		return droplet_program.Grid.split_droplet(self, droplet_id)
+
+
+def estimate(instruction_set, waiting_time=1, dimensions=[8,9]):
+	"""Run the (checked) instruction set on a dry run grid, waiting_time is the time each step takes on the device
+	and dimensions is the size of the grid ([maxX, maxY])
+	Returns a dictionary of:
+		steps:			the number of steps the droplets take
+		time:			the estimated run time in seconds (the steps and the WAIT instructions)
+		serial_time:	the time taken to send the messages to the arduino (not included in time)
+		bytes_sent:		the number of bytes sent to the arduino
+		peak_droplets:	the most droplets on the grid at once
+		activations:	(x, y) -> the number of times the plate is turned on
+		on_time:		(x, y) -> the number of seconds the plate is on for"""
+
+	grid = DryRunGrid(dimensions)
+	grid.waiting_time = waiting_time
+
+	grid.run_program(instruction_set)
+
+	arduino = grid.arduino_comm
+	arduino.update_counts()
+
+	return {
+		"steps": grid.steps,
+		"time": grid.clock.time(),
+		#a start bit, 8 data bits and a stop bit for each byte
+		"serial_time": arduino.bytes_sent * 10.0 / arduino.baudrate,
+		"bytes_sent": arduino.bytes_sent,
+		"peak_droplets": grid.peak_droplets,
+		"activations": arduino.activations,
+		"on_time": arduino.on_time,
+	}
+
+
+def print_report(report, dimensions={'maxX': 8, 'maxY': 9}):
+	"""Print the estimate in a readable form, with the plate counts laid out as the grid"""
+
+	print "Steps: %i" % (report["steps"],)
+	print "Estimated time: %.1f s (plus %.2f s sending %i bytes to the arduino)" % (report["time"], report["serial_time"], report["bytes_sent"])
+	print "Peak droplets: %i" % (report["peak_droplets"],)
+
+	for title, counts, cell_format in [("Plate activations", report["activations"], "%4i"), ("Plate on time (s)", report["on_time"], "%6.1f")]:
+		print
+		print title + ":"
+		for y in range(1, dimensions["maxY"] + 1):
+			print "".join(cell_format % (counts.get((x, y), 0),) for x in range(1, dimensions["maxX"] + 1))
+
+	if report["activations"] != {}:
+		busiest = max(report["activations"], key=lambda plate: (report["activations"][plate], report["on_time"].get(plate, 0)))
+		print
+		print "Busiest plate: %i,%i turned on %i times" % (busiest[0], busiest[1], report["activations"][busiest])
+
+
+if __name__=="__main__":
+	#estimate the given user input files, quickest first
+	import sys
+	import time
+	import userInput
+
+	if len(sys.argv) < 2:
+		print "Usage:   python dryRun.py inputfile.txt [inputfile.txt ...]"
+
+	results = []
+	for filename in sys.argv[1:]:
+		ui = userInput.UserInput()
+
+		#the file is only read, no compiled file is written next to it (see protocolCache)
+		try:
+			ui.load_input_file(filename)
+		except ValueError as e:
+			print "%s: %s" % (filename, e.args[0])
+			continue
+
+		start = time.time()
+		report = estimate(ui.instruction_set)
+		print "%s: %i steps, %.1f s, %i droplets at most (estimated in %.1f ms)" % (filename, report["steps"], report["time"], report["peak_droplets"], (time.time() - start) * 1000)
+		results.append((report["time"], filename))
+
+	if len(results) > 1:
+		print
+		print "Quickest first: %s" % (", ".join(filename for run_time, filename in sorted(results)),)
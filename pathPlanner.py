@@ -0,0 +1,300 @@
+"""This module plans the paths that droplets take across the grid of plates
+Several droplets can be planned at once, each path is reserved in space and time so that
+droplets never come close enough to each other to merge by accident
+Paths are returned in the same direction format used by the Droplet class: {xDir: -1, yDir: 0}"""
+
+import collections
+import heapq
+
+class RouteCache:
+	"""A least recently used cache of routes, keyed by (start, goal, obstacles)
+	Routes are stored as tuples of (xDir, yDir) pairs so that the cached copy cannot be changed by a caller"""
+
+	def __init__(self, size=1024):
+		"""Initialise an empty cache holding at most size routes"""
+
+		self.size = size
+		self.routes = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		"""Return the cached route as a list of directions (None if it is not in the cache)"""
+
+		route = self.routes.pop(key, None)
+
+		if route is None:
+			self.misses += 1
+			return None
+
+		#put the route back as the most recently used
+		self.routes[key] = route
+		self.hits += 1
+
+		return [{'xDir': dx, 'yDir': dy} for dx, dy in route]
+
+	def put(self, key, directions):
+		"""Add the route (a list of directions) to the cache, dropping the least recently used route if the cache is full"""
+
+		self.routes[key] = tuple((direction["xDir"], direction["yDir"]) for direction in directions)
+
+		if len(self.routes) > self.size:
+			self.routes.popitem(last=False)
+
+
+class Router:
+	"""Plans collision free paths for a number of droplets that move at the same time
+	Each time step every droplet either moves one plate horizontally/vertically or waits"""
+
+	def __init__(self, dimensions, keep_out=1):
+		"""Initialise the router for a grid with the given dimensions
+		keep_out is the (manhattan) distance in plates that has to be kept between droplets that are not merging"""
+
+		self.dimensions = dimensions
+		self.keep_out = keep_out
+
+		#the list of relative offsets that make up the keep out area around a plate
+		self.halo = [(dx, dy) for dx in range(-keep_out, keep_out + 1) for dy in range(-keep_out, keep_out + 1) if abs(dx) + abs(dy) <= keep_out]
+
+		#the possible steps a droplet can take in one time step (including waiting still)
+		self.steps = [(0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)]
+
+		#the shortest routes around the droplets that are not moving, reused whenever the same move comes up again
+		self.routes = RouteCache()
+
+		self.reset()
+
+	def reset(self):
+		"""Clear all the reservations"""
+
+		#reserved holds (x, y, t) -> group of the droplet occupying plate x,y at time t
+		self.reserved = {}
+		#parked holds (x, y) -> (t, group) for droplets that stay on plate x,y from time t onwards
+		self.parked = {}
+		#static holds the plates of droplets that do not move at all
+		self.static = set()
+		#the last time step that has been reserved by any droplet
+		self.last_time = 0
+
+	def in_bounds(self, x, y):
+		"""Check whether the plate x, y is on the grid (plates are numbered from 1)"""
+
+		return x >= 1 and x <= self.dimensions["maxX"] and y >= 1 and y <= self.dimensions["maxY"]
+
+	def is_blocked(self, x, y, t, group):
+		"""Check whether a droplet of the given group can be on plate x,y at time t
+		A plate is blocked if any other droplet is within the keep out distance at the same time,
+		one time step before or one time step after (as the droplets are moving at the same time)"""
+
+		for dx, dy in self.halo:
+			nx = x + dx
+			ny = y + dy
+
+			if (nx, ny) in self.static:
+				return True
+
+			for tt in (t - 1, t, t + 1):
+				owner = self.reserved.get((nx, ny, tt))
+				if owner is not None and owner != group:
+					return True
+
+			parked = self.parked.get((nx, ny))
+			if parked is not None and parked[1] != group and parked[0] <= t + 1:
+				return True
+
+		return False
+
+	def can_stay(self, x, y, t, group):
+		"""Check whether a droplet can stay on plate x,y from time t onwards"""
+
+		for tt in range(t, self.last_time + 2):
+			if self.is_blocked(x, y, tt, group):
+				return False
+
+		return True
+
+	def reserve(self, start, directions, group):
+		"""Reserve the plates along the given path (starting from time 0) for the given group"""
+
+		x = start["x"]
+		y = start["y"]
+		self.reserved[(x, y, 0)] = group
+
+		t = 0
+		for direction in directions:
+			t += 1
+			x += direction["xDir"]
+			y += direction["yDir"]
+			self.reserved[(x, y, t)] = group
+
+		#the droplet stays at its final position once the path is complete
+		self.parked[(x, y)] = (t, group)
+		self.last_time = max(self.last_time, t)
+
+	def find_path(self, start, goal, group):
+		"""Find the shortest path in space and time from start to goal that avoids the current reservations
+		Uses A* search over (x, y, t) states
+		Returns the list of directions, raises a ValueError if no path could be found"""
+
+		if not self.in_bounds(goal["x"], goal["y"]):
+			raise ValueError("Position %i,%i is not on the grid" % (goal["x"], goal["y"]))
+
+		goal_cell = (goal["x"], goal["y"])
+
+		#limit the search so that an impossible path does not search forever
+		#(the time allowed for going around the other droplets grows with the sides of the grid rather than its area,
+		#so that the search of a large grid stays small)
+		slack = min(self.dimensions["maxX"] * self.dimensions["maxY"], 4 * (self.dimensions["maxX"] + self.dimensions["maxY"]))
+		horizon = self.last_time + abs(goal["x"] - start["x"]) + abs(goal["y"] - start["y"]) + slack
+
+		start_state = (start["x"], start["y"], 0)
+		came_from = {start_state: None}
+		open_list = [(self.distance(start_state, goal_cell), 0, start_state)]
+
+		while open_list != []:
+			cost, t, state = heapq.heappop(open_list)
+			x, y = state[0], state[1]
+
+			if (x, y) == goal_cell and self.can_stay(x, y, t, group):
+				return self.build_directions(came_from, state)
+
+			if t >= horizon:
+				continue
+
+			for dx, dy in self.steps:
+				next_state = (x + dx, y + dy, t + 1)
+
+				if next_state in came_from:
+					continue
+				if not self.in_bounds(next_state[0], next_state[1]):
+					continue
+				if self.is_blocked(next_state[0], next_state[1], t + 1, group):
+					continue
+
+				came_from[next_state] = state
+				heapq.heappush(open_list, (t + 1 + self.distance(next_state, goal_cell), t + 1, next_state))
+
+		raise ValueError("No collision free path from %i,%i to %i,%i" % (start["x"], start["y"], goal["x"], goal["y"]))
+
+	def find_route(self, start, goal, obstacles=[]):
+		"""Find the shortest path from start to goal that keeps the keep out distance from every obstacle (a list of positions)
+		Only the droplets that are not moving are avoided (there is no timing), the routes are cached
+		Returns the list of directions, raises a ValueError if no path could be found"""
+
+		if not self.in_bounds(goal["x"], goal["y"]):
+			raise ValueError("Position %i,%i is not on the grid" % (goal["x"], goal["y"]))
+
+		start_cell = (start["x"], start["y"])
+		goal_cell = (goal["x"], goal["y"])
+		obstacle_cells = frozenset((position["x"], position["y"]) for position in obstacles)
+
+		key = (start_cell, goal_cell, obstacle_cells)
+		directions = self.routes.get(key)
+		if directions is not None:
+			return directions
+
+		#the plates within the keep out distance of an obstacle
+		blocked = set((x + dx, y + dy) for x, y in obstacle_cells for dx, dy in self.halo)
+
+		#breadth first search out from the start, every step costs the same
+		came_from = {start_cell: None}
+		queue = collections.deque([start_cell])
+
+		while queue:
+			cell = queue.popleft()
+
+			if cell == goal_cell:
+				directions = self.build_directions(came_from, cell)
+				self.routes.put(key, directions)
+				return directions
+
+			for dx, dy in self.steps[1:]:
+				next_cell = (cell[0] + dx, cell[1] + dy)
+
+				if next_cell in came_from or next_cell in blocked or not self.in_bounds(next_cell[0], next_cell[1]):
+					continue
+
+				came_from[next_cell] = cell
+				queue.append(next_cell)
+
+		raise ValueError("No path from %i,%i to %i,%i around the other droplets" % (start["x"], start["y"], goal["x"], goal["y"]))
+
+	def is_route_free(self, start, directions, group):
+		"""Check whether the path (starting from time 0) avoids the current reservations and the droplet can stay at the end"""
+
+		x = start["x"]
+		y = start["y"]
+
+		t = 0
+		for direction in directions:
+			t += 1
+			x += direction["xDir"]
+			y += direction["yDir"]
+
+			if self.is_blocked(x, y, t, group):
+				return False
+
+		return self.can_stay(x, y, t, group)
+
+	def distance(self, state, cell):
+		"""The manhattan distance between the state and the plate"""
+
+		return abs(state[0] - cell[0]) + abs(state[1] - cell[1])
+
+	def build_directions(self, came_from, state):
+		"""Walk back through the search to build the list of directions (in the order they are taken)"""
+
+		directions = []
+
+		while came_from[state] is not None:
+			previous = came_from[state]
+			directions.append({'xDir': state[0] - previous[0], 'yDir': state[1] - previous[1]})
+			state = previous
+
+		directions.reverse()
+		return directions
+
+	def plan(self, moves, obstacles=[], groups={}, in_flight={}):
+		"""Plan paths for all the droplets in moves at the same time
+		moves is a dictionary of key -> (start position, goal position)
+		obstacles is a list of positions of droplets that are not moving
+		groups is a dictionary of key -> group for droplets that are allowed to touch (e.g. when mixing),
+		droplets not in groups are only allowed to touch themselves
+		in_flight is a dictionary of key -> (position, list of directions) for droplets that already have a path,
+		these paths are kept as they are and the new paths are planned around them
+		Returns a dictionary of key -> list of directions
+		Raises a ValueError if any of the droplets cannot reach their goal"""
+
+		self.reset()
+
+		for position in obstacles:
+			self.static.add((position["x"], position["y"]))
+
+		for key in in_flight:
+			self.reserve(in_flight[key][0], in_flight[key][1], groups.get(key, key))
+
+		#plan the longest paths first as they are the hardest to fit around the others
+		order = sorted(moves.keys(), key=lambda key: -self.distance((moves[key][0]["x"], moves[key][0]["y"]), (moves[key][1]["x"], moves[key][1]["y"])))
+
+		#the droplets that have not been planned yet still sit at their start positions
+		for key in order:
+			start = moves[key][0]
+			self.parked[(start["x"], start["y"])] = (0, groups.get(key, key))
+
+		paths = {}
+		for key in order:
+			start, goal = moves[key]
+			group = groups.get(key, key)
+
+			del self.parked[(start["x"], start["y"])]
+
+			#the shortest route around the droplets that are not moving is used if it does not cross the other moving droplets,
+			#otherwise the path is searched for in space and time
+			route = self.find_route(start, goal, obstacles)
+			if self.is_route_free(start, route, group):
+				paths[key] = route
+			else:
+				paths[key] = self.find_path(start, goal, group)
+			self.reserve(start, paths[key], group)
+
+		return paths
@@ -0,0 +1,186 @@
+"""This module compiles a checked user input file into a compact binary form so that it does not have to be parsed and checked again
+The compiled file is kept next to the user input file (with .dpc added to the name) and holds a hash of the user input file,
+it is only used while the user input file is unchanged
+
+The compiled file is laid out as:
+	header:			"DPC" + format version (1 byte) + SHA-1 of the user input file (20 bytes)
+					+ size of the names + number of names + number of instructions (4 bytes each)
+	names:			the droplet names separated by new lines (a name cannot have a new line in it)
+	instructions:	13 bytes each, the instruction number (1 byte) followed by three 4 byte values:
+					NEW name, x, y / MIX name, name, name / SPLIT name, name, name / MOVE name, x, y / WAIT seconds (8 byte float)
+All numbers are little endian"""
+
+import hashlib
+import os.path
+import struct
+
+from userInput import Instructions
+
+MAGIC = "DPC"
+VERSION = 1
+
+HEADER = struct.Struct("<3sB20sIII")
+RECORD = struct.Struct("<BIII")
+WAIT_RECORD = struct.Struct("<Bd4x")
+
+#which of the parameters of each instruction are droplet names (the rest are coordinates)
+NAME_PARAMS = {
+	Instructions.NEW: [True, False, False],
+	Instructions.MIX: [True, True, True],
+	Instructions.SPLIT: [True, True, True],
+	Instructions.MOVE: [True, False, False],
+}
+
+def get_cache_filename(filename):
+	"""Return the name of the compiled file for the user input file"""
+
+	return filename + ".dpc"
+
+
+def get_file_hash(filename):
+	"""Return the SHA-1 hash of the contents of the file"""
+
+	sha = hashlib.sha1()
+	with open(filename, "rb") as input_file:
+		for block in iter(lambda: input_file.read(65536), ""):
+			sha.update(block)
+
+	return sha.digest()
+
+
+def compile_instructions(instruction_set, digest):
+	"""Compile the (checked) instruction set into the binary form, digest is the hash of the user input file
+	Raises a ValueError if a coordinate is not a whole number or cannot be stored in 4 bytes (negative or too large)"""
+
+	#each droplet name is stored once and referred to by its position in the list of names
+	names = []
+	name_ids = {}
+	records = []
+
+	for instruction_id, params in instruction_set:
+		if instruction_id == Instructions.WAIT:
+			records.append(WAIT_RECORD.pack(instruction_id, float(params[0])))
+			continue
+
+		values = []
+		for param, is_name in zip(params, NAME_PARAMS[instruction_id]):
+			if is_name:
+				if param not in name_ids:
+					name_ids[param] = len(names)
+					names.append(param)
+				values.append(name_ids[param])
+			else:
+				try:
+					value = int(param)
+				except ValueError:
+					raise ValueError("The coordinate %s is not a whole number" % (param,))
+				#a coordinate is stored as an unsigned 4 byte value
+				if value < 0 or value > 0xFFFFFFFF:
+					raise ValueError("The coordinate %s is out of the range that can be compiled" % (param,))
+				values.append(value)
+
+		records.append(RECORD.pack(instruction_id, *values))
+
+	names = "\n".join(names)
+
+	return HEADER.pack(MAGIC, VERSION, digest, len(names), len(name_ids), len(records)) + names + "".join(records)
+
+
+def load_compiled(data, digest=None):
+	"""Load the instruction set from the compiled binary form
+	The droplet names are in the instructions as strings and the coordinates as integers, ready to run
+	Returns None if the data is not a compiled instruction set or (if a digest is given) it was compiled from a different user input file"""
+
+	if len(data) < HEADER.size:
+		return None
+
+	magic, version, file_digest, names_size, name_count, instruction_count = HEADER.unpack_from(data, 0)
+	if magic != MAGIC or version != VERSION or (digest is not None and file_digest != digest):
+		return None
+
+	offset = HEADER.size + names_size
+	if len(data) != offset + instruction_count * RECORD.size:
+		return None
+
+	names = []
+	if name_count > 0:
+		names = data[HEADER.size:offset].split("\n")
+
+	#unpack every instruction at once, then take the 4 values of each instruction
+	values = struct.unpack("<" + "BIII" * instruction_count, data[offset:])
+
+	instruction_set = []
+	for instruction_id, a, b, c in zip(values[0::4], values[1::4], values[2::4], values[3::4]):
+		if instruction_id == Instructions.NEW or instruction_id == Instructions.MOVE:
+			instruction_set.append((instruction_id, [names[a], b, c]))
+		elif instruction_id == Instructions.WAIT:
+			#the 8 bytes of the float were unpacked as the first two values
+			instruction_set.append((instruction_id, [struct.unpack("<d", struct.pack("<II", a, b))[0]]))
+		else:
+			instruction_set.append((instruction_id, [names[a], names[b], names[c]]))
+
+	return instruction_set
+
+
+def load_protocol(ui, filename, use_cache=True):
+	"""Load the user input file into ui.instruction_set (ui is a UserInput object), using the compiled file if it is up to date
+	Otherwise the user input file is parsed and checked as normal and, if there are no errors, compiled for next time
+	Raises a ValueError if there are errors in the user input file (as UserInput.load_input_file)
+	Returns True if the compiled file was used"""
+
+	if not os.path.isfile(filename):
+		raise ValueError("The file cannot be found: Please check that it is spelt correctly")
+
+	digest = get_file_hash(filename)
+	cache_filename = get_cache_filename(filename)
+
+	if use_cache and os.path.isfile(cache_filename):
+		with open(cache_filename, "rb") as cache_file:
+			instruction_set = load_compiled(cache_file.read(), digest)
+
+		if instruction_set is not None:
+			ui.instruction_set = instruction_set
+			ui.errors = []
+			return True
+
+	#raises a ValueError if there are any errors (nothing is compiled)
+	ui.load_input_file(filename)
+
+	try:
+		data = compile_instructions(ui.instruction_set, digest)
+	except ValueError:
+		#leave it to the program to deal with the instructions that cannot be compiled
+		return False
+
+	try:
+		with open(cache_filename, "wb") as cache_file:
+			cache_file.write(data)
+	except IOError:
+		#the cache is only to save time, carry on without it (e.g. a read only directory)
+		pass
+
+	return False
+
+
+if __name__=="__main__":
+	#compile the given user input files
+	import sys
+	import time
+	import userInput
+
+	if len(sys.argv) < 2:
+		print "Usage:   python protocolCache.py inputfile.txt [inputfile.txt ...]"
+
+	for filename in sys.argv[1:]:
+		ui = userInput.UserInput()
+
+		for use_cache in [False, True]:
+			start = time.time()
+			try:
+				cached = load_protocol(ui, filename, use_cache)
+			except ValueError as e:
+				print "%s: %s" % (filename, e.args[0])
+				print "\n".join(ui.errors)
+				break
+
+			print "%s: %i instructions %s in %.4f s" % (filename, len(ui.instruction_set), "loaded from the compiled file" if cached else "parsed and compiled", time.time() - start)
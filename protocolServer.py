@@ -0,0 +1,378 @@
+"""This module keeps the arduino and camera open in a long running server so that protocols start straight away
+(opening the serial port resets the arduino and waits 2 seconds, and the camera has to be opened and the board found)
+Protocols are sent to the server over a local unix socket, queued by priority and run one at a time on the open devices
+
+Each request is a single line of JSON:
+	{"file": "/path/to/inputfile.txt", "priority": 0}	run a user input file (a higher priority runs first)
+	{"instructions": [[instruction id, [params]], ...]}	run an instruction set (checked as a user input file is)
+	{"status": true}									get the running job and the queue
+The server replies with a line of JSON for each event until the protocol is finished:
+	{"event": "queued", "job": 1, "position": 0}
+	{"event": "started", "job": 1, "waited": 0.001}
+	{"event": "progress", "job": 1, "completed": 2, "instructions": 8}
+	{"event": "finished", "job": 1, "run_time": 12.5, "completed": true}  or  {"event": "failed", "job": 1, "error": "..."}"""
+
+import itertools
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import stat
+import threading
+import time
+
+import protocolCache
+import userInput
+
+SOCKET_PATH = "/tmp/droplet_program.sock"
+
+def check_instructions(instructions, dimensions):
+	"""Check an instruction set sent in a request the same way as the lines of a user input file are checked
+	(the instructions and their number of parameters are known, and every droplet is defined before it is used),
+	as well as the values: droplet names are strings, coordinates are whole numbers on the grid
+	(dimensions is {'maxX': x, 'maxY': y}) and WAIT times are numbers of seconds that are not negative
+	Returns the instruction set as (instruction id, [params]) tuples, with the coordinates as integers and the times as floats
+	Raises a ValueError naming the first instruction that is not valid"""
+
+	ui = userInput.UserInput()
+	instruction_set = []
+
+	if not isinstance(instructions, list):
+		raise ValueError("The instructions must be a list of [instruction id, [params]]")
+
+	for number, instruction in enumerate(instructions, 1):
+		try:
+			if not isinstance(instruction, list) or len(instruction) != 2 or not isinstance(instruction[1], list):
+				raise ValueError("The instruction must be [instruction id, [params]]")
+
+			instruction_id, params = instruction
+			if not isinstance(instruction_id, int) or instruction_id not in userInput.Instructions.ExpectedParams:
+				raise ValueError("Invalid instruction")
+			if len(params) != userInput.Instructions.ExpectedParams[instruction_id]:
+				raise ValueError("The instruction needs %i arguments" % (userInput.Instructions.ExpectedParams[instruction_id],))
+
+			params = check_values(instruction_id, params, dimensions)
+			ui.check_defined_droplets(instruction_id, params)
+		except (TypeError, ValueError) as e:
+			raise ValueError("Instruction %i: %s" % (number, e.args[0]))
+
+		instruction_set.append((instruction_id, params))
+
+	return instruction_set
+
+
+def check_values(instruction_id, params, dimensions):
+	"""Check the values of the parameters of an instruction (which has the right number of them)
+	Returns the parameters with the coordinates as integers and the time as a float
+	Raises a ValueError if a value is not valid"""
+
+	if instruction_id == userInput.Instructions.WAIT:
+		if isinstance(params[0], bool):
+			raise ValueError("The time %s is not a number" % (json.dumps(params[0]),))
+		try:
+			seconds = float(params[0])
+		except (TypeError, ValueError):
+			raise ValueError("The time %s is not a number" % (json.dumps(params[0]),))
+		if not seconds >= 0 or seconds == float("inf"):
+			raise ValueError("The time %s is not a number of seconds that is 0 or more" % (json.dumps(params[0]),))
+		return [seconds]
+
+	names = params
+	coordinates = []
+	if instruction_id == userInput.Instructions.NEW or instruction_id == userInput.Instructions.MOVE:
+		names = params[0:1]
+		coordinates = params[1:3]
+
+	for name in names:
+		if not isinstance(name, basestring) or name == "":
+			raise ValueError("The droplet name %s is not a string" % (json.dumps(name),))
+
+	values = []
+	for coordinate, limit in zip(coordinates, [dimensions["maxX"], dimensions["maxY"]]):
+		#whole numbers are taken as numbers or as strings (as they are in a user input file)
+		if isinstance(coordinate, bool) or isinstance(coordinate, float):
+			raise ValueError("The coordinate %s is not a whole number" % (json.dumps(coordinate),))
+		try:
+			value = int(coordinate)
+		except (TypeError, ValueError):
+			raise ValueError("The coordinate %s is not a whole number" % (json.dumps(coordinate),))
+		if value < 1 or value > limit:
+			raise ValueError("The coordinate %i is not on the grid (1 to %i)" % (value, limit))
+		values.append(value)
+
+	return names + values
+
+
+class ServerJob:
+	"""A protocol waiting to be run, the events for the client are put on its events queue"""
+
+	def __init__(self, job_id, request):
+		"""Initialise object state"""
+
+		self.id = job_id
+		self.file = request.get("file")
+		self.instructions = request.get("instructions")
+		self.priority = request.get("priority", 0)
+		self.queued_time = time.time()
+		self.events = Queue.Queue()
+
+	def send(self, event, **values):
+		"""Add an event for the client"""
+
+		values["event"] = event
+		values["job"] = self.id
+		self.events.put(values)
+
+
+class ProtocolRequestHandler(SocketServer.StreamRequestHandler):
+	"""Handles one client connection: reads the request and writes back the events of the job"""
+
+	def handle(self):
+		"""Read the request line and reply"""
+
+		line = self.rfile.readline()
+		if line == "":
+			#the client closed the connection without a request (e.g. checking whether the server is running)
+			return
+
+		try:
+			request = json.loads(line)
+		except ValueError:
+			self.write_event({"event": "failed", "error": "The request is not valid JSON"})
+			return
+
+		if request.get("status"):
+			self.write_event(self.server.get_status())
+			return
+
+		if request.get("file") is None and request.get("instructions") is None:
+			self.write_event({"event": "failed", "error": "The request needs a file or instructions"})
+			return
+
+		#an instruction set is checked before it is queued, as a user input file is checked when it is loaded
+		if request.get("instructions") is not None:
+			try:
+				request["instructions"] = check_instructions(request["instructions"], self.server.grid.dimensions)
+			except ValueError as e:
+				self.write_event({"event": "failed", "error": e.args[0]})
+				return
+
+		job = self.server.submit(request)
+
+		while True:
+			event = job.events.get()
+
+			if not self.write_event(event):
+				#the client has gone, the job is still run
+				return
+
+			if event["event"] in ("finished", "failed"):
+				return
+
+	def write_event(self, event):
+		"""Write the event as a line of JSON, returns False if the client has disconnected"""
+
+		try:
+			self.wfile.write(json.dumps(event) + "\n")
+			self.wfile.flush()
+		except socket.error:
+			return False
+
+		return True
+
+
+class ProtocolServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	"""Runs the submitted protocols one at a time on a grid whose devices stay open"""
+
+	daemon_threads = True
+
+	def __init__(self, grid, socket_path=SOCKET_PATH):
+		"""Initialise the server on the (already open) grid, listening on the unix socket at socket_path
+		Raises an IOError if another server is already listening on the socket"""
+
+		#a socket file left behind by a server that did not shut down cleanly (nothing answers on it) is removed
+		if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+			connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				connection.connect(socket_path)
+			except socket.error:
+				os.remove(socket_path)
+			else:
+				raise IOError("A server is already listening on %s" % (socket_path,))
+			finally:
+				connection.close()
+
+		SocketServer.UnixStreamServer.__init__(self, socket_path, ProtocolRequestHandler)
+
+		self.grid = grid
+		self.socket_path = socket_path
+
+		#(-priority, job id, job) so that the highest priority runs first, then the earliest submitted
+		self.jobs = Queue.PriorityQueue()
+		self.job_ids = itertools.count(1)
+		self.running_job = None
+		self.lock = threading.Lock()
+
+		self.runner = threading.Thread(target=self.run_jobs)
+		self.runner.daemon = True
+
+	def start(self):
+		"""Start running the queued jobs (the camera is kept reading between jobs as well)"""
+
+		#open the arduino now so that the first protocol does not wait for it
+		self.grid.open_devices()
+
+		if self.grid.camera_in_use() and self.grid.camInput.grabber is None:
+			self.grid.camInput.start_grabber()
+
+		self.runner.start()
+
+	def submit(self, request):
+		"""Queue the request, returns the ServerJob"""
+
+		with self.lock:
+			job = ServerJob(next(self.job_ids), request)
+			job.send("queued", position=self.jobs.qsize() + (self.running_job is not None))
+			self.jobs.put((-job.priority, job.id, job))
+
+		return job
+
+	def get_status(self):
+		"""Return the running job and the queued jobs (in the order they will run)"""
+
+		with self.lock:
+			queued = sorted(self.jobs.queue)
+			running = self.running_job
+
+		return {
+			"event": "status",
+			"running": None if running is None else {"job": running.id, "file": running.file},
+			"queued": [{"job": job.id, "file": job.file, "priority": job.priority} for priority, job_id, job in queued],
+		}
+
+	def run_jobs(self):
+		"""Run the queued jobs one at a time"""
+
+		while True:
+			priority, job_id, job = self.jobs.get()
+
+			with self.lock:
+				self.running_job = job
+
+			self.run_job(job)
+
+			with self.lock:
+				self.running_job = None
+
+	def run_job(self, job):
+		"""Run the job on the grid, sending its progress to the client"""
+
+		grid = self.grid
+
+		try:
+			if job.file is not None:
+				try:
+					protocolCache.load_protocol(grid.ui, job.file)
+				except ValueError as e:
+					job.send("failed", error=e.args[0], errors=grid.ui.errors)
+					return
+				instructions = grid.ui.instruction_set
+			else:
+				instructions = job.instructions
+
+			job.send("started", waited=time.time() - job.queued_time)
+
+			grid.reset()
+			grid.progress = lambda completed, count: job.send("progress", completed=completed, instructions=count)
+
+			start = time.time()
+			completed = grid.run_program(instructions)
+			job.send("finished", run_time=time.time() - start, completed=completed)
+		except Exception as e:
+			job.send("failed", error="%s: %s" % (e.__class__.__name__, e))
+		finally:
+			grid.progress = None
+
+	def stop(self):
+		"""Stop serving (from another thread than serve_forever) and remove the socket file"""
+
+		self.shutdown()
+		self.server_close()
+
+		if self.grid.camera_in_use() and self.grid.camInput.grabber is not None:
+			self.grid.camInput.stop_grabber()
+
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+
+def submit(request, socket_path=SOCKET_PATH):
+	"""Send the request (a dictionary, see the top of this module) to the server
+	Yields each event (a dictionary) as it arrives"""
+
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	connection.connect(socket_path)
+
+	try:
+		connection.sendall(json.dumps(request) + "\n")
+
+		for line in connection.makefile("r"):
+			yield json.loads(line)
+	finally:
+		connection.close()
+
+
+if __name__=="__main__":
+	#run the server, or send user input files to it
+	import argparse
+	import droplet_program
+
+	parser = argparse.ArgumentParser(description="Run protocols on devices that are kept open")
+	parser.add_argument("--socket", default=SOCKET_PATH, help="the unix socket of the server (default %(default)s)")
+	commands = parser.add_subparsers(dest="command")
+
+	serve = commands.add_parser("serve", help="open the devices and run the protocols that are sent")
+	serve.add_argument("--virtual", action="store_true", help="use a virtual device (see virtualDevice)")
+
+	send = commands.add_parser("submit", help="run a user input file on the server and show its progress")
+	send.add_argument("file", help="the user input file")
+	send.add_argument("--priority", type=int, default=0, help="higher priorities run first (default 0)")
+
+	commands.add_parser("status", help="show the running and queued protocols")
+
+	args = parser.parse_args()
+
+	if args.command == "serve":
+		if args.virtual:
+			import arduinoComms
+			import cameraInput
+			import virtualDevice
+
+			simulator = virtualDevice.DropletSimulator()
+			arduino = virtualDevice.VirtualArduino(simulator)
+			grid = droplet_program.Grid(arduinoComms.ArduinoCommunication(arduino.port_name), cameraInput.CameraInput(capture=virtualDevice.VirtualCamera(simulator)))
+			grid.clock = virtualDevice.ScaledClock(100)
+		else:
+			grid = droplet_program.Grid()
+
+		server = ProtocolServer(grid, args.socket)
+		server.start()
+		print "Listening on %s" % (args.socket,)
+
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			if os.path.exists(args.socket):
+				os.remove(args.socket)
+
+	elif args.command == "status":
+		for event in submit({"status": True}, args.socket):
+			print json.dumps(event)
+
+	else:
+		for event in submit({"file": os.path.abspath(args.file), "priority": args.priority}, args.socket):
+			print json.dumps(event)
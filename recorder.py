@@ -0,0 +1,382 @@
+"""This module records the serial traffic and camera frames of a run so that the run can be replayed without the device
+The recording is an append only log that is memory mapped (so recording a frame is a copy into memory, not a system call),
+the file grows in large chunks and is cut down to its used size when the recording is closed
+
+The log is laid out as "DRL" + format version (1 byte), followed by the records:
+	kind (1 byte) + time recorded (8 byte float) + size of the data (4 bytes) + the data
+	kinds:	1 serial bytes written / 2 serial bytes read / 3 camera frame (height, width, channels (2 bytes each) + the pixels)
+		4 the arduino (its version reply;maxX,maxY,longest message,1 if it takes sparse frames else 0)
+A kind of 0 (the unused end of the file) ends the log, all numbers are little endian
+
+On replay the bytes read and the frames are given back in the same order relative to the bytes written as they were recorded,
+as soon as the program has written the bytes they followed (rather than at the recorded times), so a replay
+with a fast clock (e.g. virtualDevice.ScaledClock) runs the same steps as the recording without waiting on the device"""
+
+import mmap
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = "DRL"
+VERSION = 1
+
+RECORD = struct.Struct("<BdI")
+FRAME = struct.Struct("<HHH")
+
+SERIAL_WRITE = 1
+SERIAL_READ = 2
+FRAME_READ = 3
+ARDUINO = 4
+
+class Recorder:
+	"""Writes the serial traffic and camera frames to a memory mapped log
+	Give it to SerialCommunication.recorder and CameraInput.recorder (or use attach)"""
+
+	def __init__(self, filename, chunk_size=16 * 1024 * 1024):
+		"""Start a new log in the file (any old log in the file is lost)
+		The file is grown by at least chunk_size bytes at a time"""
+
+		self.chunk_size = chunk_size
+		self.lock = threading.Lock()
+
+		self.file = open(filename, "w+b")
+		self.file.write(struct.pack("<3sB", MAGIC, VERSION))
+		self.file.flush()
+
+		self.offset = len(MAGIC) + 1
+		self.size = 0
+		self.map = None
+		self.grow(chunk_size)
+
+	def grow(self, needed):
+		"""Make the file (and the mapping) big enough for needed more bytes"""
+
+		if self.map is not None:
+			self.map.flush()
+			self.map.close()
+
+		self.size = max(self.size * 2, self.offset + needed, self.chunk_size)
+		self.file.truncate(self.size)
+		self.map = mmap.mmap(self.file.fileno(), self.size)
+
+	def append(self, kind, data, timestamp=None):
+		"""Add a record to the end of the log"""
+
+		if timestamp is None:
+			timestamp = time.time()
+
+		with self.lock:
+			end = self.offset + RECORD.size + len(data)
+			if end > self.size:
+				self.grow(RECORD.size + len(data))
+
+			RECORD.pack_into(self.map, self.offset, kind, timestamp, len(data))
+			self.map[self.offset + RECORD.size:end] = data
+			self.offset = end
+
+	def record_write(self, data):
+		"""Record bytes written to the serial port"""
+
+		self.append(SERIAL_WRITE, str(data))
+
+	def record_read(self, data):
+		"""Record bytes read from the serial port"""
+
+		self.append(SERIAL_READ, str(data))
+
+	def record_frame(self, img, timestamp=None):
+		"""Record a frame read from the camera (a numpy image, grey or colour)"""
+
+		channels = 0
+		if img.ndim == 3:
+			channels = img.shape[2]
+
+		self.append(FRAME_READ, FRAME.pack(img.shape[0], img.shape[1], channels) + np.ascontiguousarray(img, np.uint8).tostring(), timestamp)
+
+	def record_arduino(self, arduino_comm):
+		"""Record the version and descriptor of the arduino, so that the replay sends the same messages"""
+
+		self.append(ARDUINO, "%s;%i,%i,%i,%i" % (arduino_comm.arduino_version, arduino_comm.maxX, arduino_comm.maxY, arduino_comm.max_message, arduino_comm.sparse_frames))
+
+	def attach(self, grid):
+		"""Record the arduino, its serial traffic and (if the camera is in use) the frames of the grid"""
+
+		self.record_arduino(grid.arduino_comm)
+		grid.arduino_comm.serial.recorder = self
+		if grid.camera_in_use():
+			grid.camInput.recorder = self
+
+	def close(self):
+		"""Finish the log, cutting the file down to the records"""
+
+		with self.lock:
+			self.map.flush()
+			self.map.close()
+			self.map = None
+			self.file.truncate(self.offset)
+			self.file.close()
+
+
+def read_log(filename):
+	"""Read the records of the log
+	Returns a list of (kind, time, data), the frames are numpy images (the data of the others is a string)
+	The file is memory mapped rather than read, so the frames are only read from the file as they are used
+	Raises a ValueError if the file is not a log"""
+
+	with open(filename, "rb") as log_file:
+		log_file.seek(0, 2)
+		if log_file.tell() < len(MAGIC) + 1:
+			raise ValueError("%s is not a recording" % (filename,))
+
+		#the mapping stays open for as long as any of the frames (which are views of it) are in use
+		data = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	if data[0:len(MAGIC)] != MAGIC or ord(data[len(MAGIC)]) != VERSION:
+		raise ValueError("%s is not a recording" % (filename,))
+
+	records = []
+	offset = len(MAGIC) + 1
+
+	while offset + RECORD.size <= len(data):
+		kind, timestamp, size = RECORD.unpack_from(data, offset)
+		if kind == 0:
+			break
+
+		start = offset + RECORD.size
+		offset = start + size
+
+		if kind == FRAME_READ:
+			height, width, channels = FRAME.unpack_from(data, start)
+			shape = (height, width, channels) if channels > 0 else (height, width)
+			records.append((kind, timestamp, np.frombuffer(data, np.uint8, height * width * max(channels, 1), start + FRAME.size).reshape(shape)))
+		else:
+			records.append((kind, timestamp, data[start:offset]))
+
+	return records
+
+
+class Replay:
+	"""Plays a recording back in place of the serial port and the camera
+	Use connection as the connection of an ArduinoCommunication and capture as the capture of a CameraInput"""
+
+	def __init__(self, filename):
+		"""Load the recording"""
+
+		records = read_log(filename)
+
+		#the bytes written, and the bytes read and frames with the number of writes that came before them
+		self.writes = []
+		self.reads = []
+		self.frames = []
+		#the version reply and (maxX, maxY, longest message, sparse frames) of the recorded arduino, None in older recordings
+		self.arduino_version = None
+		self.descriptor = None
+
+		for kind, timestamp, data in records:
+			if kind == SERIAL_WRITE:
+				self.writes.append(data)
+			elif kind == SERIAL_READ:
+				self.reads.append((len(self.writes), data))
+			elif kind == FRAME_READ:
+				self.frames.append((len(self.writes), data))
+			elif kind == ARDUINO:
+				self.arduino_version, sep, descriptor = data.rpartition(";")
+				self.descriptor = tuple(int(value) for value in descriptor.split(","))
+
+		if records != []:
+			self.recorded_time = records[-1][1] - records[0][1]
+		else:
+			self.recorded_time = 0.0
+
+		#how far through the recording the replay is
+		self.write_count = 0
+		self.read_count = 0
+		self.frame_count = 0
+		#the writes that were not the same as the recording
+		self.mismatches = []
+
+		self.lock = threading.Lock()
+		self.connection = ReplayConnection(self)
+		self.capture = ReplayCapture(self)
+
+	def write(self, data):
+		"""Check the bytes written against the recording"""
+
+		with self.lock:
+			if self.write_count >= len(self.writes) or self.writes[self.write_count] != data:
+				self.mismatches.append((self.write_count, data))
+			self.write_count += 1
+
+	def take_reads(self):
+		"""Return the bytes read that are due after the bytes written so far"""
+
+		with self.lock:
+			data = []
+			while self.read_count < len(self.reads) and self.reads[self.read_count][0] <= self.write_count:
+				data.append(self.reads[self.read_count][1])
+				self.read_count += 1
+
+		return "".join(data)
+
+	def take_frame(self):
+		"""Return the newest frame that is due after the bytes written so far (None if there is none yet)"""
+
+		with self.lock:
+			while self.frame_count < len(self.frames) and self.frames[self.frame_count][0] <= self.write_count:
+				self.frame_count += 1
+
+			if self.frame_count == 0:
+				return None
+			return self.frames[self.frame_count - 1][1]
+
+	def is_complete(self):
+		"""Check whether every write, read and frame in the recording has been replayed"""
+
+		return self.write_count == len(self.writes) and self.read_count == len(self.reads) and self.frame_count == len(self.frames)
+
+
+class ReplayConnection:
+	"""A serial connection (with the pyserial read, write and inWaiting methods) that plays back the recorded bytes"""
+
+	def __init__(self, replay):
+		"""Initialise the connection on the replay"""
+
+		self.replay = replay
+		self.buffer = ""
+
+	def inWaiting(self):
+		"""The number of bytes that are ready to be read"""
+
+		self.buffer += self.replay.take_reads()
+		return len(self.buffer)
+
+	def read(self, size=1):
+		"""Read up to size bytes"""
+
+		if len(self.buffer) < size:
+			self.buffer += self.replay.take_reads()
+
+		data = self.buffer[:size]
+		self.buffer = self.buffer[size:]
+		return data
+
+	def write(self, data):
+		"""Check the bytes against the recording"""
+
+		self.replay.write(data)
+
+	def close(self):
+		"""Nothing to close"""
+
+		pass
+
+
+class ReplayCapture:
+	"""A capture (used in place of cv2.VideoCapture) that plays back the recorded frames"""
+
+	def __init__(self, replay):
+		"""Initialise the capture on the replay"""
+
+		self.replay = replay
+
+	def read(self):
+		"""Return the newest recorded frame that is due (in the same way as cv2.VideoCapture.read)"""
+
+		frame = self.replay.take_frame()
+		if frame is None:
+			return False, None
+
+		return True, frame.copy()
+
+	def release(self):
+		"""Nothing to release"""
+
+		pass
+
+
+if __name__=="__main__":
+	#record a run (on the arduino and camera, or a virtual device) or replay a recording
+	import argparse
+	import arduinoComms
+	import cameraInput
+	import droplet_program
+	import virtualDevice
+
+	parser = argparse.ArgumentParser(description="Record a run or replay a recording")
+	parser.add_argument("mode", choices=["record", "replay", "info"], help="what to do with the recording")
+	parser.add_argument("recording", help="the recording file")
+	parser.add_argument("file", nargs="?", help="the user input file to run (record and replay)")
+	parser.add_argument("--virtual", action="store_true", help="record a virtual device rather than the arduino and camera")
+	parser.add_argument("--closed-loop", action="store_true", help="wait for the camera to see the droplets arrive (the same for record and replay)")
+	parser.add_argument("--speed", type=float, default=1000, help="how many times faster than real time the replay waits (default %(default)g)")
+	args = parser.parse_args()
+
+	if args.mode == "info":
+		records = read_log(args.recording)
+		for kind, name in [(SERIAL_WRITE, "serial writes"), (SERIAL_READ, "serial reads"), (FRAME_READ, "frames")]:
+			print "%s: %i" % (name, len([record for record in records if record[0] == kind]))
+		if records != []:
+			print "recorded time: %.2f s" % (records[-1][1] - records[0][1],)
+
+	elif args.file is None:
+		parser.error("the user input file is needed to record or replay")
+
+	elif args.mode == "record":
+		if args.virtual:
+			simulator = virtualDevice.DropletSimulator()
+			arduino = virtualDevice.VirtualArduino(simulator)
+			grid = droplet_program.Grid(arduinoComms.ArduinoCommunication(arduino.port_name), cameraInput.CameraInput(capture=virtualDevice.VirtualCamera(simulator)))
+			grid.clock = virtualDevice.ScaledClock(100)
+		else:
+			grid = droplet_program.Grid()
+
+		grid.closed_loop = args.closed_loop
+
+		if grid.load_program(args.file):
+			if args.virtual:
+				#the droplets are put onto the simulated grid as the program adds them
+				grid.droplet_added = lambda droplet: simulator.add_droplet(droplet.position["x"], droplet.position["y"])
+
+			recorder = Recorder(args.recording)
+			recorder.attach(grid)
+
+			start = time.time()
+			grid.run_program()
+			#the replies to the last commands
+			time.sleep(0.1)
+			grid.arduino_comm.check_replies()
+			recorder.close()
+
+			print "Recorded %.2f s to %s" % (time.time() - start, args.recording)
+
+		if args.virtual:
+			arduino.close()
+
+	else:
+		replay = Replay(args.recording)
+
+		arduino_comm = arduinoComms.ArduinoCommunication("", connection=replay.connection, version=replay.arduino_version)
+		if replay.descriptor is not None:
+			maxX, maxY, max_message, sparse_frames = replay.descriptor
+			if sparse_frames:
+				arduino_comm.set_descriptor(maxX, maxY, max_message)
+			else:
+				arduino_comm.maxX = maxX
+				arduino_comm.maxY = maxY
+
+		grid = droplet_program.Grid(arduino_comm, cameraInput.CameraInput(capture=replay.capture))
+		grid.clock = virtualDevice.ScaledClock(args.speed)
+		grid.closed_loop = args.closed_loop
+
+		if grid.load_program(args.file):
+			start = time.time()
+			grid.run_program()
+			grid.arduino_comm.check_replies()
+
+			print "Replayed %.2f s of recording in %.3f s" % (replay.recorded_time, time.time() - start)
+			print "Writes: %i of %i, different from the recording: %i" % (replay.write_count, len(replay.writes), len(replay.mismatches))
+			for index, data in replay.mismatches[:10]:
+				print "  write %i: %r" % (index, data)
+			print "Replayed the whole recording" if replay.is_complete() else "The recording was not all replayed"
@@ -0,0 +1,195 @@
+"""This module turns the sequential instruction set into a dependency graph
+Instructions only depend on the earlier instructions that used the same droplets,
+so instructions on different droplets can be run at the same time
+WAIT instructions become timed dependencies rather than pausing the whole program"""
+
+import time
+
+from userInput import Instructions
+import userInput
+import telemetry
+
+#the name of each instruction (for the telemetry)
+INSTRUCTION_NAMES = dict((value, name) for name, value in vars(Instructions).items() if isinstance(value, int))
+
+class Node:
+	"""A single instruction in the dependency graph"""
+
+	def __init__(self, index, instruction):
+		"""Initialise object state"""
+
+		self.index = index
+		self.instruction = instruction
+		#the nodes that cannot start until this one is complete
+		self.dependents = []
+		#the number of nodes that have to complete before this one can start
+		self.waiting_on = 0
+		self.dispatched = False
+		#the (wall clock) time the node was dispatched, from telemetry.start (None when the telemetry is not recording)
+		self.dispatch_time = None
+		self.complete = False
+		#the droplet names that this node is the last use of (when it was added)
+		self.droplets = []
+
+
+class InstructionGraph:
+	"""Dependency graph of an instruction set, keyed on the droplet names used by each instruction"""
+
+	def __init__(self, instruction_set, keep_nodes=True):
+		"""Build the graph from the instruction set
+		More instructions can be added later (see Scheduler.add), if keep_nodes is False the nodes are not
+		kept in self.nodes, so the memory used does not grow with the number of instructions"""
+
+		self.nodes = []
+		self.keep_nodes = keep_nodes
+		self.size = 0
+		#the node that last used each droplet name
+		self.last_use = {}
+		#the droplets that exist at the current point in the instruction set
+		self.live_droplets = set()
+		self.ui = userInput.UserInput()
+
+		for instruction in instruction_set:
+			self.add(instruction)
+
+	def add(self, instruction):
+		"""Add the next instruction of the instruction set to the graph"""
+
+		node = Node(self.size, instruction)
+		self.size += 1
+		if self.keep_nodes:
+			self.nodes.append(node)
+
+		if instruction[0] == Instructions.WAIT:
+			#a wait holds back every droplet that exists at this point in the instruction set
+			used = list(self.live_droplets)
+			defined = []
+			for droplet in used:
+				self.depend_on(node, self.last_use.get(droplet))
+				self.last_use[droplet] = node
+			node.droplets = used
+		else:
+			used, defined = self.ui.get_droplet_names(instruction[0], instruction[1])
+
+			#depend on the last instruction that used any of the droplets (including names being reused)
+			for droplet in used + defined:
+				self.depend_on(node, self.last_use.get(droplet))
+				self.last_use[droplet] = node
+			node.droplets = used + defined
+
+			for droplet in used:
+				self.live_droplets.discard(droplet)
+			for droplet in defined:
+				self.live_droplets.add(droplet)
+
+			#moving a droplet does not get rid of it
+			if instruction[0] == Instructions.MOVE:
+				self.live_droplets.add(instruction[1][0])
+
+		return node
+
+	def release(self, node):
+		"""Forget the complete node as the last use of its droplets (nothing has to wait for it any more)"""
+
+		for droplet in node.droplets:
+			if self.last_use.get(droplet) is node:
+				del self.last_use[droplet]
+
+	def depend_on(self, node, parent):
+		"""Make node depend on parent"""
+
+		if parent is not None and parent is not node and not parent.complete and node not in parent.dependents:
+			parent.dependents.append(node)
+			node.waiting_on += 1
+
+
+class Scheduler:
+	"""Hands out the instructions of an InstructionGraph as soon as their dependencies are complete"""
+
+	def __init__(self, graph, clock=time):
+		"""Initialise the scheduler
+		clock is any object with time() and sleep() functions (the time module by default)"""
+
+		self.graph = graph
+		self.clock = clock
+		#the instructions that are ready to be dispatched
+		self.ready_nodes = [node for node in graph.nodes if node.waiting_on == 0]
+		#the WAIT instructions that are counting down as (finish time, node)
+		self.timers = []
+		self.remaining = len(graph.nodes)
+
+	def ready(self):
+		"""Return the list of instructions that can be run now
+		WAIT instructions are never returned, they are completed by the scheduler once their time is up"""
+
+		now = self.clock.time()
+
+		#complete any waits that have finished
+		for timer in list(self.timers):
+			if timer[0] <= now:
+				self.timers.remove(timer)
+				self.complete(timer[1])
+
+		nodes = []
+		while self.ready_nodes != []:
+			node = self.ready_nodes.pop(0)
+			node.dispatched = True
+			#timed on the wall clock, the scheduler clock may be faster than real time (e.g. a virtual device)
+			node.dispatch_time = telemetry.start()
+
+			if node.instruction[0] == Instructions.WAIT:
+				self.timers.append((now + float(node.instruction[1][0]), node))
+			else:
+				nodes.append(node)
+
+		#the waits that were just started may already be complete (e.g. WAIT 0)
+		if nodes == [] and any(timer[0] <= now for timer in self.timers):
+			return self.ready()
+
+		return nodes
+
+	def add(self, instruction):
+		"""Add the next instruction of the instruction set, so the instructions can be given a few at a time as they are read
+		Returns the node of the instruction"""
+
+		node = self.graph.add(instruction)
+		self.remaining += 1
+
+		if node.waiting_on == 0:
+			self.ready_nodes.append(node)
+
+		return node
+
+	def complete(self, node):
+		"""Mark the instruction as complete, releasing any instructions that depend on it"""
+
+		node.complete = True
+		self.remaining -= 1
+
+		if node.dispatch_time is not None:
+			telemetry.stop("instruction." + INSTRUCTION_NAMES[node.instruction[0]], node.dispatch_time)
+		self.graph.release(node)
+
+		for dependent in node.dependents:
+			dependent.waiting_on -= 1
+			if dependent.waiting_on == 0:
+				self.ready_nodes.append(dependent)
+
+	def next_timer(self):
+		"""Return the time at which the next WAIT instruction finishes (None if there are no waits running)"""
+
+		if self.timers == []:
+			return None
+		return min(timer[0] for timer in self.timers)
+
+	def wait_for_timer(self):
+		"""Sleep until the next WAIT instruction finishes"""
+
+		finish = self.next_timer()
+		if finish is not None:
+			self.clock.sleep(max(0, finish - self.clock.time()))
+
+	def done(self):
+		"""Check whether every instruction has been completed"""
+
+		return self.remaining == 0
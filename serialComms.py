@@ -10,28 +10,38 @@ class SerialCommunication:
 	Maintains a connection to the port
 	"""
 	
-	def __init__(self, port_name="/dev/ttyUSB1"):
+	def __init__(self, port_name="/dev/ttyUSB1", baudrate=9600, connection=None):
 		"""Setup the serial port
-		Return a connection object"""
+		Return a connection object
+		An already open connection object can be given instead (anything with the pyserial read, write and inWaiting methods)"""
+
+		#the buffer of bytes that have been read but not yet returned as complete commands
+		self.input = bytearray()
+		#the position in the buffer where the next command starts
+		self.input_start = 0
+		#the position in the buffer up to which there is no \r\n (so it does not need searching again)
+		self.input_scanned = 0
+		#every byte written and read is given to the recorder if there is one (see recorder.Recorder)
+		self.recorder = None
+		
+		if connection is not None:
+			#the given connection is already open and ready
+			self.connection = connection
+			return
 		
 		self.connection = serial.Serial()
 		
 		# setup the details for the connection
 		self.connection.port = port_name
-		self.connection.baudrate = 9600
+		self.connection.baudrate = baudrate
 		self.connection.bytesize = serial.EIGHTBITS
 		self.connection.parity = serial.PARITY_NONE
 		self.connection.stopbits = serial.STOPBITS_ONE
-
-		#set the class attribute called input to be an empty string
-		self.input=""
 		
 		#open the serial connection for the duration that this object is existing
+		#(opening the port resets the arduino, see ArduinoCommunication.wait_until_ready for waiting until it has started)
 		self.connection.open()
 		
-		#wait for 2 seconds before sending any instructions over the serial connection
-		time.sleep(2)
-		
 	def __del__(self):
 		"""Close the serial connection"""
 		
@@ -39,30 +49,57 @@ class SerialCommunication:
 
 	def read(self):
 		"""Read any serial characters that are waiting
-		Return all characters that are read"""
+		Return the list of complete commands that have been read (any incomplete command is kept for the next read)"""
+		
+		#read everything that is waiting in one go
+		waiting = self.connection.inWaiting()
+		if waiting > 0:
+			data = self.connection.read(waiting)
+			self.input.extend(data)
+			
+			if self.recorder is not None:
+				self.recorder.record_read(data)
 		
-		while self.connection.inWaiting() > 0:
-			self.input += self.connection.read(1)
+		command_list = []
 		
-		command_list = self.input.split("\r\n")
+		#split off each complete command, only searching the bytes that have not been searched before
+		end = self.input.find("\r\n", self.input_scanned)
+		while end != -1:
+			command_list.append(bytes(self.input[self.input_start:end]))
+			self.input_start = end + 2
+			end = self.input.find("\r\n", self.input_start)
 		
-		#store the last command (incomplete command) back into the input string
-		self.input = command_list[-1]
+		#the last byte may be the \r of a command that has not fully arrived yet
+		self.input_scanned = max(self.input_start, len(self.input) - 1)
 		
-		#return the list of all the commands except the last element (the incomplete command)
-		return command_list[:-1]
+		#drop the returned commands from the buffer once they make up most of it,
+		#so the incomplete command is only moved occasionally rather than on every read
+		if self.input_start > len(self.input) // 2:
+			del self.input[:self.input_start]
+			self.input_scanned -= self.input_start
+			self.input_start = 0
+		
+		return command_list
 	
 	def write(self, command):
 		"""Write the command to the serial output (making sure that it complies with the protocol)
 		"""
 		
-		self.connection.write("%s\r\n" % (command,) )
+		data = "%s\r\n" % (command,)
+		
+		if self.recorder is not None:
+			self.recorder.record_write(data)
+		
+		self.connection.write(data)
 		
 		
 if __name__=="__main__":
 
 	serial_obj = SerialCommunication("/dev/ttyACM0")
 	
+	#give the arduino time to start after the reset
+	time.sleep(2)
+	
 	commands = ["VER","S21", "C54", "CAP"]
 	
 	# attempt to send the above commands over serial communication
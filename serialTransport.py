@@ -0,0 +1,245 @@
+"""This module is part of the arduino communication section
+It adds a transport layer on top of the SerialCommunication class so that several commands can be in flight at once
+Each command is tagged with a sequence number that the arduino sends back in its reply (e.g. S44:1F -> ACK S44:1F)
+A background thread reads the replies, matches them to the commands and retransmits any commands that are not answered in time"""
+
+import collections
+import threading
+import time
+
+class CommandFuture:
+	"""Holds the result of a command that has been sent to the arduino
+	The result is the reply from the arduino (without the sequence number)"""
+
+	def __init__(self, command):
+		"""Initialise object state"""
+
+		self.command = command
+		self.reply = None
+		self.error = None
+		self.callbacks = []
+		self.event = threading.Event()
+		self.sent_time = 0
+		self.attempts = 0
+		#the position of the command in the order the commands were sent
+		self.order = 0
+
+	def done(self):
+		"""Check whether the command has been answered (or has failed)"""
+
+		return self.event.is_set()
+
+	def result(self, timeout=None):
+		"""Wait for the reply to the command and return it
+		Raises the error if the command failed"""
+
+		if not self.event.wait(timeout):
+			raise IOError("Timed out waiting for the reply to %s" % (self.command,))
+
+		if self.error is not None:
+			raise self.error
+
+		return self.reply
+
+	def add_done_callback(self, callback):
+		"""Call the callback with this future once the command has been answered (or has failed)"""
+
+		if self.done():
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+
+	def set_result(self, reply):
+		"""Set the reply to the command"""
+
+		self.reply = reply
+		self.finish()
+
+	def set_error(self, error):
+		"""Set the command as failed"""
+
+		self.error = error
+		self.finish()
+
+	def finish(self):
+		"""Wake up anything waiting for the command and run the callbacks"""
+
+		self.event.set()
+
+		for callback in self.callbacks:
+			callback(self)
+
+
+class SerialTransport:
+	"""Sends commands with sequence numbers and matches the replies from a background reader thread
+	At most window commands are in flight at once, sending another one waits for a free slot"""
+
+	def __init__(self, serial_comm, window=8, timeout=0.25, retries=3, poll_interval=0.001, resync=None, max_unexpected=32):
+		"""Initialise the transport on an open SerialCommunication object
+		timeout is the time in seconds to wait for a reply before retransmitting the command,
+		a command fails once it has been retransmitted retries times
+		resync is called with a command that has timed out after later commands were sent, sending it again would undo
+		them so it returns the commands to send in its place (e.g. the whole plate state), or None to send it again
+		Only the last max_unexpected unexpected replies are kept"""
+
+		self.serial = serial_comm
+		self.window = window
+		self.timeout = timeout
+		self.retries = retries
+		self.poll_interval = poll_interval
+		self.resync = resync
+
+		#sequence numbers are two hex characters, the window has to be smaller than that to keep them unique
+		if window < 1 or window > 128:
+			raise ValueError("The window must be between 1 and 128 commands")
+
+		self.sequence = 0
+		#the number of commands sent so far, to order them
+		self.sent = 0
+		#the commands that are waiting for a reply, sequence number -> future
+		self.in_flight = {}
+		self.unexpected = collections.deque(maxlen=max_unexpected)
+
+		self.lock = threading.Condition()
+		self.running = False
+		self.thread = None
+
+	def start(self):
+		"""Start the background reader thread"""
+
+		self.running = True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		"""Stop the background reader thread, any commands still in flight fail"""
+
+		self.running = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+		with self.lock:
+			for sequence in list(self.in_flight.keys()):
+				self.fail(sequence, IOError("The transport was stopped before %s was answered" % (self.in_flight[sequence].command,)))
+
+	def send(self, command):
+		"""Send the command and return a CommandFuture for its reply
+		Waits for a free slot if the window is full"""
+
+		with self.lock:
+			while len(self.in_flight) >= self.window:
+				self.lock.wait()
+
+			return self.add(command)
+
+	def add(self, command):
+		"""Send the command without waiting for a free slot and return its CommandFuture (the lock must be held)"""
+
+		future = CommandFuture(command)
+		future.order = self.sent
+		self.sent += 1
+
+		sequence = "%02X" % (self.sequence,)
+		self.sequence = (self.sequence + 1) % 256
+
+		self.in_flight[sequence] = future
+		self.transmit(sequence, future)
+
+		return future
+
+	def transmit(self, sequence, future):
+		"""Write the command with its sequence number to the serial port (the lock must be held)"""
+
+		future.attempts += 1
+		future.sent_time = time.time()
+		self.serial.write("%s:%s" % (future.command, sequence))
+
+	def fail(self, sequence, error):
+		"""Fail the command with the given sequence number (the lock must be held)"""
+
+		future = self.in_flight.pop(sequence)
+		self.lock.notify_all()
+		future.set_error(error)
+
+	def run(self):
+		"""The reader thread: match replies to their commands and retransmit any commands that have timed out"""
+
+		while self.running:
+			for msg in self.serial.read():
+				self.handle_reply(msg)
+
+			self.check_timeouts()
+
+			time.sleep(self.poll_interval)
+
+	def handle_reply(self, msg):
+		"""Match a reply from the arduino to the command it answers"""
+
+		reply, sep, sequence = msg.rpartition(":")
+
+		with self.lock:
+			future = self.in_flight.get(sequence)
+
+			if sep == "" or future is None:
+				#either not a reply to a tagged command or the reply to a command that has already been answered
+				self.unexpected.append(msg)
+				return
+
+			del self.in_flight[sequence]
+			self.lock.notify_all()
+
+		future.set_result(reply)
+
+	def check_timeouts(self):
+		"""Retransmit any commands that have not been answered in time, failing them once they run out of retries
+		A command that has later commands sent after it is replaced by the commands from resync (if it gives any),
+		so that it is not applied after them"""
+
+		now = time.time()
+		#commands sent in place of timed out commands, so that commands replaced by the same ones share them
+		resent = {}
+
+		with self.lock:
+			for sequence in sorted(self.in_flight.keys(), key=lambda sequence: self.in_flight[sequence].order):
+				future = self.in_flight[sequence]
+
+				if now - future.sent_time <= self.timeout:
+					continue
+
+				if future.attempts > self.retries:
+					self.fail(sequence, IOError("No reply from the arduino to %s" % (future.command,)))
+					continue
+
+				commands = None
+				if self.resync is not None and future.order < self.sent - 1:
+					commands = self.resync(future.command)
+
+				if commands is None:
+					self.transmit(sequence, future)
+					continue
+
+				#the command is answered by the reply to the last of the commands sent in its place
+				del self.in_flight[sequence]
+				self.lock.notify_all()
+
+				commands = tuple(commands)
+				if commands not in resent:
+					resent[commands] = [self.add(command) for command in commands]
+					for replacement in resent[commands]:
+						replacement.attempts += future.attempts - 1
+				replacements = resent[commands]
+
+				if replacements == []:
+					future.set_result(None)
+				else:
+					replacements[-1].add_done_callback(lambda replacement, future=future: self.replaced(future, replacement))
+
+	def replaced(self, future, replacement):
+		"""Answer a command that was replaced after timing out with the result of its replacement"""
+
+		if replacement.error is not None:
+			future.set_error(replacement.error)
+		else:
+			future.set_result(replacement.reply)
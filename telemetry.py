@@ -0,0 +1,209 @@
+"""This module records how long the parts of the program take (instructions, serial commands, camera stages and steps)
+Timings are added to histograms with fixed buckets, so recording a value costs the same however many are recorded
+Nothing is recorded unless enabled is True, each timing point then only costs a check of the flag
+
+The histograms can be written as JSON lines (one line per metric, appended so that a file builds up a history)
+or as a Prometheus text file (for the node exporter textfile collector)"""
+
+import json
+import math
+import os
+import threading
+import time
+
+#set to True (or call enable) to start recording
+enabled = False
+
+#the upper bound of the smallest bucket in seconds, each bucket is twice the size of the one before
+BUCKET_START = 0.00001
+BUCKET_COUNT = 28
+
+class Histogram:
+	"""Counts the values recorded into buckets that double in size, along with their count, sum, minimum and maximum"""
+
+	def __init__(self):
+		"""Initialise an empty histogram"""
+
+		self.buckets = [0] * (BUCKET_COUNT + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+
+	def observe(self, value):
+		"""Record the value"""
+
+		#the exponent of value / BUCKET_START is the index of the first bucket whose upper bound is not below the value
+		if value <= BUCKET_START:
+			index = 0
+		else:
+			mantissa, exponent = math.frexp(value / BUCKET_START)
+			index = min(exponent - (mantissa == 0.5), BUCKET_COUNT)
+
+		self.buckets[index] += 1
+		self.count += 1
+		self.sum += value
+
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def get_bounds(self):
+		"""Return the upper bound of each bucket (the last bucket has no upper bound)"""
+
+		return [BUCKET_START * 2 ** index for index in range(0, BUCKET_COUNT)] + [float("inf")]
+
+
+class Registry:
+	"""Holds the histograms and counters by name"""
+
+	def __init__(self):
+		"""Initialise an empty registry"""
+
+		self.histograms = {}
+		self.counters = {}
+		self.lock = threading.Lock()
+
+	def observe(self, name, value):
+		"""Record the value in the named histogram"""
+
+		with self.lock:
+			histogram = self.histograms.get(name)
+			if histogram is None:
+				histogram = self.histograms[name] = Histogram()
+			histogram.observe(value)
+
+	def count(self, name, amount=1):
+		"""Add to the named counter"""
+
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def clear(self):
+		"""Forget everything that has been recorded"""
+
+		with self.lock:
+			self.histograms = {}
+			self.counters = {}
+
+
+registry = Registry()
+
+def enable(on=True):
+	"""Start (or stop) recording"""
+
+	global enabled
+	enabled = on
+
+
+def observe(name, value):
+	"""Record a value (a time in seconds) in the named histogram"""
+
+	if enabled:
+		registry.observe(name, value)
+
+
+def count(name, amount=1):
+	"""Add to the named counter"""
+
+	if enabled:
+		registry.count(name, amount)
+
+
+def start():
+	"""Return the time to time something from (None when not recording), to be passed to stop"""
+
+	if enabled:
+		return time.time()
+	return None
+
+
+def stop(name, start_time):
+	"""Record the time since start_time (from start) in the named histogram"""
+
+	if start_time is not None:
+		registry.observe(name, time.time() - start_time)
+
+
+def export_jsonl(filename):
+	"""Append a line of JSON for each histogram and counter to the file"""
+
+	now = time.time()
+
+	with registry.lock:
+		lines = []
+		for name, histogram in sorted(registry.histograms.items()):
+			lines.append({
+				"time": now,
+				"name": name,
+				"type": "histogram",
+				"count": histogram.count,
+				"sum": histogram.sum,
+				"min": histogram.min,
+				"max": histogram.max,
+				#the upper bound of each bucket that has values in it -> the number of values
+				"buckets": dict(("%g" % (bound,), bucket) for bound, bucket in zip(histogram.get_bounds(), histogram.buckets) if bucket > 0),
+			})
+		for name, value in sorted(registry.counters.items()):
+			lines.append({"time": now, "name": name, "type": "counter", "value": value})
+
+	with open(filename, "a") as output:
+		for line in lines:
+			output.write(json.dumps(line) + "\n")
+
+
+def get_metric_name(name):
+	"""The Prometheus name of a metric (letters, digits and underscores only)"""
+
+	return "droplet_" + "".join(character if character.isalnum() else "_" for character in name)
+
+
+def export_prometheus(filename):
+	"""Write the histograms and counters to the file in the Prometheus text format
+	The file is written in full and then renamed over the old one, so it is never read half written"""
+
+	lines = []
+
+	with registry.lock:
+		for name, histogram in sorted(registry.histograms.items()):
+			metric = get_metric_name(name) + "_seconds"
+			lines.append("# TYPE %s histogram" % (metric,))
+
+			#the buckets are cumulative
+			total = 0
+			for bound, bucket in zip(histogram.get_bounds(), histogram.buckets):
+				total += bucket
+				lines.append('%s_bucket{le="%s"} %i' % (metric, "+Inf" if math.isinf(bound) else "%g" % (bound,), total))
+
+			lines.append("%s_sum %r" % (metric, histogram.sum))
+			lines.append("%s_count %i" % (metric, histogram.count))
+
+		for name, value in sorted(registry.counters.items()):
+			metric = get_metric_name(name) + "_total"
+			lines.append("# TYPE %s counter" % (metric,))
+			lines.append("%s %i" % (metric, value))
+
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w") as output:
+		output.write("\n".join(lines) + "\n")
+	os.rename(temp_filename, filename)
+
+
+def export(filename):
+	"""Write the metrics to the file, as a Prometheus text file if the name ends in .prom, otherwise as JSON lines"""
+
+	if filename.endswith(".prom"):
+		export_prometheus(filename)
+	else:
+		export_jsonl(filename)
+
+
+def print_summary():
+	"""Print the count, mean and maximum of each histogram and the value of each counter"""
+
+	with registry.lock:
+		for name, histogram in sorted(registry.histograms.items()):
+			print "%-28s %8i x  mean %9.3f ms  max %9.3f ms" % (name, histogram.count, histogram.sum / histogram.count * 1000, histogram.max * 1000)
+		for name, value in sorted(registry.counters.items()):
+			print "%-28s %8i" % (name, value)
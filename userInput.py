@@ -26,8 +26,9 @@ class UserInput:
 		self.instruction_set = []
 		# a list of protocol errors so the user can see where things went wrong
 		self.errors = []
-		self.defined_droplets = []
-		self.deleted_droplets = []
+		# the droplets that exist at the current point of the instruction set and the ones that have been used up (sets for fast lookups)
+		self.defined_droplets = set()
+		self.deleted_droplets = set()
 		
 		
 	def load_input_file(self, filename):
@@ -38,43 +39,52 @@ class UserInput:
 		
 		# clear the previous instructions
 		self.instruction_set = []
-		self.errors = []
 		
-		instructions = []
+		# instructions in the set are in the form: (instruction_id, [list of params])
+		for instruction in self.read_input_file(filename):
+			self.instruction_set.append(instruction)
 		
-		# read the contents of the file with name 'filename'
-		if os.path.isfile(filename):
-			txt = open(filename).read()
-		else:
+		if len(self.errors) > 0:
+			raise ValueError("There were errors in the instruction set")
+	
+	
+	def read_input_file(self, filename, error_callback=None):
+		"""Read the input file one line at a time, yielding each valid instruction as (instruction_id, [list of params])
+		The whole file is never held in memory, so very large files can be checked and run as they are read
+		Errors are added to self.errors as they are found (and passed to the error_callback function if one is given)
+		Any previous errors and droplet definitions are cleared before reading the file"""
+		
+		if not os.path.isfile(filename):
 			raise ValueError("The file cannot be found: Please check that it is spelt correctly")
-			
 		
-		# split the text into line by line instructions
-		instructions = txt.split('\n')
-		# for windows: remove any carriage return characters
-		instructions = filter(lambda ch: ch != '\r', instructions)
+		self.errors = []
+		self.defined_droplets = set()
+		self.deleted_droplets = set()
 		
 		line_count = 1
 		
-		for i in instructions:
-			if i != "" and i[0] != " ":
-				try:
-					instruction_id = self.match_instruction(i)
-					params = self.extract_parameters(instruction_id, i)
-					
-					self.check_defined_droplets(instruction_id, params)
-					
-					# add the 'decoded' instruction to the instruction set
-					# instructions in the set are in the form: (instruction_id, [list of params])
-					self.instruction_set.append((instruction_id, params))
-					
-				except ValueError as val_e:
-					self.errors.append("Line %i: '%s' ::: %s" % (line_count, i, val_e.args[0]))
-					
-			line_count += 1
-		
-		if len(self.errors) > 0:
-			raise ValueError("There were errors in the instruction set")
+		with open(filename) as input_file:
+			for i in input_file:
+				# for windows: remove any carriage return characters
+				i = i.rstrip("\r\n")
+				
+				if i != "" and i[0] != " ":
+					try:
+						instruction_id = self.match_instruction(i)
+						params = self.extract_parameters(instruction_id, i)
+						
+						self.check_defined_droplets(instruction_id, params)
+						
+					except ValueError as val_e:
+						error = "Line %i: '%s' ::: %s" % (line_count, i, val_e.args[0])
+						self.errors.append(error)
+						if error_callback is not None:
+							error_callback(error)
+					else:
+						# pass on the 'decoded' instruction
+						yield (instruction_id, params)
+						
+				line_count += 1
 		
 	
 	def match_instruction(self, instruction):
@@ -155,6 +165,22 @@ class UserInput:
 		except ValueError as val_e:
 			raise ValueError(val_e.args[0] + undefined_droplets)
 		
+	def get_droplet_names(self, instruction_id, params):
+		"""Returns the droplets that the instruction uses up and the droplets that it defines
+		as a tuple of two lists: (used droplets, defined droplets)
+		These are the same droplets that check_defined_droplets checks"""
+
+		if instruction_id == Instructions.NEW:
+			return ([], [params[0]])
+		elif instruction_id == Instructions.MIX:
+			return ([params[0], params[1]], [params[2]])
+		elif instruction_id == Instructions.SPLIT:
+			return ([params[0]], [params[1], params[2]])
+		elif instruction_id == Instructions.MOVE:
+			return ([params[0]], [])
+		else:
+			return ([], [])
+
 	def define_droplet(self, droplet):
 		"""This defines the droplet if it not already defined, if it is already defined, it throws an error"""
 		
@@ -162,7 +188,7 @@ class UserInput:
 		if droplet in self.defined_droplets:
 			raise ValueError("Droplet %s has already been defined previously in the instruction set" % (droplet,))
 		else:
-			self.defined_droplets.append(droplet)
+			self.defined_droplets.add(droplet)
 
 	def check_droplet_is_defined(self, droplet):
 		"""This checks if the given droplet name is already defined"""
@@ -180,7 +206,7 @@ class UserInput:
 		"""This removes a droplet definition"""
 		
 		self.defined_droplets.remove(droplet)
-		self.deleted_droplets.append(droplet)
+		self.deleted_droplets.add(droplet)
 
 if __name__=="__main__":
 	
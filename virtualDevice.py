@@ -0,0 +1,368 @@
+"""This module is a virtual version of the hardware so that the software can be run without the device
+The VirtualArduino speaks the serial protocol over a pseudo terminal, acting the same as ArduinoCode.ino
+The DropletSimulator moves droplets towards the plates that are switched on
+The VirtualCamera renders frames of the simulated grid that CameraInput.find_drop_positions can read"""
+
+import os
+import pty
+import sys
+import select
+import threading
+import time
+import tty
+
+import cv2
+import numpy as np
+
+class DropletSimulator:
+	"""Simulates the droplets on the grid of plates
+	The plates are driven the same way as on the arduino: each plate is on when its source pin is low and its ground pin is high"""
+
+	def __init__(self, dimensions=[8,9]):
+		"""Initialise the simulated grid with no droplets and every pin low (as the arduino pins are at startup)"""
+
+		self.maxX = dimensions[0]
+		self.maxY = dimensions[1]
+
+		#source pins (x axis) and ground pins (y axis), True is HIGH
+		self.source = [False] * self.maxX
+		self.ground = [False] * self.maxY
+
+		#the positions of the droplets as [x, y] lists
+		self.droplets = []
+		self.lock = threading.RLock()
+
+	def add_droplet(self, x, y):
+		"""Place a droplet on the plate at x, y"""
+
+		with self.lock:
+			self.droplets.append([x, y])
+
+	def set_plate(self, x, y):
+		"""Turn on the plate at x, y (as setPlate in the arduino code)"""
+
+		with self.lock:
+			self.source[x - 1] = False
+			self.ground[y - 1] = True
+			self.update()
+
+	def clear_plate(self, x, y):
+		"""Turn off the plate at x, y (as clearPlate in the arduino code)"""
+
+		with self.lock:
+			self.source[x - 1] = True
+			self.ground[y - 1] = False
+			self.update()
+
+	def clear_plates(self):
+		"""Turn off all the plates (as clearPlates in the arduino code)"""
+
+		with self.lock:
+			self.source = [True] * self.maxX
+			self.ground = [False] * self.maxY
+			self.update()
+
+	def apply_frame(self, plates):
+		"""Set the given plates on and every other plate off in one go (as applyFrame in the arduino code)"""
+
+		with self.lock:
+			self.source = [True] * self.maxX
+			self.ground = [False] * self.maxY
+			for x, y in plates:
+				self.source[x - 1] = False
+				self.ground[y - 1] = True
+			self.update()
+
+	def is_on(self, x, y):
+		"""Check whether the plate at x, y is on"""
+
+		if x < 1 or x > self.maxX or y < 1 or y > self.maxY:
+			return False
+		return not self.source[x - 1] and self.ground[y - 1]
+
+	def update(self):
+		"""Move the droplets in response to the plates
+		A droplet on a plate that is on is held there (stretched over any plates either side of it that are on),
+		a droplet on a plate that is off with the plates either side of it on is pulled apart onto them
+		(as Grid.split_droplet turns the centre plate off), otherwise it moves onto a neighbouring plate that is on,
+		droplets that end up on the same plate are merged"""
+
+		with self.lock:
+			droplets = []
+
+			for x, y in self.droplets:
+				if self.is_on(x, y):
+					droplets.append([x, y])
+				elif self.is_on(x - 1, y) and self.is_on(x + 1, y):
+					droplets += [[x - 1, y], [x + 1, y]]
+				elif self.is_on(x, y - 1) and self.is_on(x, y + 1):
+					droplets += [[x, y - 1], [x, y + 1]]
+				else:
+					#move towards the first neighbouring plate that is on (if there are none the droplet stays still)
+					for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+						if self.is_on(x + dx, y + dy):
+							x += dx
+							y += dy
+							break
+					droplets.append([x, y])
+
+			#merge any droplets that are on the same plate
+			self.droplets = []
+			for droplet in droplets:
+				if droplet not in self.droplets:
+					self.droplets.append(droplet)
+
+	def get_positions(self):
+		"""Return the positions of the droplets as a list of (x, y) tuples"""
+
+		with self.lock:
+			return [(x, y) for x, y in self.droplets]
+
+
+class VirtualArduino:
+	"""Acts as the arduino on the other end of a pseudo terminal
+	The port_name attribute is the name of the terminal for SerialCommunication to open"""
+
+	def __init__(self, simulator=None, version="V 0.0.4", byte_time=0, max_message=122):
+		"""Open the pseudo terminal and start answering messages
+		byte_time is the time in seconds taken to send each byte back (0 runs faster than the real device),
+		max_message is the longest message given in the descriptor (as the buffer of the arduino code)"""
+
+		if simulator is None:
+			simulator = DropletSimulator()
+
+		self.simulator = simulator
+		self.version = version
+		self.byte_time = byte_time
+		self.max_message = max_message
+
+		#the number of hex characters in a frame message (one bit per plate)
+		self.frame_chars = ((simulator.maxX * simulator.maxY + 7) // 8) * 2
+
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		self.port_name = os.ttyname(self.slave)
+
+		#a count of each type of message received
+		self.received = {}
+
+		self.input = ""
+		self.running = True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def close(self):
+		"""Stop answering messages and close the pseudo terminal"""
+
+		self.running = False
+		self.thread.join()
+		os.close(self.master)
+		os.close(self.slave)
+
+	def run(self):
+		"""Read the messages from the terminal and act on them (as readSerialInput in the arduino code)"""
+
+		while self.running:
+			readable, writable, errors = select.select([self.master], [], [], 0.05)
+
+			if readable != []:
+				self.input += os.read(self.master, 4096)
+
+				while "\n" in self.input:
+					message, self.input = self.input.split("\n", 1)
+					self.message_received(message.rstrip("\r"))
+
+	def reply(self, message, tag):
+		"""Send a reply back, with the sequence tag of the message if it had one"""
+
+		if tag != "":
+			message = "%s:%s" % (message, tag)
+
+		if self.byte_time > 0:
+			time.sleep(self.byte_time * (len(message) + 2))
+
+		os.write(self.master, "%s\r\n" % (message,))
+
+	def get_plate(self, address):
+		"""Return the x, y coordinates from the address in a set or clear message (as readPlate in the arduino code)"""
+
+		if "," in address:
+			x, y = address.split(",", 1)
+			return int(x), int(y)
+		return ord(address[0]) - 48, ord(address[1]) - 48
+
+	def on_grid(self, x, y):
+		"""Check whether the plate is on the grid (the arduino code ignores plates that are not)"""
+
+		return 1 <= x <= self.simulator.maxX and 1 <= y <= self.simulator.maxY
+
+	def message_received(self, message):
+		"""Act on a message (as messageReceived in the arduino code)"""
+
+		message, sep, tag = message.partition(":")
+
+		command = message[0:1]
+		if command == "C" and message[1:3] == "AP":
+			command = "CAP"
+		self.received[command] = self.received.get(command, 0) + 1
+
+		if message[0:1] == "F" and len(message) == 1 + self.frame_chars:
+			self.reply("ACK " + message, tag)
+
+			plates = []
+			for bit in range(0, self.simulator.maxX * self.simulator.maxY):
+				if int(message[1 + (bit // 8) * 2:3 + (bit // 8) * 2], 16) & (1 << (bit % 8)):
+					plates.append(((bit % self.simulator.maxX) + 1, (bit // self.simulator.maxX) + 1))
+			self.simulator.apply_frame(plates)
+
+		elif message[0:1] == "P":
+			self.reply("ACK " + message, tag)
+
+			plates = []
+			for address in message[1:].split(";"):
+				if address != "":
+					x, y = self.get_plate(address)
+					if self.on_grid(x, y):
+						plates.append((x, y))
+			self.simulator.apply_frame(plates)
+
+		elif message[0:1] == "S":
+			self.reply("ACK " + message, tag)
+			x, y = self.get_plate(message[1:])
+			if self.on_grid(x, y):
+				self.simulator.set_plate(x, y)
+
+		elif message[0:1] == "C" and message[1:2] != "A" and message[2:3] != "P":
+			self.reply("ACK " + message, tag)
+			x, y = self.get_plate(message[1:])
+			if self.on_grid(x, y):
+				self.simulator.clear_plate(x, y)
+
+		elif message[0:3] == "CAP":
+			self.reply("ACK CAP", tag)
+			self.simulator.clear_plates()
+
+		elif message[0:3] == "VER":
+			self.reply(self.version, tag)
+
+		elif message[0:3] == "DIM":
+			self.reply("DIM %i,%i,%i" % (self.simulator.maxX, self.simulator.maxY, self.max_message), tag)
+
+
+class ScaledClock:
+	"""A clock that runs faster than real time, used in place of the time module for Grid.clock
+	Every sleep is shortened by the speed factor and the time moves on by speed seconds for every real second"""
+
+	def __init__(self, speed=100.0):
+		"""Initialise the clock to the current time"""
+
+		self.speed = float(speed)
+		self.start = time.time()
+
+	def time(self):
+		"""Return the scaled time"""
+
+		return self.start + (time.time() - self.start) * self.speed
+
+	def sleep(self, seconds):
+		"""Sleep for the scaled amount of time"""
+
+		time.sleep(seconds / self.speed)
+
+
+class VirtualCamera:
+	"""Renders frames of the simulated grid, used in place of cv2.VideoCapture
+	The frames look like the test images: a light board of plates on a darker background with dark round droplets"""
+
+	def __init__(self, simulator, cell_size=52, shape=(480, 640), cells=8, fps=30):
+		"""Initialise the camera
+		cells is the number of plates along each side of the board that the camera can see,
+		reading a frame waits for the next frame time as a real camera does (fps of 0 never waits)"""
+
+		self.simulator = simulator
+		self.cell_size = cell_size
+		self.shape = shape
+		self.cells = cells
+		self.fps = fps
+		self.next_frame_time = 0
+
+		#the top left corner of the board in the frame
+		self.left = (shape[1] - cells * cell_size) // 2
+		self.top = (shape[0] - cells * cell_size) // 2
+
+		#draw the empty board once, the droplets are drawn onto a copy of it for each frame
+		self.board = np.empty((shape[0], shape[1], 3), np.uint8)
+		self.board[:] = (60, 70, 50)
+		size = cells * cell_size
+		cv2.rectangle(self.board, (self.left, self.top), (self.left + size, self.top + size), (220, 220, 220), -1)
+		for i in range(1, cells):
+			cv2.line(self.board, (self.left + i * cell_size, self.top), (self.left + i * cell_size, self.top + size), (90, 90, 90), 1)
+			cv2.line(self.board, (self.left, self.top + i * cell_size), (self.left + size, self.top + i * cell_size), (90, 90, 90), 1)
+
+	def render_frame(self):
+		"""Draw the current droplet positions onto the board"""
+
+		frame = self.board.copy()
+
+		for x, y in self.simulator.get_positions():
+			if x <= self.cells and y <= self.cells:
+				centre = (self.left + int((x - 0.5) * self.cell_size), self.top + int((y - 0.5) * self.cell_size))
+				cv2.circle(frame, centre, int(self.cell_size * 0.45), (70, 70, 70), -1)
+
+		return frame
+
+	def read(self):
+		"""Return a frame in the same way as cv2.VideoCapture.read"""
+
+		if self.fps > 0:
+			now = time.time()
+			if now < self.next_frame_time:
+				time.sleep(self.next_frame_time - now)
+			self.next_frame_time = max(now, self.next_frame_time) + 1.0 / self.fps
+
+		return True, self.render_frame()
+
+	def release(self):
+		"""Nothing to release for the virtual camera"""
+
+		pass
+
+
+if __name__=="__main__":
+	#test suite: run the valid user input file on the virtual device
+	import arduinoComms
+	import cameraInput
+	import droplet_program
+
+	simulator = DropletSimulator()
+	arduino = VirtualArduino(simulator)
+	camera = VirtualCamera(simulator)
+
+	grid = droplet_program.Grid(arduinoComms.ArduinoCommunication(arduino.port_name), cameraInput.CameraInput(capture=camera))
+	grid.clock = ScaledClock(100)
+
+	grid.ui.load_input_file("userinput_valid.txt")
+
+	#the droplets are put onto the simulated grid as the program adds them
+	grid.droplet_added = lambda droplet: simulator.add_droplet(droplet.position["x"], droplet.position["y"])
+
+	start = time.time()
+	program_start = grid.clock.time()
+	grid.run_program()
+	grid.arduino_comm.check_replies()
+
+	print("Run time: %.2f s (%.1f s on the device)" % (time.time() - start, grid.clock.time() - program_start))
+	print("Messages received: %s" % (arduino.received,))
+	print("Unacknowledged messages: %i" % (len(grid.arduino_comm.msg_queue),))
+	print("Program droplets:   %s" % (sorted(grid.droplets.get_positions()),))
+	print("Simulated droplets: %s" % (sorted(simulator.get_positions()),))
+	print("Camera droplets:    %s" % (sorted(grid.camInput.find_drop_positions()),))
+
+	arduino.close()
+
+	#the program has to end up with the droplets where the simulated device has them
+	if sorted(grid.droplets.get_positions()) != sorted(simulator.get_positions()):
+		print("FAILED: The program and simulated droplets are different")
+		sys.exit(1)
+	print("SUCCESS: The program and simulated droplets are the same")